@@ -0,0 +1,480 @@
+import atexit
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context, shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import psycopg
+import pyarrow as pa
+from psycopg import Connection
+
+from afdd.db import fetch_timeseries_columns, pivot_timeseries_columns
+from afdd.graph_index import GraphIndex, component_shards
+from afdd.logger import logger
+from afdd.models import AnomalyBatch, Rule
+from afdd.planner import plan_fetches, resample_alignment
+from afdd.sql_rules import evaluates_in_database, find_anomalies_in_database
+from afdd.utils import anomaly_batch, hit_intervals, merge_intervals
+from afdd.windows import IncrementalWindow, throwaway_time
+
+DEFAULT_CHUNK_SECONDS = 24 * 3600
+INTERVAL_COLUMNS = ["componentURI", "start_time", "end_time"]
+
+
+@dataclass
+class BackfillProgress:
+    """
+    How far a backfill got.
+
+    Attributes:
+        chunks_done: Chunks analyzed so far
+        chunks_total: Chunks the range was split into
+        covered_until: End of the last analyzed chunk
+        rows: Readings loaded from Postgres so far
+        anomalies: Anomalies written so far
+        elapsed: Seconds since the backfill started
+    """
+
+    chunks_done: int
+    chunks_total: int
+    covered_until: datetime
+    rows: int = 0
+    anomalies: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def fraction(self) -> float:
+        return self.chunks_done / self.chunks_total if self.chunks_total else 1.0
+
+
+def chunk_alignment(rules: List[Rule]) -> int:
+    """
+    Seconds every chunk boundary is a multiple of: the least common multiple of the rules' resample sizes. Chunks that end on a bucket
+    boundary of every rule never split a bucket, so the rolling windows carried to the next chunk only hold complete buckets.
+    """
+    return resample_alignment(rules)
+
+
+def backfill_chunks(start_time: datetime, end_time: datetime, chunk_seconds: int, alignment: int) -> List[Tuple[datetime, datetime]]:
+    """
+    Splits [start_time, end_time] into chunks of about chunk_seconds that end on epoch aligned multiples of alignment. Every chunk but
+    the last ends one microsecond before its boundary, since readings are loaded including the end time.
+    """
+    chunk_seconds = max(alignment, chunk_seconds // alignment * alignment)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    first_boundary = (int((start_time - epoch).total_seconds()) // alignment * alignment) + chunk_seconds
+
+    chunks = []
+    chunk_start = start_time
+    boundary = epoch + timedelta(seconds=first_boundary)
+    while boundary < end_time:
+        chunks.append((chunk_start, boundary - timedelta(microseconds=1)))
+        chunk_start = boundary
+        boundary += timedelta(seconds=chunk_seconds)
+    chunks.append((chunk_start, end_time))
+    return chunks
+
+
+def close_intervals(
+    open_intervals: pd.DataFrame, new_intervals: pd.DataFrame, cutoff: Optional[datetime], component_cutoffs: Optional[pd.Series] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Merges the intervals of a chunk into the ones still open from earlier chunks. Hits of later chunks start at cutoff (a window before
+    the next chunk's boundary) at the earliest, so an interval that ends before it can't be extended any more and is closed. A component
+    whose readings stopped can still get hits from where they stopped once they come back, component_cutoffs holds the earlier cutoffs
+    of those components.
+
+    Returns:
+        The closed intervals and the ones that stay open, all of them are closed when cutoff is None (the last chunk)
+    """
+    frames = [frame for frame in (open_intervals, new_intervals) if not frame.empty]
+    if not frames:
+        return open_intervals.iloc[:0], open_intervals.iloc[:0]
+    intervals = pd.concat(frames, ignore_index=True).sort_values(["componentURI", "start_time"], kind="stable")
+    intervals = merge_intervals(
+        components=pd.Index(intervals["componentURI"].astype(object)),
+        start_time=pd.Index(intervals["start_time"]),
+        end_time=pd.Index(intervals["end_time"]),
+    )
+    if cutoff is None:
+        return intervals, intervals.iloc[:0]
+    limits = pd.Series(cutoff, index=intervals.index)
+    if component_cutoffs is not None and not component_cutoffs.empty:
+        earlier = intervals["componentURI"].astype(object).map(component_cutoffs)
+        limits = limits.where(earlier.isna() | (earlier >= cutoff), earlier)
+    closed = intervals["end_time"] < limits
+    return intervals.loc[closed], intervals.loc[~closed]
+
+
+def backfill(
+    conn: Connection,
+    graph_index: GraphIndex,
+    rules: List[Rule],
+    start_time: datetime,
+    end_time: datetime,
+    write: Callable[[AnomalyBatch], None],
+    chunk_seconds: int = DEFAULT_CHUNK_SECONDS,
+    evaluate_in_database: bool = False,
+    on_progress: Optional[Callable[[BackfillProgress], None]] = None,
+) -> BackfillProgress:
+    """
+    Runs rules over past readings between start_time and end_time without loading the whole range at once. The range is walked in
+    chunks; rules with the same fetch group share one query per chunk, and each rule carries its rolling windows and the anomalies that
+    could still grow from one chunk to the next like the rule loop does between cycles, so the anomalies are the same as analyze_data
+    over the whole range. Only one chunk of readings is in memory at a time.
+
+    With evaluate_in_database, the rules that allow it are run by Postgres over the whole range in one query instead.
+
+    Args:
+        write: Called with the anomalies of a rule as soon as they can't change any more
+        on_progress: Called after every chunk
+
+    Returns:
+        The progress after the last chunk
+    """
+    sql_rules = [rule for rule in rules if evaluate_in_database and evaluates_in_database(rule)]
+    chunk_rules = [rule for rule in rules if rule not in sql_rules]
+    started = time.perf_counter()
+    progress = BackfillProgress(chunks_done=0, chunks_total=0, covered_until=start_time)
+    run_in_database(conn, graph_index, sql_rules, start_time, end_time, write, progress)
+
+    def write_intervals(rule: Rule, intervals: pd.DataFrame):
+        view = graph_index.view(rule)
+        anomalies = anomaly_batch(graph=view.graph, intervals=intervals, rule=rule, metadata=view.metadata)
+        write(anomalies)
+        progress.anomalies += len(anomalies)
+
+    if chunk_rules:
+        walk_chunks(conn, graph_index, chunk_rules, start_time, end_time, write_intervals, chunk_seconds, progress, started, on_progress)
+    progress.elapsed = time.perf_counter() - started
+    return progress
+
+
+def run_in_database(
+    conn: Connection,
+    graph_index: GraphIndex,
+    rules: List[Rule],
+    start_time: datetime,
+    end_time: datetime,
+    write: Callable[[AnomalyBatch], None],
+    progress: BackfillProgress,
+) -> None:
+    """Runs the rules that Postgres can evaluate over the whole range, one query per rule"""
+    for rule in rules:
+        logger.info(f"*** ANALYZING DATA IN POSTGRES FOR RULE {rule.rule_id} ***")
+        view = graph_index.view(rule)
+        anomalies = find_anomalies_in_database(conn, view.graph, rule, start_time, end_time, metadata=view.metadata)
+        write(anomalies)
+        progress.anomalies += len(anomalies)
+
+
+def walk_chunks(
+    conn: Connection,
+    graph_index: GraphIndex,
+    rules: List[Rule],
+    start_time: datetime,
+    end_time: datetime,
+    write_intervals: Callable[[Rule, pd.DataFrame], None],
+    chunk_seconds: int,
+    progress: BackfillProgress,
+    started: float,
+    on_progress: Optional[Callable[[BackfillProgress], None]] = None,
+    resume_after: Optional[datetime] = None,
+) -> Tuple[Dict[int, IncrementalWindow], Dict[int, pd.Series]]:
+    """
+    The chunk loop of backfill: evaluates the rules chunk by chunk and calls write_intervals with the anomaly intervals of a rule that
+    can't change any more.
+
+    Returns:
+        The windows of every rule as they are after the last chunk, and (with resume_after) the first reading of every component at or
+        after resume_after by rule, which the partitions of parallel_backfill are stitched together with
+    """
+    chunks = backfill_chunks(start_time, end_time, chunk_seconds, chunk_alignment(rules))
+    progress.chunks_total += len(chunks)
+    groups = plan_fetches(rules)
+    windows: Dict[int, IncrementalWindow] = {rule.rule_id: IncrementalWindow(rule=rule) for rule in rules}
+    open_intervals = {rule.rule_id: pd.DataFrame(columns=INTERVAL_COLUMNS) for rule in rules}
+    resumes = {rule.rule_id: pd.Series(dtype="datetime64[ns, UTC]") for rule in rules}
+
+    for number, (chunk_start, chunk_end) in enumerate(chunks):
+        # the boundary of the next chunk, None for the last one
+        boundary = chunks[number + 1][0] if number + 1 < len(chunks) else None
+        for group in groups:
+            graph = graph_index.scope(group.key.component_type, group.sensor_types)
+            fetch_start = min(windows[rule.rule_id].fetch_start(chunk_start) for rule in group.rules)
+            columns = fetch_timeseries_columns(conn, graph, fetch_start, chunk_end, group.sensor_types)
+            progress.rows += len(columns)
+            timeseries_df = pivot_timeseries_columns(columns, graph)
+            if resume_after is not None and not timeseries_df.empty:
+                ts = timeseries_df.index.get_level_values("ts")
+                first_readings = pd.Series(ts, index=timeseries_df.index.get_level_values(0))[ts >= resume_after].groupby(level=0).min()
+                for rule in group.rules:
+                    known = resumes[rule.rule_id]
+                    resumes[rule.rule_id] = pd.concat([known, first_readings.loc[~first_readings.index.isin(known.index)]])
+
+            for rule in group.rules:
+                new_intervals = open_intervals[rule.rule_id].iloc[:0]
+                # without readings yet, the first chunk with readings starts the windows from start_time like a full pass would
+                if not timeseries_df.empty:
+                    rolling_mean = windows[rule.rule_id].update(timeseries_data=timeseries_df, start_time=start_time)
+                    if not rolling_mean.empty:
+                        new_intervals = hit_intervals(hits=rule_hits(rolling_mean, rule), rule=rule)
+
+                cutoff = None if boundary is None else boundary - timedelta(seconds=rule.condition.duration)
+                component_cutoffs = windows[rule.rule_id].next_buckets() - pd.Timedelta(seconds=rule.condition.duration)
+                closed, open_intervals[rule.rule_id] = close_intervals(
+                    open_intervals[rule.rule_id], new_intervals, cutoff, component_cutoffs=component_cutoffs
+                )
+                if not closed.empty:
+                    write_intervals(rule, closed)
+
+        progress.chunks_done += 1
+        progress.covered_until = chunk_end
+        progress.elapsed = time.perf_counter() - started
+        logger.info(
+            f"backfill {progress.chunks_done}/{progress.chunks_total} chunks up to {chunk_end}: {progress.rows} readings "
+            f"({progress.rows_per_second:.0f}/s), {progress.anomalies} anomalies"
+        )
+        if on_progress is not None:
+            on_progress(progress)
+    return windows, resumes
+
+
+def rule_hits(rolling_mean: pd.DataFrame, rule: Rule) -> pd.MultiIndex:
+    """The (componentURI, ts) rows of a rolling metric where the rule's condition holds"""
+    return rolling_mean.index[rule.condition.evaluator().evaluate(rolling_mean)]
+
+
+@dataclass
+class PartitionResult:
+    """
+    What one task of parallel_backfill hands back: the anomaly intervals of one component shard over one time partition, and what the
+    partition is stitched to its neighbours with.
+
+    Attributes:
+        shard: Component shard the task ran
+        partition: Position of the task's time partition
+        intervals: Anomaly intervals of every rule, by rule_id
+        partials: Buckets every rule carried at the end of the partition (see IncrementalWindow.partials), by rule_id
+        resumes: First reading at or after the start of the partition of every component, by rule_id
+        progress: How far the task got
+    """
+
+    shard: int
+    partition: int
+    intervals: Dict[int, pd.DataFrame]
+    partials: Dict[int, Optional[Dict[str, pd.DataFrame]]]
+    resumes: Dict[int, pd.Series]
+    progress: BackfillProgress
+
+
+def backfill_partitions(
+    start_time: datetime, end_time: datetime, rules: List[Rule], partitions: int
+) -> List[Tuple[datetime, datetime, datetime]]:
+    """
+    Splits [start_time, end_time] into about partitions time ranges that end on chunk boundaries (see backfill_chunks).
+
+    Returns:
+        The start, end and load start of every partition: partitions after the first one load one rolling window before their start, so
+        their first windows are full
+    """
+    alignment = chunk_alignment(rules)
+    span = math.ceil((end_time - start_time).total_seconds() / max(partitions, 1) / alignment) * alignment
+    ranges = backfill_chunks(start_time, end_time, span, alignment)
+    # a whole number of alignments, the load starts stay on bucket boundaries
+    lead = math.ceil(max(rule.condition.duration for rule in rules) / alignment) * alignment
+    return [
+        (partition_start, partition_end, max(start_time, partition_start - timedelta(seconds=lead)) if number else start_time)
+        for number, (partition_start, partition_end) in enumerate(ranges)
+    ]
+
+
+def stitch_partitions(results: List[PartitionResult], rules: List[Rule], start_time: datetime) -> Dict[int, pd.DataFrame]:
+    """
+    Merges the anomaly intervals of the time partitions of one component shard, in partition order. A partition only sees a component's
+    readings from its load start on, so the windows over a gap in the readings that spans a partition edge are missed by both
+    partitions; they are rebuilt from the buckets the earlier partitions carried and the first reading of the later one.
+    """
+    results = sorted(results, key=lambda result: result.partition)
+    stitched = {}
+    for rule in rules:
+        window = IncrementalWindow(rule=rule, first_bucket=pd.Timestamp(throwaway_time(rule, start_time)))
+        frames = []
+        for result in results:
+            if window.partials is not None and not result.resumes[rule.rule_id].empty:
+                gap_rows = window.gap_rows(result.resumes[rule.rule_id])
+                if not gap_rows.empty:
+                    frames.append(hit_intervals(hits=rule_hits(gap_rows, rule), rule=rule))
+            frames.append(result.intervals[rule.rule_id])
+            if result.partials[rule.rule_id] is not None:
+                window.absorb(result.partials[rule.rule_id])
+        empty = pd.DataFrame(columns=INTERVAL_COLUMNS)
+        stitched[rule.rule_id], _ = close_intervals(empty, pd.concat([frame for frame in frames if not frame.empty] or [empty]), None)
+    return stitched
+
+
+# per process state of the parallel_backfill workers, set up once by _start_worker
+_worker: Dict[str, object] = {}
+
+
+def _start_worker(conninfo: str, graph_buffer: str, graph_size: int, rules: List[Rule], chunk_seconds: int):
+    """Opens the worker's own connection and reads the graph out of the shared memory buffer the parent wrote it to"""
+    # the buffer stays open while the worker runs, the graph's columns can point into it
+    buffer = shared_memory.SharedMemory(name=graph_buffer)
+    graph = pa.ipc.open_stream(pa.py_buffer(buffer.buf[:graph_size])).read_all().to_pandas()
+    _worker.update(conn=psycopg.connect(conninfo), buffer=buffer, graph=graph, rules=rules, chunk_seconds=chunk_seconds, shards={})
+    atexit.register(_stop_worker)
+
+
+def _stop_worker():
+    """Closes the worker's connection and its handle of the shared graph buffer when the pool shuts the worker down"""
+    if not _worker:
+        return
+    conn, buffer = _worker["conn"], _worker["buffer"]
+    # the graph and the shard indexes go first, the buffer can't be closed while their columns point into it
+    _worker.clear()
+    conn.close()
+    buffer.close()
+
+
+def _run_partition(shard: int, shards: int, partition: int, partition_start: datetime, partition_end: datetime, load_start: datetime):
+    """Backfills one component shard over one time partition in a worker process"""
+    rules: List[Rule] = _worker["rules"]
+    if shard not in _worker["shards"]:
+        graph = _worker["graph"]
+        # the same crc32 shards as the live loop's (see afdd.graph_index.shard_index), they don't depend on the order the graph was loaded in
+        _worker["shards"][shard] = GraphIndex(graph.loc[component_shards(graph["componentURI"], shards) == shard], rules)
+    graph_index = _worker["shards"][shard]
+
+    started = time.perf_counter()
+    progress = BackfillProgress(chunks_done=0, chunks_total=0, covered_until=load_start)
+    intervals: Dict[int, List[pd.DataFrame]] = {rule.rule_id: [] for rule in rules}
+    windows, resumes = walk_chunks(
+        _worker["conn"],
+        graph_index,
+        rules,
+        load_start,
+        partition_end,
+        lambda rule, closed: intervals[rule.rule_id].append(closed),
+        _worker["chunk_seconds"],
+        progress,
+        started,
+        resume_after=partition_start,
+    )
+    progress.elapsed = time.perf_counter() - started
+    return PartitionResult(
+        shard=shard,
+        partition=partition,
+        intervals={
+            rule_id: pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=INTERVAL_COLUMNS)
+            for rule_id, frames in intervals.items()
+        },
+        partials={rule_id: window.partials for rule_id, window in windows.items()},
+        resumes=resumes,
+        progress=progress,
+    )
+
+
+def parallel_backfill(
+    conninfo: str,
+    graph_index: GraphIndex,
+    rules: List[Rule],
+    start_time: datetime,
+    end_time: datetime,
+    write: Callable[[AnomalyBatch], None],
+    processes: int,
+    chunk_seconds: int = DEFAULT_CHUNK_SECONDS,
+    evaluate_in_database: bool = False,
+    on_progress: Optional[Callable[[BackfillProgress], None]] = None,
+    component_shards: Optional[int] = None,
+    time_partitions: Optional[int] = None,
+) -> BackfillProgress:
+    """
+    Same as backfill, spread over a pool of processes. The components are split into shards and the range into time partitions, and
+    every (shard, partition) pair is backfilled by a worker with its own Postgres connection. The graph is written once to shared memory
+    that every worker reads it from. The readings aren't: every task loads only its own shard's components over its own partition (plus
+    one rolling window before it), so no two tasks read the same readings and there is nothing to share. Loading them in the parent to
+    hand them over in shared memory would run every COPY through one connection and one process and hold them twice, while each worker's
+    own COPY decodes straight into its numpy columns, in parallel with the others. The intervals of the partitions of a shard are stitched together (see stitch_partitions) and
+    written once all of its partitions are done, so the anomalies are the same as backfill's.
+
+    By default there is a shard per process (at most one per component) and enough time partitions for two tasks per process, so a
+    slow task doesn't keep the other processes waiting.
+    """
+    sql_rules = [rule for rule in rules if evaluate_in_database and evaluates_in_database(rule)]
+    chunk_rules = [rule for rule in rules if rule not in sql_rules]
+    started = time.perf_counter()
+    progress = BackfillProgress(chunks_done=0, chunks_total=0, covered_until=start_time)
+    if sql_rules:
+        with psycopg.connect(conninfo) as conn:
+            run_in_database(conn, graph_index, sql_rules, start_time, end_time, write, progress)
+    if not chunk_rules:
+        progress.elapsed = time.perf_counter() - started
+        return progress
+
+    graph = graph_index.graph
+    shards = component_shards or max(1, min(processes, graph["componentURI"].nunique()))
+    partitions = backfill_partitions(start_time, end_time, chunk_rules, time_partitions or math.ceil(2 * processes / shards))
+    alignment = chunk_alignment(chunk_rules)
+    progress.chunks_total = shards * sum(len(backfill_chunks(load_start, end, chunk_seconds, alignment)) for _, end, load_start in partitions)
+    logger.info(f"backfill of {len(chunk_rules)} rules in {shards} component shards x {len(partitions)} time partitions on {processes} processes")
+
+    sink = pa.BufferOutputStream()
+    table = pa.Table.from_pandas(graph, preserve_index=False)
+    with pa.ipc.new_stream(sink, table.schema) as stream:
+        stream.write_table(table)
+    serialized = sink.getvalue()
+    buffer = shared_memory.SharedMemory(create=True, size=max(serialized.size, 1))
+    try:
+        buffer.buf[: serialized.size] = memoryview(serialized).cast("B")
+        results: Dict[int, List[PartitionResult]] = {shard: [] for shard in range(shards)}
+        done_partitions = [0] * len(partitions)
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=get_context("spawn"),
+            initializer=_start_worker,
+            initargs=(conninfo, buffer.name, serialized.size, chunk_rules, chunk_seconds),
+        ) as pool:
+            # shard by shard, so the intervals of a shard are stitched and written while the next ones run
+            tasks = [
+                pool.submit(_run_partition, shard, shards, number, partition_start, partition_end, load_start)
+                for shard in range(shards)
+                for number, (partition_start, partition_end, load_start) in enumerate(partitions)
+            ]
+            for task in as_completed(tasks):
+                result: PartitionResult = task.result()
+                results[result.shard].append(result)
+                progress.chunks_done += result.progress.chunks_done
+                progress.rows += result.progress.rows
+                done_partitions[result.partition] += 1
+                if len(results[result.shard]) == len(partitions):
+                    intervals = stitch_partitions(results.pop(result.shard), chunk_rules, start_time)
+                    for rule in chunk_rules:
+                        if not intervals[rule.rule_id].empty:
+                            view = graph_index.view(rule)
+                            anomalies = anomaly_batch(graph=view.graph, intervals=intervals[rule.rule_id], rule=rule, metadata=view.metadata)
+                            write(anomalies)
+                            progress.anomalies += len(anomalies)
+                # the range is covered up to the end of the last partition that every shard finished, with all the ones before it
+                finished = next((number for number, count in enumerate(done_partitions) if count < shards), len(partitions))
+                if finished:
+                    progress.covered_until = partitions[finished - 1][1]
+                progress.elapsed = time.perf_counter() - started
+                logger.info(
+                    f"backfill {progress.chunks_done}/{progress.chunks_total} chunks up to {progress.covered_until}: {progress.rows} readings "
+                    f"({progress.rows_per_second:.0f}/s), {progress.anomalies} anomalies"
+                )
+                if on_progress is not None:
+                    on_progress(progress)
+    finally:
+        buffer.close()
+        buffer.unlink()
+    return progress
@@ -1,17 +1,45 @@
-from typing import List
+from datetime import datetime
+from typing import Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import time
+import numpy as np
 import pandas as pd
-from psycopg import Connection
+from psycopg import Connection, AsyncConnection
+from psycopg_pool import AsyncConnectionPool
 import json
-import neo4j
 from neo4j import GraphDatabase
 from afdd.utils import strip_brick_prefix
+from afdd.graph_index import GRAPH_COLUMNS, GraphIndex
+from afdd.graph import IdentifierEncoder, brick_timeseries_ids, graph_timeseries_ids, identifier_codes, timeseries_positions
+from afdd.equation import compile_equation
 
-from afdd.models import PointReading, Rule, Condition, Metric, Severity
+from afdd.models import BucketAggregates, IngestStats, PointReading, Rule, Condition, Metric, Severity, TimeseriesColumns
 from afdd.logger import logger
 
 
+def create_pool(conninfo: str, min_size: int = 1, max_size: int = 10) -> AsyncConnectionPool:
+    """
+    Creates a bounded pool of async Postgres connections for the rule loop. The pool is not opened here, it has to be opened inside the
+    running event loop (e.g. `async with pool:`).
+
+    Every connection is checked before it is handed out, so connections that were dropped by the server are discarded and replaced
+    instead of failing a rule cycle. If the server goes away the pool keeps trying to reconnect in the background for reconnect_timeout
+    seconds.
+    """
+    return AsyncConnectionPool(
+        conninfo=conninfo,
+        min_size=min_size,
+        max_size=max_size,
+        open=False,
+        check=AsyncConnectionPool.check_connection,
+        max_idle=300,
+        reconnect_timeout=300,
+    )
+
+
 def insert_timeseries(conn: Connection, data: List[PointReading]) -> None:
-    """Insert a list of timeseries data into the timeseries table. Used for creating sample data."""
+    """Insert a list of timeseries data into the timeseries table. Used for creating sample data, use copy_timeseries for large batches."""
     query = "INSERT INTO timeseries (ts, value, timeseriesid) VALUES "
     values = []
     placeholders = []
@@ -30,36 +58,262 @@ def insert_timeseries(conn: Connection, data: List[PointReading]) -> None:
         raise e
 
 
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)  # signature, flags, header extension length
+PGCOPY_TRAILER = struct.pack("!h", -1)
+POSTGRES_EPOCH_US = 946684800 * 1_000_000  # postgres binary timestamps count microseconds from 2000-01-01
+
+# fixed size part of a timeseries row in the binary COPY format: field count, then length and data of ts and value, then length of
+# the timeseriesid that follows it
+_COPY_ROW_PREFIX = np.dtype(
+    [("fields", ">i2"), ("ts_len", ">i4"), ("ts", ">i8"), ("value_len", ">i4"), ("value", ">f8"), ("id_len", ">i4")]
+)
+
+
+def encode_timeseries_copy(data: pd.DataFrame) -> bytes:
+    """
+    Encodes a dataframe with ts, value and timeseriesid columns into rows of the Postgres binary COPY format (without the header and
+    trailer). The whole chunk is encoded with numpy array operations instead of one Python call per reading.
+    """
+    n = len(data)
+    ts = pd.to_datetime(data["ts"], utc=True, format="ISO8601").to_numpy(dtype="datetime64[us]").astype(np.int64) - POSTGRES_EPOCH_US
+    codes, ids = pd.factorize(data["timeseriesid"].astype(str))
+    encoded_ids = [timeseriesid.encode() for timeseriesid in ids]
+    distinct_lengths = np.array([len(timeseriesid) for timeseriesid in encoded_ids], dtype=np.int64)
+    id_lengths = distinct_lengths[codes]
+
+    prefix = np.empty(n, dtype=_COPY_ROW_PREFIX)
+    prefix["fields"] = 3
+    prefix["ts_len"] = 8
+    prefix["ts"] = ts
+    prefix["value_len"] = 8
+    prefix["value"] = data["value"].to_numpy(dtype=np.float64)
+    prefix["id_len"] = id_lengths
+
+    row_lengths = _COPY_ROW_PREFIX.itemsize + id_lengths
+    row_starts = np.concatenate(([0], np.cumsum(row_lengths)[:-1])).astype(np.int64)
+    buffer = np.empty(int(row_lengths.sum()), dtype=np.uint8)
+    buffer[row_starts[:, None] + np.arange(_COPY_ROW_PREFIX.itemsize)] = prefix.view(np.uint8).reshape(n, _COPY_ROW_PREFIX.itemsize)
+    # the timeseriesid bytes of all rows are copied in one pass out of the distinct ids laid end to end, within is the position of every
+    # byte in its row's id
+    id_bytes = np.frombuffer(b"".join(encoded_ids), dtype=np.uint8)
+    id_offsets = np.concatenate(([0], np.cumsum(distinct_lengths)[:-1])).astype(np.int64)
+    bytes_before = np.concatenate(([0], np.cumsum(id_lengths)[:-1])).astype(np.int64)
+    within = np.arange(int(id_lengths.sum()), dtype=np.int64) - np.repeat(bytes_before, id_lengths)
+    destinations = np.repeat(row_starts + _COPY_ROW_PREFIX.itemsize, id_lengths) + within
+    buffer[destinations] = id_bytes[np.repeat(id_offsets[codes], id_lengths) + within]
+    return buffer.tobytes()
+
+
+def _timeseries_chunks(data, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Splits a dataframe, a mapping of column arrays, or an iterable of either into dataframes of at most chunk_size rows"""
+    if isinstance(data, (pd.DataFrame, Mapping)):
+        data = [data]
+    for part in data:
+        if not isinstance(part, pd.DataFrame):
+            part = pd.DataFrame(part)
+        for start in range(0, len(part), chunk_size):
+            yield part.iloc[start : start + chunk_size]
+
+
+def copy_timeseries(
+    conn: Connection,
+    data: Union[pd.DataFrame, Mapping[str, Iterable], Iterable[Union[pd.DataFrame, Mapping[str, Iterable]]]],
+    chunk_size: int = 100_000,
+) -> IngestStats:
+    """
+    Bulk loads readings into the timeseries table with binary COPY FROM STDIN. Used for backfilling sensor history.
+
+    Args:
+        conn: Postgres connection
+        data: Columnar readings with ts, value and timeseriesid columns: a dataframe, a dict of arrays, or an iterable of those (e.g. a
+            generator reading a large file piece by piece)
+        chunk_size: Number of readings sent and committed per COPY, which bounds the memory used
+
+    Returns:
+        IngestStats: How many readings were loaded and how fast
+    """
+    stats = IngestStats()
+    start = time.perf_counter()
+    for chunk in _timeseries_chunks(data, chunk_size):
+        if chunk.empty:
+            continue
+        payload = encode_timeseries_copy(chunk)
+        with conn.cursor() as cur:
+            with cur.copy("COPY timeseries (ts, value, timeseriesid) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.write(PGCOPY_HEADER)
+                copy.write(payload)
+                copy.write(PGCOPY_TRAILER)
+        conn.commit()
+        stats.rows += len(chunk)
+        stats.chunks += 1
+        stats.seconds = time.perf_counter() - start
+        logger.info(f"copied {stats.rows} readings in {stats.chunks} chunks ({stats.rows_per_second:.0f} rows/s)")
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+# anomalies that are already in the table (same rule, times, points and metadata, see migration 4) are skipped
+ANOMALY_INSERT = """
+  INSERT INTO anomalies (start_time, end_time, rule_id, points, metadata) VALUES (%s, %s, %s, %s, %s)
+  ON CONFLICT (anomaly_key) DO NOTHING
+"""
+
+
 def append_anomalies(conn: Connection, anomaly_list: List[tuple]):
-    """Inserts a list of anomalies into postgres. Used for real time analysis."""
-    query = "INSERT INTO anomalies (start_time, end_time, rule_id, points, metadata) VALUES (%s, %s, %s, %s, %s)"
+    """Inserts a list of anomalies into postgres, skipping the ones already in the table. Used for real time analysis."""
     try:
         with conn.cursor() as cur:
-            cur.executemany(query, anomaly_list)
+            cur.executemany(ANOMALY_INSERT, anomaly_list)
             conn.commit()
     except Exception as e:
         raise e
 
 
-def append_past_anomalies(conn: Connection, anomaly_list: List[tuple]):
-    """Inserts a list of anomalies into postgres, checking if the anomaly already exists in the table. Used for past data analysis."""
-    query = """INSERT INTO anomalies (start_time, end_time, rule_id, points, metadata)
-  SELECT %s, %s, %s, %s, %s
-  WHERE NOT EXISTS (
-    SELECT 1 FROM anomalies
-    WHERE start_time = %s
-    AND end_time = %s
-    AND rule_id = %s
-    AND points = %s
-    AND metadata = %s )"""
-    try:
-        with conn.cursor() as cur:
+def append_past_anomalies(conn: Connection, anomaly_list: Iterable[tuple]) -> int:
+    """
+    Inserts a list of anomalies into postgres, skipping the ones already in the table, so past data analysis can be run again over the
+    same range. The anomalies are streamed with COPY into a temporary staging table and moved into anomalies with one INSERT that skips
+    the anomaly keys the unique index already holds. Used for past data analysis.
+
+    Returns:
+        The number of anomalies that were new
+    """
+    # the staging table is emptied on commit, so the copy and the insert share one transaction
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            """CREATE TEMPORARY TABLE IF NOT EXISTS anomalies_staging (
+              start_time TIMESTAMPTZ NOT NULL,
+              end_time TIMESTAMPTZ NOT NULL,
+              rule_id INT,
+              points JSONB NOT NULL,
+              metadata JSONB NOT NULL
+            ) ON COMMIT DELETE ROWS"""
+        )
+        with cur.copy("COPY anomalies_staging (start_time, end_time, rule_id, points, metadata) FROM STDIN") as copy:
             for anomaly in anomaly_list:
-                param = anomaly + anomaly
-                cur.execute(query, param)
-            conn.commit()
-    except Exception as e:
-        raise e
+                copy.write_row(anomaly)
+        cur.execute(
+            """INSERT INTO anomalies (start_time, end_time, rule_id, points, metadata)
+              SELECT start_time, end_time, rule_id, points, metadata FROM anomalies_staging
+              ON CONFLICT (anomaly_key) DO NOTHING"""
+        )
+        inserted = cur.rowcount
+    conn.commit()
+    return inserted
+
+
+# the open anomalies are found by the component in their metadata (see afdd.utils.component_metadata)
+OPEN_ANOMALIES_QUERY = """
+  SELECT DISTINCT ON (metadata->>'component') metadata->>'component', anomaly_id, start_time, end_time
+  FROM anomalies
+  WHERE rule_id = %s AND end_time >= %s
+  ORDER BY metadata->>'component', end_time DESC
+"""
+
+# an anomaly that would become an exact copy of an existing one is deleted instead, and the existing one is returned in its place
+EXTEND_ANOMALIES = """
+  WITH extension AS (
+    SELECT * FROM unnest(%s::int[], %s::timestamptz[]) AS extension(anomaly_id, end_time)
+  ), target AS (
+    SELECT anomaly.anomaly_id, extension.end_time, existing.anomaly_id AS existing_id
+    FROM anomalies anomaly
+    JOIN extension USING (anomaly_id)
+    LEFT JOIN anomalies existing
+      ON existing.anomaly_key = anomaly_key(anomaly.rule_id, anomaly.start_time, extension.end_time, anomaly.points, anomaly.metadata)
+      AND existing.anomaly_id <> anomaly.anomaly_id
+    WHERE anomaly.end_time < extension.end_time
+  ), duplicate AS (
+    DELETE FROM anomalies USING target WHERE anomalies.anomaly_id = target.anomaly_id AND target.existing_id IS NOT NULL
+  ), extended AS (
+    UPDATE anomalies SET end_time = target.end_time
+    FROM target
+    WHERE anomalies.anomaly_id = target.anomaly_id AND target.existing_id IS NULL
+    RETURNING anomalies.metadata, anomalies.anomaly_id, anomalies.start_time, anomalies.end_time
+  )
+  SELECT metadata->>'component', anomaly_id, start_time, end_time FROM extended
+  UNION ALL
+  SELECT existing.metadata->>'component', existing.anomaly_id, existing.start_time, existing.end_time
+  FROM target JOIN anomalies existing ON existing.anomaly_id = target.existing_id
+"""
+
+# the no-op update returns the id of an anomaly that was already in the table, so it can be continued too
+INSERT_OPEN_ANOMALIES = """
+  INSERT INTO anomalies (start_time, end_time, rule_id, points, metadata)
+  SELECT * FROM unnest(%s::timestamptz[], %s::timestamptz[], %s::int[], %s::jsonb[], %s::jsonb[])
+  ON CONFLICT (anomaly_key) DO UPDATE SET end_time = EXCLUDED.end_time
+  RETURNING metadata->>'component', anomaly_id, start_time, end_time
+"""
+
+
+async def fetch_open_anomalies_async(conn: AsyncConnection, rule_id: int, since: datetime) -> List[tuple]:
+    """
+    The latest anomaly of every component of a rule that ended at or after since, as (componentURI, anomaly_id, start_time, end_time)
+    rows. Used to load the open anomalies of afdd.open_anomalies.OpenAnomalies.
+    """
+    async with conn.cursor() as cur:
+        await cur.execute(OPEN_ANOMALIES_QUERY, (rule_id, since))
+        rows = await cur.fetchall()
+    await conn.commit()
+    return rows
+
+
+async def write_open_anomalies_async(conn: AsyncConnection, extensions: List[Tuple[int, datetime]], anomaly_list: List[tuple]) -> List[tuple]:
+    """
+    Extends the end_time of open anomalies and inserts new anomalies in one transaction, one statement each. Used for real time analysis.
+
+    Args:
+        conn: Async Postgres connection
+        extensions: (anomaly_id, end_time) of every anomaly to extend, an anomaly is never shortened
+        anomaly_list: New anomalies in the format of AnomalyBatch.to_tuples
+
+    Returns:
+        The (componentURI, anomaly_id, start_time, end_time) rows that were written
+    """
+    rows = []
+    async with conn.transaction(), conn.cursor() as cur:
+        if extensions:
+            anomaly_ids, end_times = zip(*extensions)
+            await cur.execute(EXTEND_ANOMALIES, (list(anomaly_ids), list(end_times)))
+            rows.extend(await cur.fetchall())
+        if anomaly_list:
+            await cur.execute(INSERT_OPEN_ANOMALIES, [list(column) for column in zip(*anomaly_list)])
+            rows.extend(await cur.fetchall())
+    return rows
+
+
+# a rule that has no watermark for this number of shards (AFDD_COMPONENT_SHARDS changed) resumes from the earliest watermark it has
+# for another number of shards, rules without any watermark don't hold the others back
+WATERMARK_QUERY = """
+  SELECT min(coalesce(
+    (SELECT processed_until FROM watermarks WHERE rule_id = rule.rule_id AND shards = %(shards)s AND shard = %(shard)s),
+    (SELECT min(processed_until) FROM watermarks WHERE rule_id = rule.rule_id AND shards <> %(shards)s)
+  ))
+  FROM unnest(%(rule_ids)s::int[]) AS rule(rule_id)
+"""
+
+WRITE_WATERMARKS = """
+  INSERT INTO watermarks (rule_id, shards, shard, processed_until)
+  SELECT rule.rule_id, %(shards)s, %(shard)s, %(processed_until)s FROM unnest(%(rule_ids)s::int[]) AS rule(rule_id)
+  ON CONFLICT (rule_id, shards, shard) DO UPDATE SET processed_until = greatest(watermarks.processed_until, EXCLUDED.processed_until)
+"""
+
+
+async def fetch_watermark_async(conn: AsyncConnection, rule_ids: List[int], shard: int = 0, shards: int = 1) -> Optional[datetime]:
+    """
+    Up to where the rules of a fetch group were analyzed for one component shard: the earliest watermark of the rules, None if none of
+    them ran before. Real time analysis resumes from here after a restart.
+    """
+    async with conn.cursor() as cur:
+        await cur.execute(WATERMARK_QUERY, {"rule_ids": rule_ids, "shard": shard, "shards": shards})
+        (processed_until,) = await cur.fetchone()
+    await conn.commit()
+    return processed_until
+
+
+async def write_watermarks_async(conn: AsyncConnection, rule_ids: List[int], processed_until: datetime, shard: int = 0, shards: int = 1) -> None:
+    """Records that the rules were analyzed up to processed_until (exclusive) for one component shard, a watermark never moves back"""
+    async with conn.transaction():
+        await conn.execute(WRITE_WATERMARKS, {"rule_ids": rule_ids, "shard": shard, "shards": shards, "processed_until": processed_until})
 
 
 def load_rules(conn: Connection, rules_json: str) -> None:
@@ -116,6 +370,8 @@ def get_rules(conn: Connection) -> List[Rule]:
                             duration=row[3]["duration"],
                             sleep_time=row[3]["sleep_time"],
                             severity=Severity[row[3]["severity"].upper()],
+                            # compiling here means a typo in a sensor name fails at startup instead of inside the rule loop
+                            compiled=compile_equation(row[3]["equation"], sensor_types=row[5]),
                         ),
                     )
                 )
@@ -126,32 +382,15 @@ def get_rules(conn: Connection) -> List[Rule]:
         raise e
 
 
-def load_timeseries(
-    conn: Connection,
-    graph: pd.DataFrame,
-    start_time: str,
-    end_time: str,
-    brick_list: List[str],
-) -> pd.DataFrame:
-    """
-    Creates a dataframe containing the timeseries data between given start and end time for given brick classes.
-    The brick classes should just be passed in as the ending of the URI (everything after https://brickschema.org/schema/Brick#).
-    It returns a multi-indexed dataframe where the level 0 index is component, the level 1 index is timestamp, and each column is a brick class.
-
-    Returns:
-        pd.DataFrame: A multi-indexed dataframe with the following columns:
-            - componentURI: URI of the component
-            - ts: Timestamp
-            - value: Value of the timeseries data
-    """
+def _timeseries_query(graph: pd.DataFrame, start_time: str, end_time: str, brick_list: List[str]) -> Tuple[str, tuple]:
+    """Builds the query and parameters that select the timeseries data between start and end time for the given brick classes"""
     # gets all of the timeseriesids that correspond to the given brick class
+    ids = graph_timeseries_ids(graph)
     all_ts_ids = []
     for brick_class in brick_list:
-        timeseries_ids = graph.loc[graph["class"] == brick_class, "timeseriesid"].to_list()
-        timeseries_ids = [str(id).strip() for id in timeseries_ids]
-        all_ts_ids.extend(timeseries_ids)
+        all_ts_ids.extend(ids[(graph["class"] == brick_class).to_numpy()])
 
-    logger.info(f"all timeseries ids that correspond with the brick classes {brick_list}: {all_ts_ids}")
+    logger.debug(f"{len(all_ts_ids)} timeseries ids correspond with the brick classes {brick_list}")
     # Generating placeholders for SQL IN clause
     placeholders = ", ".join(["%s" for _ in all_ts_ids])
 
@@ -161,78 +400,465 @@ def load_timeseries(
       WHERE timeseriesid IN ({placeholders}) AND ts >= %s AND ts <= %s
       ORDER BY ts ASC
     """
+    return query, (*all_ts_ids, start_time, end_time)
 
-    with conn.cursor() as cur:
-        parameters = (*all_ts_ids, start_time, end_time)
-        cur.execute(query, parameters)
-        rows = cur.fetchall()
-
-        # make a dataframe out of the query results
-        df = pd.DataFrame(rows, columns=["ts", "value", "timeseriesid"])
-        logger.info(f"timeseries data: {df}")
-
-        # convert the ts column to datetimes
-        df["ts"] = pd.to_datetime(df["ts"])
-        df.drop_duplicates(inplace=True)
-
-        # strip whitespaces so that merge can match timeseriesids
-        graph["timeseriesid"] = graph["timeseriesid"].str.strip()
-        df["timeseriesid"] = df["timeseriesid"].str.strip()
-
-        # merge ts dataframe and information from graph by matching up timeseriesid
-        timeseries_df = pd.merge(
-            df,
-            graph[["class", "timeseriesid", "componentURI"]],
-            on="timeseriesid",
-            how="left",
-        )
-        logger.info(f"timeseriesdf merged: \n{timeseries_df}")
-
-        # pivot the df to have ts as the index, timeseriesid as the columns and value as the values
-        df_pivoted = timeseries_df.pivot_table(
-            index=["componentURI", "ts"],
-            columns="class",
-            values="value",
-            aggfunc="first",
-        )
-        df_pivoted.sort_index(inplace=True)
 
-        conn.commit()
-        logger.info(f"pivoted ts df: \n{df_pivoted.to_string()}")
+def pivot_timeseries(rows: List[tuple], graph: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turns the rows of a timeseries query into a dataframe indexed by component and timestamp with a column per brick class. This is the
+    row based path, load_timeseries uses the columnar fetch_timeseries_columns and pivot_timeseries_columns instead.
+    """
+    # make a dataframe out of the query results
+    df = pd.DataFrame(rows, columns=["ts", "value", "timeseriesid"])
+
+    # convert the ts column to datetimes
+    df["ts"] = pd.to_datetime(df["ts"])
+    df.drop_duplicates(inplace=True)
+
+    # strip whitespaces so that merge can match timeseriesids, without touching the caller's graph
+    graph = pd.DataFrame({
+        "class": graph["class"].to_numpy(dtype=object),
+        "timeseriesid": graph_timeseries_ids(graph),
+        "componentURI": graph["componentURI"].to_numpy(dtype=object),
+    })
+    df["timeseriesid"] = df["timeseriesid"].str.strip()
+
+    # merge ts dataframe and information from graph by matching up timeseriesid
+    timeseries_df = pd.merge(
+        df,
+        graph,
+        on="timeseriesid",
+        how="left",
+    )
+
+    # pivot the df to have ts as the index, timeseriesid as the columns and value as the values
+    df_pivoted = timeseries_df.pivot_table(
+        index=["componentURI", "ts"],
+        columns="class",
+        values="value",
+        aggfunc="first",
+    )
+    df_pivoted.sort_index(inplace=True)
+    logger.debug(f"pivoted {len(df)} timeseries rows into {len(df_pivoted)} rows for {df_pivoted.index.get_level_values(0).nunique()} components")
+
+    return df_pivoted
+
+
+# fixed size rows of the binary COPY output of the columnar timeseries query: field count, then length and data of ts, value and the
+# position of the reading's timeseriesid in the query's id array
+_COPY_OUT_ROW = np.dtype(
+    [("fields", ">i2"), ("ts_len", ">i4"), ("ts", ">i8"), ("value_len", ">i4"), ("value", ">f8"), ("point_len", ">i4"), ("point", ">i4")]
+)
+
+
+def _timeseries_copy_query(
+    graph: pd.DataFrame, start_time: str, end_time: str, brick_list: List[str], ids: Optional[np.ndarray] = None
+) -> Tuple[str, tuple, np.ndarray]:
+    """
+    Builds the binary COPY query that streams the timeseries data between start and end time for the given brick classes. Instead of
+    the timeseriesid text each row carries the id's position in the queried id array, so that every row has the same size. ids are the
+    timeseriesids of the brick classes, looked up from the graph if not given.
+
+    Returns:
+        The query, its parameters and the array of queried timeseriesids
+    """
+    if ids is None:
+        ids = brick_timeseries_ids(graph, brick_list)
+    logger.debug(f"{len(ids)} timeseries ids correspond with the brick classes {brick_list}")
+
+    query = """
+      COPY (
+        SELECT t.ts, t.value, (ids.position - 1)::int4
+        FROM unnest(%s::text[]) WITH ORDINALITY AS ids(timeseriesid, position)
+        JOIN timeseries t ON t.timeseriesid = ids.timeseriesid
+        WHERE t.ts >= %s AND t.ts <= %s
+      ) TO STDOUT (FORMAT BINARY)
+    """
+    return query, (list(ids), start_time, end_time), ids
+
+
+def decode_timeseries_copy(payload: Union[bytes, bytearray], timeseries_ids: np.ndarray) -> TimeseriesColumns:
+    """
+    Reads the binary COPY output of the columnar timeseries query into typed arrays. The rows are viewed in place by one numpy record
+    array, no Python object is created per reading.
+
+    Raises:
+        ValueError: If the payload isn't in the layout the query produces
+    """
+    if bytes(payload[: len(PGCOPY_HEADER)]) != PGCOPY_HEADER:
+        raise ValueError("Unexpected header in the binary COPY output of the timeseries query")
+    body = memoryview(payload)[len(PGCOPY_HEADER) : len(payload) - len(PGCOPY_TRAILER)]
+    if len(body) % _COPY_OUT_ROW.itemsize:
+        raise ValueError("Unexpected row size in the binary COPY output of the timeseries query")
+
+    rows = np.frombuffer(body, dtype=_COPY_OUT_ROW)
+    if not ((rows["fields"] == 3) & (rows["ts_len"] == 8) & (rows["value_len"] == 8) & (rows["point_len"] == 4)).all():
+        raise ValueError("Unexpected row layout in the binary COPY output of the timeseries query")
+
+    return TimeseriesColumns(
+        ts=(rows["ts"].astype(np.int64) + POSTGRES_EPOCH_US) * 1000,
+        value=rows["value"].astype(np.float64),
+        point=rows["point"].astype(np.int32),
+        timeseries_ids=timeseries_ids,
+    )
+
+
+def _expand_points(point: np.ndarray, timeseries_ids: np.ndarray, graph: pd.DataFrame, positions: Optional[np.ndarray] = None):
+    """
+    Maps every row of a columnar result to the graph rows of its timeseriesid. A timeseriesid that is in several graph rows fills all of
+    them, like the merge in pivot_timeseries does. positions is the position of every graph row's timeseriesid in timeseries_ids, when
+    the caller already has it (see GraphIndex.timeseries_positions).
+
+    Returns:
+        For every (result row, graph row) pair the index of the result row, the component code and the brick class code, followed by the
+        sorted component URIs and brick classes the codes point into
+    """
+    position = timeseries_positions(graph, timeseries_ids) if positions is None else positions
+    queried = position >= 0
+    point_position = position[queried]
+    # on an interned graph these are the codes it already holds, no string is compared
+    component_codes, components = identifier_codes(graph["componentURI"])
+    class_codes, classes = identifier_codes(graph["class"])
+    component_codes, class_codes = component_codes[queried], class_codes[queried]
+
+    # repeat each result row once per graph row of its timeseriesid
+    by_position = np.argsort(point_position, kind="stable")
+    rows_per_id = np.bincount(point_position, minlength=len(timeseries_ids))
+    first_row = np.cumsum(rows_per_id) - rows_per_id
+    copies = rows_per_id[point]
+    row = np.repeat(np.arange(len(point)), copies)
+    offset = np.arange(len(row)) - np.repeat(np.cumsum(copies) - copies, copies)
+    point_row = by_position[first_row[point][row] + offset]
+    return row, component_codes[point_row], class_codes[point_row], components, classes
+
+
+def pivot_timeseries_columns(columns: TimeseriesColumns, graph: pd.DataFrame, positions: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """
+    Builds the same frame as pivot_timeseries from the typed arrays of a columnar fetch. The readings are sorted once with numpy and
+    scattered into a (component, ts) x class matrix instead of going through merge and pivot_table. positions is the position of every
+    graph row's timeseriesid in columns.timeseries_ids, looked up from the graph if not given.
+    """
+    reading, component, sensor_class, components, classes = _expand_points(columns.point, columns.timeseries_ids, graph, positions)
+    ts = columns.ts[reading]
+    value = columns.value[reading]
+
+    # like pivot_table's "first", missing values are skipped and the first reading of a cell wins, lexsort is stable so readings of the
+    # same cell stay in query order
+    valid = ~np.isnan(value)
+    order = np.lexsort((sensor_class[valid], ts[valid], component[valid]))
+    component, sensor_class, ts, value = (array[valid][order] for array in (component, sensor_class, ts, value))
+
+    new_row = np.ones(len(ts), dtype=bool)
+    new_row[1:] = (component[1:] != component[:-1]) | (ts[1:] != ts[:-1])
+    first_in_cell = new_row.copy()
+    first_in_cell[1:] |= sensor_class[1:] != sensor_class[:-1]
+    row = np.cumsum(new_row) - 1
+
+    matrix = np.full((int(new_row.sum()), len(classes)), np.nan)
+    matrix[row[first_in_cell], sensor_class[first_in_cell]] = value[first_in_cell]
+    present = ~np.isnan(matrix).all(axis=0)
+
+    ts_levels, ts_codes = np.unique(ts[new_row], return_inverse=True)
+    index = pd.MultiIndex(
+        levels=[pd.Index(components), pd.to_datetime(ts_levels, unit="ns", utc=True)],
+        codes=[component[new_row], ts_codes],
+        names=["componentURI", "ts"],
+    ).remove_unused_levels()
+    df_pivoted = pd.DataFrame(matrix[:, present], index=index, columns=pd.Index(classes[present], name="class"))
+    logger.debug(f"pivoted {len(columns)} timeseries rows into {len(df_pivoted)} rows for {len(index.levels[0])} components")
 
     return df_pivoted
 
 
-def load_graph_neo4j(driver: GraphDatabase.driver, component_class: str) -> pd.DataFrame:
-    """Loads all necessary sensor information for the given component for a neo4j graph"""
+def fetch_timeseries_columns(
+    conn: Connection,
+    graph: pd.DataFrame,
+    start_time: str,
+    end_time: str,
+    brick_list: List[str],
+    timeseries_ids: Optional[np.ndarray] = None,
+) -> TimeseriesColumns:
+    """
+    Streams the timeseries data between start and end time for the given brick classes with binary COPY into typed arrays. Pass the
+    timeseries_ids of the brick classes when they are precomputed (see GraphIndex.timeseries_ids), otherwise they're looked up.
+    """
+    query, parameters, timeseries_ids = _timeseries_copy_query(graph, start_time, end_time, brick_list, timeseries_ids)
+
+    buffer = bytearray()
+    with conn.cursor() as cur:
+        with cur.copy(query, parameters) as copy:
+            for chunk in copy:
+                buffer += chunk
+        conn.commit()
+
+    return decode_timeseries_copy(buffer, timeseries_ids)
+
+
+async def fetch_timeseries_columns_async(
+    conn: AsyncConnection,
+    graph: pd.DataFrame,
+    start_time: str,
+    end_time: str,
+    brick_list: List[str],
+    timeseries_ids: Optional[np.ndarray] = None,
+) -> TimeseriesColumns:
+    """Same as fetch_timeseries_columns, but awaits the stream on an async connection so other rules can run while it is in flight"""
+    query, parameters, timeseries_ids = _timeseries_copy_query(graph, start_time, end_time, brick_list, timeseries_ids)
+
+    buffer = bytearray()
+    async with conn.cursor() as cur:
+        async with cur.copy(query, parameters) as copy:
+            async for chunk in copy:
+                buffer += chunk
+        await conn.commit()
+
+    return decode_timeseries_copy(buffer, timeseries_ids)
+
+
+# fixed size rows of the binary COPY output of the bucket aggregate query: bucket start, position of the timeseriesid, sum, count,
+# min and max of the readings in the bucket and the newest reading's timestamp
+_COPY_OUT_BUCKET = np.dtype(
+    [
+        ("fields", ">i2"),
+        ("bucket_len", ">i4"),
+        ("bucket", ">i8"),
+        ("point_len", ">i4"),
+        ("point", ">i4"),
+        ("sum_len", ">i4"),
+        ("sum", ">f8"),
+        ("count_len", ">i4"),
+        ("count", ">i8"),
+        ("min_len", ">i4"),
+        ("min", ">f8"),
+        ("max_len", ">i4"),
+        ("max", ">f8"),
+        ("last_len", ">i4"),
+        ("last", ">i8"),
+    ]
+)
+
+
+def _bucket_copy_query(
+    graph: pd.DataFrame, start_time: str, end_time: str, brick_list: List[str], resample_size: int, ids: Optional[np.ndarray] = None
+) -> Tuple[str, tuple, np.ndarray]:
+    """
+    Builds the binary COPY query that aggregates the readings of every timeseriesid into buckets of resample_size seconds. Buckets are
+    aligned to the epoch like the pandas resampling in afdd.windows, and NaN readings are left out like pandas skips them.
+    """
+    if ids is None:
+        ids = brick_timeseries_ids(graph, brick_list)
+    logger.debug(f"{len(ids)} timeseries ids correspond with the brick classes {brick_list}")
 
     query = """
-  MATCH (c:Class) WHERE c.uri CONTAINS $component_class
-  MATCH (c)-[:HAS_BRICK_CLASS]-(comp:Component)
-  MATCH (comp)-[:hasPoint]-(p:Point)
-  MATCH (comp)-[:isDeviceOf]-(d:Device)
-  MATCH (p)-[:HAS_BRICK_CLASS]-(class: Class)
-  MATCH (p)-[:hasExternalReference]-(t:TimeseriesReference)
-  RETURN p.uri AS point, class.uri AS class, t.hasTimeseriesId AS timeseriesid, d.uri AS deviceURI, comp.uri AS componentURI
-  """
-
-    df = driver.execute_query(
-        query_=query,
-        component_class=component_class,
-        database_="neo4j",
-        result_transformer_=neo4j.Result.to_df,
+      COPY (
+        SELECT
+          date_bin(make_interval(secs => %s), t.ts, TIMESTAMPTZ 'epoch'),
+          (ids.position - 1)::int4,
+          sum(t.value),
+          count(*),
+          min(t.value),
+          max(t.value),
+          max(t.ts)
+        FROM unnest(%s::text[]) WITH ORDINALITY AS ids(timeseriesid, position)
+        JOIN timeseries t ON t.timeseriesid = ids.timeseriesid
+        WHERE t.ts >= %s AND t.ts <= %s AND t.value <> 'NaN'
+        GROUP BY 1, 2
+      ) TO STDOUT (FORMAT BINARY)
+    """
+    return query, (resample_size, list(ids), start_time, end_time), ids
+
+
+def decode_bucket_copy(
+    payload: Union[bytes, bytearray], timeseries_ids: np.ndarray, graph: pd.DataFrame, positions: Optional[np.ndarray] = None
+) -> BucketAggregates:
+    """
+    Reads the binary COPY output of the bucket aggregate query into per component partial aggregates. Timeseriesids of the same
+    component and brick class are combined, so the result matches bucketing the pivoted readings.
+
+    Raises:
+        ValueError: If the payload isn't in the layout the query produces
+    """
+    if bytes(payload[: len(PGCOPY_HEADER)]) != PGCOPY_HEADER:
+        raise ValueError("Unexpected header in the binary COPY output of the bucket aggregate query")
+    body = memoryview(payload)[len(PGCOPY_HEADER) : len(payload) - len(PGCOPY_TRAILER)]
+    if len(body) % _COPY_OUT_BUCKET.itemsize:
+        raise ValueError("Unexpected row size in the binary COPY output of the bucket aggregate query")
+    rows = np.frombuffer(body, dtype=_COPY_OUT_BUCKET)
+    if not (rows["fields"] == 7).all():
+        raise ValueError("Unexpected row layout in the binary COPY output of the bucket aggregate query")
+
+    row, component, sensor_class, components, classes = _expand_points(rows["point"].astype(np.int32), timeseries_ids, graph, positions)
+    # grouped by the integer codes of components and classes, the URIs are only looked up for the distinct codes of the result
+    buckets = pd.DataFrame({
+        "componentURI": component,
+        "ts": pd.to_datetime((rows["bucket"][row].astype(np.int64) + POSTGRES_EPOCH_US) * 1000, unit="ns", utc=True),
+        "class": sensor_class,
+        "sum": rows["sum"][row].astype(np.float64),
+        "count": rows["count"][row].astype(np.int64),
+        "min": rows["min"][row].astype(np.float64),
+        "max": rows["max"][row].astype(np.float64),
+    })
+    if buckets.empty:
+        index = pd.MultiIndex.from_arrays([[], pd.DatetimeIndex([], tz="UTC")], names=["componentURI", "ts"])
+        return BucketAggregates(
+            partials={name: pd.DataFrame(index=index, columns=pd.Index([], name="class")) for name in ("sum", "count", "min", "max")},
+            watermark=None,
+            rows=0,
+        )
+
+    table = (
+        buckets.groupby(["componentURI", "ts", "class"])
+        .agg({"sum": "sum", "count": "sum", "min": "min", "max": "max"})
+        .unstack("class")
     )
-    df["class"] = df["class"].apply(strip_brick_prefix)
-    return df
+    table.index = table.index.set_levels(components[table.index.levels[0]], level="componentURI")
+    table.columns = table.columns.set_levels(classes[table.columns.levels[1]], level="class")
+    partials = {name: table[name] for name in ("sum", "count", "min", "max")}
+    # like pandas resampling, a brick class without readings in an occupied bucket has a sum and count of 0
+    partials["sum"] = partials["sum"].fillna(0.0)
+    partials["count"] = partials["count"].fillna(0).astype(np.int64)
+
+    watermark = pd.Timestamp((int(rows["last"].max()) + POSTGRES_EPOCH_US) * 1000, tz="UTC")
+    return BucketAggregates(partials=partials, watermark=watermark, rows=len(rows))
+
+
+def fetch_bucket_aggregates(
+    conn: Connection,
+    graph: pd.DataFrame,
+    start_time: str,
+    end_time: str,
+    brick_list: List[str],
+    resample_size: int,
+    timeseries_ids: Optional[np.ndarray] = None,
+    positions: Optional[np.ndarray] = None,
+) -> BucketAggregates:
+    """
+    Lets Postgres resample the timeseries data between start and end time for the given brick classes into buckets of resample_size
+    seconds, so only one row per timeseriesid and bucket is transferred instead of every reading. Pass the timeseries_ids of the brick
+    classes and the positions of the graph rows in them when they are precomputed (see GraphIndex.timeseries_positions).
+    """
+    query, parameters, timeseries_ids = _bucket_copy_query(graph, start_time, end_time, brick_list, resample_size, timeseries_ids)
+
+    buffer = bytearray()
+    with conn.cursor() as cur:
+        with cur.copy(query, parameters) as copy:
+            for chunk in copy:
+                buffer += chunk
+        conn.commit()
+
+    return decode_bucket_copy(buffer, timeseries_ids, graph, positions)
+
+
+async def fetch_bucket_aggregates_async(
+    conn: AsyncConnection,
+    graph: pd.DataFrame,
+    start_time: str,
+    end_time: str,
+    brick_list: List[str],
+    resample_size: int,
+    timeseries_ids: Optional[np.ndarray] = None,
+    positions: Optional[np.ndarray] = None,
+) -> BucketAggregates:
+    """Same as fetch_bucket_aggregates, but awaits the stream on an async connection so other rules can run while it is in flight"""
+    query, parameters, timeseries_ids = _bucket_copy_query(graph, start_time, end_time, brick_list, resample_size, timeseries_ids)
+
+    buffer = bytearray()
+    async with conn.cursor() as cur:
+        async with cur.copy(query, parameters) as copy:
+            async for chunk in copy:
+                buffer += chunk
+        await conn.commit()
+
+    return decode_bucket_copy(buffer, timeseries_ids, graph, positions)
+
+
+def load_timeseries(
+    conn: Connection,
+    graph: pd.DataFrame,
+    start_time: str,
+    end_time: str,
+    brick_list: List[str],
+) -> pd.DataFrame:
+    """
+    Creates a dataframe containing the timeseries data between given start and end time for given brick classes.
+    The brick classes should just be passed in as the ending of the URI (everything after https://brickschema.org/schema/Brick#).
+    It returns a multi-indexed dataframe where the level 0 index is component, the level 1 index is timestamp, and each column is a brick class.
+
+    Returns:
+        pd.DataFrame: A multi-indexed dataframe with the following columns:
+            - componentURI: URI of the component
+            - ts: Timestamp
+            - value: Value of the timeseries data
+    """
+    columns = fetch_timeseries_columns(conn, graph, start_time, end_time, brick_list)
+    return pivot_timeseries_columns(columns, graph)
+
+
+# the Brick namespace of the component classes that rules name by their local name, e.g. IAQ_Sensor_Equipment
+BRICK_NAMESPACE = "https://brickschema.org/schema/Brick#"
+# records read from Neo4j per page while a graph result is streamed
+GRAPH_PAGE_SIZE = 10_000
+# concurrent sessions of load_graph_data, which queries every component class on its own
+GRAPH_LOAD_WORKERS = 4
+
+# one query for every component class: the classes are matched on their exact uri, which the class_uri index on :Class(uri) serves
+# (created by extra/neo4j/apoc.conf), instead of scanning every class for a substring
+GRAPH_QUERY = """
+UNWIND $class_uris AS class_uri
+MATCH (c:Class {uri: class_uri})-[:HAS_BRICK_CLASS]-(comp:Component)
+MATCH (comp)-[:hasPoint]-(p:Point)
+MATCH (comp)-[:isDeviceOf]-(d:Device)
+MATCH (p)-[:HAS_BRICK_CLASS]-(class: Class)
+MATCH (p)-[:hasExternalReference]-(t:TimeseriesReference)
+RETURN class_uri,
+       p.uri AS point,
+       class.uri AS class,
+       t.hasTimeseriesId AS timeseriesid,
+       d.uri AS deviceURI,
+       comp.uri AS componentURI
+"""
+
+
+def brick_class_uri(component_class: str) -> str:
+    """The uri of a component class, rules name Brick classes by their local name but a full uri is used as it is"""
+    if "#" in component_class or "://" in component_class:
+        return component_class
+    return BRICK_NAMESPACE + component_class
+
+
+def stream_graph_data(driver: GraphDatabase.driver, component_classes: Iterable[str], page_size: int = GRAPH_PAGE_SIZE) -> pd.DataFrame:
+    """
+    Loads the points of every component of the given classes with one query. The result is read page_size records at a time and each
+    page is dictionary encoded into int32 code buffers right away, so the whole result never exists as records or Python rows.
+
+    Returns:
+        pd.DataFrame: An interned dataframe (see afdd.graph.intern_graph) with the columns point, class (the brick class uri),
+        timeseriesid, deviceURI and componentURI, plus the component_type (as given in component_classes) each row was loaded for
+    """
+    component_types = {brick_class_uri(component_class): component_class for component_class in component_classes}
+    encoders = {column: IdentifierEncoder() for column in ("class_uri", *GRAPH_COLUMNS)}
 
+    start = time.perf_counter()
+    with driver.session(database="neo4j", fetch_size=page_size) as session:
+        result = session.run(GRAPH_QUERY, class_uris=list(component_types))
+        while records := result.fetch(page_size):
+            for encoder, values in zip(encoders.values(), zip(*records)):
+                encoder.extend(values)
 
-def load_component_data(driver: GraphDatabase.driver, component_class: str) -> pd.DataFrame:
+    graph = pd.DataFrame({column: encoder.to_categorical() for column, encoder in encoders.items()})
+    graph["component_type"] = graph.pop("class_uri").cat.rename_categories(lambda uri: component_types[uri])
+    logger.info(f"Loaded {len(graph)} graph rows for {len(component_types)} component classes in {time.perf_counter() - start:.2f}s")
+    return graph
+
+
+def load_component_data(driver: GraphDatabase.driver, component_class: str, raise_errors: bool = False) -> pd.DataFrame:
     """
     Load the necessary sensor information for the given component class.
 
     Args:
         driver: Neo4j driver
-        component_class: The Brick class URI for the component
+        component_class: The Brick class of the component, its local name or its uri
+        raise_errors: Raise query errors instead of logging them and returning an empty dataframe
 
     Returns:
         pd.DataFrame: A dataframe with the following columns:
@@ -242,29 +868,12 @@ def load_component_data(driver: GraphDatabase.driver, component_class: str) -> p
             - deviceURI: URI of the device
             - componentURI: URI of the component
     """
-
-    query = """
-    MATCH (c:Class) WHERE c.uri CONTAINS $component_class
-    MATCH (c)-[:HAS_BRICK_CLASS]-(comp:Component)
-    MATCH (comp)-[:hasPoint]-(p:Point)
-    MATCH (comp)-[:isDeviceOf]-(d:Device)
-    MATCH (p)-[:HAS_BRICK_CLASS]-(class: Class)
-    MATCH (p)-[:hasExternalReference]-(t:TimeseriesReference)
-    RETURN p.uri AS point, 
-           class.uri AS class, 
-           t.hasTimeseriesId AS timeseriesid, 
-           d.uri AS deviceURI, 
-           comp.uri AS componentURI
-    """
     try:
-        return driver.execute_query(
-            query_=query,
-            component_class=component_class,
-            database_="neo4j",
-            result_transformer_=neo4j.Result.to_df,
-        )
+        return stream_graph_data(driver, [component_class])[GRAPH_COLUMNS]
     except Exception as e:
         logger.error(f"Error loading data for component class {component_class}: {e}")
+        if raise_errors:
+            raise
         return pd.DataFrame()
 
 
@@ -294,8 +903,9 @@ def load_graph_data(driver: GraphDatabase.driver, rules_list) -> pd.DataFrame:
 
     # Load and process data
     try:
-        # Load all component data into a single dataframe
-        dfs = [load_component_data(driver, comp_class) for comp_class in component_classes]
+        # Load all component data into a single dataframe, the classes are queried in concurrent sessions
+        with ThreadPoolExecutor(max_workers=min(len(component_classes), GRAPH_LOAD_WORKERS)) as executor:
+            dfs = list(executor.map(lambda comp_class: load_component_data(driver, comp_class), component_classes))
         graph_df = pd.concat(dfs, ignore_index=True)
 
         # Clean up data
@@ -312,3 +922,38 @@ def load_graph_data(driver: GraphDatabase.driver, rules_list) -> pd.DataFrame:
         return graph_df
     finally:
         driver.close()
+
+
+def load_graph_index(
+    driver: GraphDatabase.driver, rules_list: List[Rule], close_driver: bool = True, raise_errors: bool = False
+) -> GraphIndex:
+    """
+    Load the graph data the rules need, like load_graph_data, but keep track of the component type every row was loaded for and
+    build the GraphIndex the rules run against.
+
+    Args:
+        driver: Neo4j driver
+        rules_list: List of Rule objects
+        close_driver: Close the driver once the graph is loaded, the graph refresher keeps it open
+        raise_errors: Raise query errors instead of logging them and building an empty index, so a failed refresh can't look like a
+            graph without components
+
+    Returns:
+        GraphIndex: The graph of every component type in rules_list with a precomputed view per rule
+    """
+    component_classes = {rule.component_type for rule in rules_list}
+    logger.info(f"Loading data for components: {component_classes}")
+
+    try:
+        try:
+            graph = stream_graph_data(driver, component_classes)
+        except Exception as e:
+            logger.error(f"Error loading data for component classes {component_classes}: {e}")
+            if raise_errors:
+                raise
+            graph = pd.DataFrame(columns=[*GRAPH_COLUMNS, "component_type"])
+        graph["class"] = graph["class"].map(strip_brick_prefix)
+        return GraphIndex(graph, rules_list)
+    finally:
+        if close_driver:
+            driver.close()
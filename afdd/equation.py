@@ -0,0 +1,167 @@
+import ast
+from dataclasses import dataclass, field
+from functools import lru_cache
+from types import CodeType
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr
+except ImportError:  # numexpr is optional, the numpy evaluator is used without it
+    numexpr = None
+
+NUMEXPR_MIN_ROWS = 10000  # below this numexpr's thread start up costs more than it saves
+
+FUNCTIONS = {"abs": np.abs, "sqrt": np.sqrt, "log": np.log, "exp": np.exp}
+
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.Compare,
+    ast.BoolOp,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Eq,
+    ast.NotEq,
+    ast.And,
+    ast.Or,
+    ast.Not,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Mod,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+    ast.BitAnd,
+    ast.BitOr,
+    ast.Invert,
+)
+
+
+class EquationError(ValueError):
+    """Raised when a rule's equation can't be compiled"""
+
+
+class _ElementwiseRewriter(ast.NodeTransformer):
+    """
+    Rewrites the parts of an equation that only work on scalars in Python into their elementwise array form:
+    chained comparisons (1000 < CO2_Sensor < 1500) become & of pairwise comparisons, and/or become &/| and not becomes ~.
+    """
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        operands = [node.left, *node.comparators]
+        pairs = [ast.Compare(left=operands[i], ops=[op], comparators=[operands[i + 1]]) for i, op in enumerate(node.ops)]
+        return self._combine(pairs, ast.BitAnd())
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        return self._combine(node.values, ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr())
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+    @staticmethod
+    def _combine(values, op: ast.operator) -> ast.AST:
+        combined = values[0]
+        for value in values[1:]:
+            combined = ast.BinOp(left=combined, op=op, right=value)
+        return combined
+
+
+@dataclass(frozen=True)
+class CompiledEquation:
+    """
+    A rule equation that has been parsed and checked once and can be evaluated against any dataframe of sensor values.
+
+    Attributes:
+        source: The equation as written in the rule
+        expression: The equation rewritten to elementwise operators, as handed to numexpr
+        columns: The sensor columns the equation reads, in the order they first appear
+    """
+
+    source: str
+    expression: str
+    columns: Tuple[str, ...]
+    code: CodeType = field(repr=False, compare=False)
+
+    def evaluate(self, frame: pd.DataFrame) -> np.ndarray:
+        """
+        Evaluates the equation for every row of frame and returns a boolean array. Comparisons with missing values are False, and a
+        column that is missing from frame is treated as all missing values.
+        """
+        arrays: Dict[str, np.ndarray] = {}
+        for column in self.columns:
+            if column in frame.columns:
+                arrays[column] = frame[column].to_numpy(dtype=float, na_value=np.nan)
+            else:
+                arrays[column] = np.full(len(frame), np.nan)
+
+        if numexpr is not None and len(frame) >= NUMEXPR_MIN_ROWS:
+            result = numexpr.evaluate(self.expression, local_dict=arrays)
+        else:
+            result = eval(self.code, {"__builtins__": {}, **FUNCTIONS}, arrays)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (len(frame),))
+
+
+@lru_cache(maxsize=None)
+def _compile(equation: str) -> CompiledEquation:
+    try:
+        tree = ast.parse(equation.strip(), mode="eval")
+    except SyntaxError as e:
+        raise EquationError(f"Invalid equation {equation!r}: {e.msg}") from e
+
+    columns = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise EquationError(f"Invalid equation {equation!r}: {type(node).__name__} is not supported")
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords):
+            raise EquationError(f"Invalid equation {equation!r}: only {sorted(FUNCTIONS)} can be called")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise EquationError(f"Invalid equation {equation!r}: {node.value!r} is not a number")
+        if isinstance(node, ast.Name) and node.id not in FUNCTIONS and node.id not in columns:
+            columns.append(node.id)
+    if not columns:
+        raise EquationError(f"Invalid equation {equation!r}: it doesn't read any sensor")
+
+    tree = ast.fix_missing_locations(_ElementwiseRewriter().visit(tree))
+    return CompiledEquation(
+        source=equation,
+        expression=ast.unparse(tree),
+        columns=tuple(columns),
+        code=compile(tree, filename="<equation>", mode="eval"),
+    )
+
+
+def compile_equation(equation: str, sensor_types: Optional[Iterable[str]] = None) -> CompiledEquation:
+    """
+    Compiles a rule equation such as "1000 < CO2_Sensor < 1500" into a reusable evaluator. Equations are cached, so compiling the same
+    equation again is free.
+
+    If sensor_types is given, every name in the equation has to be one of the rule's sensor types.
+
+    Raises:
+        EquationError: If the equation isn't valid or reads a sensor that isn't in sensor_types
+    """
+    compiled = _compile(equation)
+    if sensor_types is not None:
+        unknown = [column for column in compiled.columns if column not in set(sensor_types)]
+        if unknown:
+            raise EquationError(f"Equation {equation!r} reads {unknown}, which are not in the rule's sensor_types {list(sensor_types)}")
+    return compiled
@@ -0,0 +1,98 @@
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# the graph columns that hold identifiers, every distinct value is stored once after intern_graph
+IDENTIFIER_COLUMNS = ("point", "class", "timeseriesid", "deviceURI", "componentURI")
+
+
+def intern_graph(graph: pd.DataFrame) -> pd.DataFrame:
+    """
+    Dictionary encodes the identifiers of a graph frame once when it is loaded: timeseriesids are stripped and every identifier column
+    becomes a categorical, so each URI is stored once and rows only hold int32 codes. Masks, joins and groupbys on the interned frame
+    compare codes instead of strings. The frame passed in is not modified.
+    """
+    graph = graph.drop_duplicates().reset_index(drop=True)
+    if "timeseriesid" in graph.columns:
+        graph["timeseriesid"] = _strip_timeseries_ids(graph["timeseriesid"])
+    for column in IDENTIFIER_COLUMNS:
+        if column in graph.columns:
+            graph[column] = graph[column].astype("category")
+    return graph
+
+
+def _strip_timeseries_ids(column: pd.Series) -> pd.Series:
+    """Strips the timeseriesids, only the distinct ones when the column is already interned (e.g. read back from the graph cache)"""
+    if isinstance(column.dtype, pd.CategoricalDtype) and not column.isna().any():
+        stripped = column.cat.categories.astype(str).str.strip()
+        if stripped.is_unique and stripped.is_monotonic_increasing:
+            return column.cat.rename_categories(stripped)
+    return column.astype(str).str.strip()
+
+
+def identifier_codes(column: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    """
+    The codes of an identifier column and the sorted distinct values they point into, -1 for missing values. The codes of an interned
+    column are used as they are, any other column is factorized.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype) and column.cat.categories.is_monotonic_increasing:
+        return column.cat.codes.to_numpy(), pd.Index(column.cat.categories.to_numpy(dtype=object))
+    codes, categories = pd.factorize(column, sort=True)
+    return codes, pd.Index(np.asarray(categories, dtype=object))
+
+
+def _timeseries_id_codes(graph: pd.DataFrame) -> Tuple[np.ndarray, pd.Index]:
+    """
+    The codes of the graph rows' stripped timeseriesids and the ids they point into. intern_graph already stripped the categories of an
+    interned column, so they are used as they are; a plain column is factorized and its distinct ids are stripped.
+    """
+    column = graph["timeseriesid"]
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), pd.Index(column.cat.categories.to_numpy(dtype=object))
+    codes, categories = identifier_codes(column)
+    return codes, pd.Index(categories.astype(str).str.strip().to_numpy(dtype=object))
+
+
+def graph_timeseries_ids(graph: pd.DataFrame) -> np.ndarray:
+    """The stripped timeseriesid of every graph row"""
+    codes, ids = _timeseries_id_codes(graph)
+    return np.append(ids.to_numpy(), None)[codes]
+
+
+def timeseries_positions(graph: pd.DataFrame, ids: np.ndarray) -> np.ndarray:
+    """The position of every graph row's stripped timeseriesid in the unique ids, or -1 if it isn't one of them"""
+    codes, categories = _timeseries_id_codes(graph)
+    return np.append(pd.Index(ids).get_indexer(categories), -1)[codes]
+
+
+def brick_timeseries_ids(graph: pd.DataFrame, brick_list) -> np.ndarray:
+    """The unique stripped timeseriesids of the graph rows whose brick class is in brick_list, in the order of their first row"""
+    codes, ids = _timeseries_id_codes(graph)
+    codes = codes[graph["class"].isin(brick_list).to_numpy()]
+    return pd.unique(ids.to_numpy()[pd.unique(codes[codes >= 0])])
+
+
+class IdentifierEncoder:
+    """
+    Dictionary encodes the values of one identifier column while a result is read page by page, so every distinct URI is kept once and
+    each row only adds an int32 code. to_categorical gives the interned column with sorted categories, like intern_graph.
+    """
+
+    def __init__(self):
+        self._codes: Dict[object, int] = {}
+        self._pages: List[np.ndarray] = []
+
+    def extend(self, values: Sequence) -> None:
+        codes = self._codes
+        self._pages.append(
+            np.fromiter((-1 if value is None else codes.setdefault(value, len(codes)) for value in values), dtype=np.int32, count=len(values))
+        )
+
+    def to_categorical(self) -> pd.Categorical:
+        codes = np.concatenate(self._pages) if self._pages else np.empty(0, dtype=np.int32)
+        categories = np.array([str(value) for value in self._codes], dtype=object)
+        order = np.argsort(categories, kind="stable")
+        sorted_codes = np.empty(len(order), dtype=np.int32)
+        sorted_codes[order] = np.arange(len(order), dtype=np.int32)
+        return pd.Categorical.from_codes(np.where(codes >= 0, sorted_codes[np.maximum(codes, 0)], -1), categories=categories[order])
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from afdd.logger import logger
+
+# key of the cache's own entry in the Parquet schema metadata
+METADATA_KEY = b"afdd_graph_cache"
+
+
+@dataclass(frozen=True)
+class CachedGraph:
+    """
+    A graph read back from the on-disk cache.
+
+    Attributes:
+        graph: The interned graph with the component_type column, as GraphIndex.graph holds it
+        loaded_at: When the graph was last loaded from (or checked against) Neo4j
+    """
+
+    graph: pd.DataFrame
+    loaded_at: datetime
+
+    @property
+    def age(self) -> float:
+        """Seconds since the graph was last loaded from Neo4j"""
+        return (datetime.now(timezone.utc) - self.loaded_at).total_seconds()
+
+
+def graph_cache_path(directory: str, component_types: Iterable[str]) -> str:
+    """The cache file of a set of component types, rule sets with the same component types share it"""
+    key = hashlib.sha256("\n".join(sorted(set(component_types))).encode()).hexdigest()[:16]
+    return os.path.join(directory, f"graph_{key}.parquet")
+
+
+def write_graph_cache(directory: str, graph: pd.DataFrame, component_types: Iterable[str], loaded_at: Optional[datetime] = None) -> str:
+    """
+    Writes the graph to its cache file as Parquet, stamped with the component types and when it was loaded. The interned columns are
+    stored dictionary encoded, so every URI is written once. The file is written next to the old one and renamed over it, a reader never
+    sees half a file.
+
+    Returns:
+        The path of the cache file
+    """
+    component_types = sorted(set(component_types))
+    loaded_at = loaded_at or datetime.now(timezone.utc)
+    table = pa.Table.from_pandas(graph, preserve_index=False)
+    stamp = json.dumps({"component_types": component_types, "loaded_at": loaded_at.isoformat()}).encode()
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), METADATA_KEY: stamp})
+
+    os.makedirs(directory, exist_ok=True)
+    path = graph_cache_path(directory, component_types)
+    pq.write_table(table, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    logger.info(f"Wrote {len(graph)} graph rows to {path}")
+    return path
+
+
+def read_graph_cache(directory: str, component_types: Iterable[str]) -> Optional[CachedGraph]:
+    """The cached graph of the component types, or None if there is none or it can't be read (the graph is then loaded from Neo4j)"""
+    component_types = sorted(set(component_types))
+    path = graph_cache_path(directory, component_types)
+    if not os.path.exists(path):
+        return None
+    try:
+        table = pq.read_table(path)
+        stamp = json.loads(table.schema.metadata[METADATA_KEY])
+        if stamp["component_types"] != component_types:
+            logger.warning(f"Ignoring graph cache {path}, it holds the component types {stamp['component_types']}")
+            return None
+        cached = CachedGraph(graph=table.to_pandas(), loaded_at=datetime.fromisoformat(stamp["loaded_at"]))
+    except (OSError, KeyError, ValueError, pa.ArrowException) as e:
+        logger.warning(f"Ignoring unreadable graph cache {path}: {e}")
+        return None
+    logger.info(f"Read {len(cached.graph)} graph rows from {path}, loaded from Neo4j {cached.age:.0f}s ago")
+    return cached
@@ -0,0 +1,164 @@
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Tuple
+
+import numpy as np
+import pandas as pd
+
+from afdd.graph import intern_graph
+from afdd.logger import logger
+from afdd.models import Rule
+from afdd.planner import rule_columns
+from afdd.utils import component_metadata, strip_brick_prefix
+
+GRAPH_COLUMNS = ["point", "class", "timeseriesid", "deviceURI", "componentURI"]
+
+
+@dataclass(frozen=True)
+class RuleView:
+    """
+    The part of the graph a rule works with, prepared once when the graph is loaded.
+
+    Attributes:
+        rule_id: The rule the view belongs to
+        graph: Interned graph rows of the rule's component type whose brick class the rule's equation reads, all the rule fetches
+        metadata: The JSON encoded points and metadata of every component in graph, indexed by componentURI
+    """
+
+    rule_id: int
+    graph: pd.DataFrame
+    metadata: pd.DataFrame
+
+
+@dataclass(frozen=True)
+class GraphDiff:
+    """What changed between two versions of a graph, see diff_graphs"""
+
+    added_components: Tuple[str, ...]
+    removed_components: Tuple[str, ...]
+    added_points: Tuple[str, ...]
+    removed_points: Tuple[str, ...]
+    changed_rows: int
+
+    @property
+    def empty(self) -> bool:
+        return self.changed_rows == 0
+
+
+def _uris(column: pd.Series) -> pd.Index:
+    return pd.Index(column.dropna().unique().astype(object))
+
+
+def diff_graphs(old: pd.DataFrame, new: pd.DataFrame) -> GraphDiff:
+    """
+    Compares two graph frames (plain or interned) row by row. changed_rows counts the rows that are only in one of them, so a point
+    that moved to another device or got a new timeseriesid is a change even though no component or point was added or removed.
+    """
+    columns = [column for column in new.columns if column in old.columns]
+    old_rows = pd.MultiIndex.from_frame(old[columns].astype(object))
+    new_rows = pd.MultiIndex.from_frame(new[columns].astype(object))
+    old_components, new_components = _uris(old["componentURI"]), _uris(new["componentURI"])
+    old_points, new_points = _uris(old["point"]), _uris(new["point"])
+    return GraphDiff(
+        added_components=tuple(new_components.difference(old_components)),
+        removed_components=tuple(old_components.difference(new_components)),
+        added_points=tuple(new_points.difference(old_points)),
+        removed_points=tuple(old_points.difference(new_points)),
+        changed_rows=len(new_rows.difference(old_rows)) + len(old_rows.difference(new_rows)),
+    )
+
+
+class GraphIndex:
+    """
+    Read only lookups over the graph of every component type the rules use. The interned graph is split by (component type, brick
+    classes) and each rule gets a RuleView, so a cycle fetches only its own components' sensors and writes anomalies without scanning
+    the graph. Build a new index to pick up graph changes instead of modifying one.
+    """
+
+    def __init__(self, graph: pd.DataFrame, rules: Iterable[Rule]):
+        """graph holds the columns of load_graph_data plus the component_type the rows were loaded for"""
+        self.graph = intern_graph(graph)
+        self.graph["component_type"] = self.graph["component_type"].astype("category")
+        self._scopes: Dict[Tuple[str, Tuple[str, ...]], pd.DataFrame] = {}
+        self._views: Dict[int, RuleView] = {}
+        for rule in rules:
+            scope = self.scope(rule.component_type, rule_columns(rule))
+            # the points of an anomaly cover all of the rule's sensor_types, not only the ones its equation reads
+            of_type = self.graph.loc[(self.graph["component_type"] == rule.component_type).to_numpy()]
+            components = scope["componentURI"].cat.categories.to_numpy(dtype=object)
+            self._views[rule.rule_id] = RuleView(
+                rule_id=rule.rule_id,
+                graph=scope,
+                metadata=component_metadata(graph=of_type, components=components, sensor_types=rule.sensor_types),
+            )
+        logger.info(f"graph index: {len(self.graph)} points, {len(self._scopes)} scopes for {len(self._views)} rules")
+
+    @classmethod
+    def from_component_graphs(cls, graphs: Mapping[str, pd.DataFrame], rules: Iterable[Rule]) -> "GraphIndex":
+        """Builds the index from the load_component_data result of every component type, keyed by component type"""
+        frames = [
+            graph[GRAPH_COLUMNS].assign(component_type=component_type)
+            for component_type, graph in graphs.items()
+            if set(GRAPH_COLUMNS).issubset(graph.columns)
+        ]
+        graph = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[*GRAPH_COLUMNS, "component_type"])
+        graph["class"] = graph["class"].map(strip_brick_prefix)
+        return cls(graph, rules)
+
+    def scope(self, component_type: str, sensor_types: Iterable[str]) -> pd.DataFrame:
+        """
+        The interned graph rows of a component type whose brick class is one of sensor_types, which is what a fetch group loads. Scopes
+        are built once and shared by every rule and group that asks for the same one.
+        """
+        key = (component_type, tuple(sorted(set(sensor_types))))
+        if key not in self._scopes:
+            rows = (self.graph["component_type"] == component_type) & self.graph["class"].isin(key[1])
+            scope = self.graph.loc[rows.to_numpy()].reset_index(drop=True)
+            interned = [column for column in scope.columns if isinstance(scope[column].dtype, pd.CategoricalDtype)]
+            self._scopes[key] = scope.assign(**{column: scope[column].cat.remove_unused_categories() for column in interned})
+        return self._scopes[key]
+
+    def timeseries_ids(self, component_type: str, sensor_types: Iterable[str]) -> np.ndarray:
+        """
+        The unique stripped timeseriesids of a scope, the ids a fetch for those sensors of that component type sends to Postgres. The
+        scope only keeps the categories its rows use, so these are its interned categories.
+        """
+        return self.scope(component_type, sensor_types)["timeseriesid"].cat.categories.to_numpy(dtype=object)
+
+    def timeseries_positions(self, component_type: str, sensor_types: Iterable[str]) -> np.ndarray:
+        """The position of every row of a scope in its timeseries_ids, which are the codes of its interned timeseriesid column"""
+        return self.scope(component_type, sensor_types)["timeseriesid"].cat.codes.to_numpy()
+
+    def view(self, rule: Rule) -> RuleView:
+        return self._views[rule.rule_id]
+
+    @property
+    def rule_ids(self) -> List[int]:
+        return list(self._views)
+
+
+def component_shards(components: pd.Series, shards: int) -> np.ndarray:
+    """The component shard of every entry of an interned componentURI column: the crc32 of the URI modulo shards, the same in every process"""
+    categories = components.cat.categories
+    category_shards = np.array([zlib.crc32(str(uri).encode()) % shards for uri in categories], dtype=np.int64)
+    return np.append(category_shards, -1)[components.cat.codes.to_numpy()]
+
+
+def shard_index(index: GraphIndex, rules: Iterable[Rule], shard: int, shards: int) -> GraphIndex:
+    """A GraphIndex over the components of one shard of index's graph, see component_shards"""
+    return GraphIndex(index.graph.loc[component_shards(index.graph["componentURI"], shards) == shard], rules)
+
+
+class GraphStore:
+    """
+    Holds the GraphIndex the rules currently run against. A refresh builds a whole new index and swaps it in with one assignment, so a
+    cycle that took store.index at its start keeps using one consistent version of the graph until it ends.
+    """
+
+    def __init__(self, index: GraphIndex):
+        self.index = index
+        self.version = 0
+
+    def swap(self, index: GraphIndex) -> None:
+        self.index = index
+        self.version += 1
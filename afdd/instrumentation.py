@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, write_to_textfile
+
+LAG_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 150.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+STAGE_SECONDS = Histogram(
+    "afdd_stage_duration_seconds",
+    "Time spent in each stage of a rule cycle (query, pivot, resample, rolling, eval, assembly, insert, cycle)",
+    ("stage", "rules"),
+    buckets=STAGE_BUCKETS,
+)
+ROWS_FETCHED = Counter("afdd_rows_fetched_total", "Timeseries rows fetched from Postgres", ("rules",))
+ANOMALIES_WRITTEN = Counter("afdd_anomalies_written_total", "Anomalies written to Postgres", ("rule",))
+CYCLE_ERRORS = Counter("afdd_cycle_errors_total", "Rule cycles that failed", ("rules",))
+MISSED_CYCLES = Counter("afdd_missed_cycles_total", "Scheduled cycles that were coalesced into a catch-up cycle after an overrun", ("rules",))
+DETECTION_LAG = Histogram(
+    "afdd_detection_lag_seconds",
+    "Time from the newest reading a cycle loaded to the moment its anomalies were written",
+    ("rules",),
+    buckets=LAG_BUCKETS,
+)
+LAST_DETECTION_LAG = Gauge("afdd_last_detection_lag_seconds", "Detection lag of the last cycle", ("rules",))
+GRAPH_REFRESHES = Counter("afdd_graph_refreshes_total", "Graph refreshes from Neo4j by result (unchanged, swapped, failed)", ("result",))
+LEASES_HELD = Gauge("afdd_leases_held", "(fetch group, component shard) units this worker holds the lease of")
+EVENT_LOOP_LAG = Histogram("afdd_event_loop_lag_seconds", "How late the event loop woke up a sleeping task", buckets=LOOP_LAG_BUCKETS)
+
+
+def stage_timer(stage: str, rules):
+    """Times a stage of a rule cycle. rules is a rule id or a list of rule ids (for stages shared by a fetch group)."""
+    return STAGE_SECONDS.labels(stage=stage, rules=rules_label(rules)).time()
+
+
+def rules_label(rules) -> str:
+    if isinstance(rules, (list, tuple)):
+        return ",".join(str(rule_id) for rule_id in rules)
+    return str(rules)
+
+
+async def monitor_event_loop(interval: float = 1.0) -> None:
+    """Measures how late the event loop wakes up from a sleep of `interval` seconds, which is how long rules wait behind blocking work"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+async def write_textfile_periodically(path: str, interval: float = 15.0) -> None:
+    """Writes the metrics to path for the node_exporter textfile collector every `interval` seconds, the file is replaced atomically"""
+    while True:
+        await asyncio.to_thread(write_to_textfile, path, REGISTRY)
+        await asyncio.sleep(interval)
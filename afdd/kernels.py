@@ -0,0 +1,77 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# quantile sketches count values in logarithmically sized bins (the DDSketch algorithm), every quantile they return is within
+# RELATIVE_ACCURACY of the exact quantile of the values counted
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+# the bin of a value v is sign(v) * (_KEY_OFFSET + ceil(log_gamma(|v|))), larger than the key of any float so bins sort like values
+_KEY_OFFSET = 1 << 16
+
+
+def sketch_bins(values: np.ndarray) -> np.ndarray:
+    """
+    The quantile sketch bin of every value, 0 for zeros. Bins are integers in the order of the values they hold, so a sketch is just
+    the number of values in every bin: two sketches are merged by adding up their counts, and the memory a sketch uses only depends on
+    the range of its values and not on how many there are.
+    """
+    values = np.asarray(values, dtype=float)
+    bins = np.zeros(len(values), dtype=np.int64)
+    nonzero = values != 0
+    keys = np.ceil(np.log(np.abs(values[nonzero])) / _LOG_GAMMA).astype(np.int64)
+    bins[nonzero] = np.sign(values[nonzero]).astype(np.int64) * (keys + _KEY_OFFSET)
+    return bins
+
+
+def bin_values(bins: np.ndarray) -> np.ndarray:
+    """The value a quantile sketch bin stands for, within RELATIVE_ACCURACY of every value in it"""
+    bins = np.asarray(bins, dtype=np.int64)
+    magnitudes = 2 * GAMMA ** (np.abs(bins) - _KEY_OFFSET).astype(float) / (GAMMA + 1)
+    return np.where(bins == 0, 0.0, np.sign(bins) * magnitudes)
+
+
+def sliding_quantiles(counts: pd.DataFrame, window: int, q: float) -> pd.DataFrame:
+    """
+    The q quantile of the values of the last `window` buckets of every column at every bucket. counts holds the quantile sketches of
+    the buckets, the number of values of every column in every bin, indexed by (componentURI, ts, bin) and sorted. Every bucket needs at
+    least one row (an empty bucket has only zero counts), the buckets of each component have to be consecutive like the output of a
+    groupby resample. Windows without any values are NaN.
+
+    Every bin is counted in each window it falls into, and the quantile of every window is looked up in the cumulative counts of all
+    windows' bins at once, so no sketch is merged or walked bucket by bucket.
+    """
+    index = counts.index
+    columns = counts.shape[1]
+    # the position of every row's bucket, rows of the same bucket are next to each other
+    new_bucket = np.ones(len(index), dtype=bool)
+    new_bucket[1:] = (np.diff(index.codes[0]) != 0) | (np.diff(index.codes[1]) != 0)
+    bucket = np.cumsum(new_bucket) - 1
+    firsts = np.flatnonzero(new_bucket)
+    # the end of every bucket's component, a window never reaches into the next component
+    components = index.codes[0][firsts]
+    boundaries = np.append(np.flatnonzero(np.diff(components)) + 1, len(firsts))
+    component_stops = np.repeat(boundaries, np.diff(boundaries, prepend=0))
+
+    rows, column = np.nonzero(counts.to_numpy())
+    count = counts.to_numpy()[rows, column].astype(np.int64)
+    bins = index.get_level_values(2).to_numpy(dtype=np.int64)[rows]
+    targets = bucket[rows][:, None] + np.arange(window)
+    in_component = (targets < component_stops[bucket[rows]][:, None]).ravel()
+    target = (targets * columns + column[:, None]).ravel()[in_component]
+    bins = bins.repeat(window)[in_component]
+    count = count.repeat(window)[in_component]
+
+    out = np.full(len(firsts) * columns, np.nan)
+    if len(target):
+        # sorted by window and then by bin, i.e. by value
+        order = np.argsort(target * (4 * _KEY_OFFSET) + (bins + 2 * _KEY_OFFSET), kind="stable")
+        target, bins, cumulative = target[order], bins[order], np.append(0, np.cumsum(count[order]))
+        windows, starts = np.unique(target, return_index=True)
+        before = cumulative[starts]
+        totals = cumulative[np.append(starts[1:], len(target))] - before
+        # the first bin of every window whose cumulative count passes the rank of the quantile
+        out[windows] = bin_values(bins[np.searchsorted(cumulative, before + q * (totals - 1), side="right") - 1])
+    return pd.DataFrame(out.reshape(len(firsts), columns), index=index.droplevel(2)[firsts], columns=counts.columns)
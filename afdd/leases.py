@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from afdd.instrumentation import LEASES_HELD, rules_label
+from afdd.logger import logger
+from afdd.planner import FetchGroup
+
+DEFAULT_LEASE_SECONDS = 60
+# how many times a lease is renewed before it would expire
+RENEWALS_PER_LEASE = 3
+
+HEARTBEAT = """
+  INSERT INTO workers (worker, heartbeat) VALUES (%s, now())
+  ON CONFLICT (worker) DO UPDATE SET heartbeat = EXCLUDED.heartbeat
+"""
+LIVE_WORKERS = "SELECT worker FROM workers WHERE heartbeat > now() - make_interval(secs => %s) ORDER BY worker"
+# takes the units that are free, expired or already ours, and renews the ones that are ours; the rows are locked in the same order by
+# every worker, so two workers racing for a unit can't deadlock
+ACQUIRE_LEASES = """
+  INSERT INTO leases (rules, shard, worker, expires_at)
+  SELECT unit.rules, unit.shard, %(worker)s, now() + make_interval(secs => %(seconds)s)
+  FROM unnest(%(rules)s::text[], %(shards)s::int[]) AS unit(rules, shard)
+  ORDER BY unit.rules, unit.shard
+  ON CONFLICT (rules, shard) DO UPDATE SET worker = EXCLUDED.worker, expires_at = EXCLUDED.expires_at
+  WHERE leases.worker = EXCLUDED.worker OR leases.expires_at < now()
+  RETURNING rules, shard, covered_until
+"""
+RELEASE_LEASES = """
+  UPDATE leases SET expires_at = now()
+  FROM unnest(%(rules)s::text[], %(shards)s::int[]) AS unit(rules, shard)
+  WHERE leases.rules = unit.rules AND leases.shard = unit.shard AND leases.worker = %(worker)s
+"""
+# only the holder can record progress, a worker that lost its lease finds out here
+COVER_LEASE = """
+  UPDATE leases SET covered_until = greatest(covered_until, %s)
+  WHERE rules = %s AND shard = %s AND worker = %s
+  RETURNING covered_until
+"""
+
+
+@dataclass(frozen=True)
+class LeaseUnit:
+    """The share of work a lease covers: the rules of one fetch group, for the components of one shard"""
+
+    rules: str
+    shard: int
+
+    @classmethod
+    def of(cls, group: FetchGroup, shard: int) -> "LeaseUnit":
+        # sorted, so every worker names the unit the same no matter in which order it loaded the rules
+        return cls(rules=rules_label(sorted(group.rule_ids)), shard=shard)
+
+
+@dataclass
+class Lease:
+    """
+    A unit this worker holds.
+
+    Attributes:
+        covered_until: End of the last cycle any worker finished for the unit, None if it never ran
+        valid_until: time.monotonic() at which the lease may have expired, unless it is renewed before
+    """
+
+    covered_until: Optional[datetime]
+    valid_until: float
+
+
+def rendezvous_owner(unit: LeaseUnit, workers: Iterable[str]) -> Optional[str]:
+    """
+    The worker a unit belongs to: the one with the highest hash of (worker, unit). Every worker computes the same owners from the same
+    list of workers, and a worker joining or leaving only moves the units it gains or loses.
+    """
+
+    def weight(worker: str) -> int:
+        return int.from_bytes(hashlib.sha1(f"{worker}|{unit.rules}|{unit.shard}".encode()).digest()[:8], "big")
+
+    return max(workers, key=weight, default=None)
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class LeaseManager:
+    """
+    Shares the (fetch group, component shard) units between afdd workers through the workers and leases tables.
+
+    Every lease_seconds / RENEWALS_PER_LEASE seconds a worker records its heartbeat, works out which units are its own among the
+    workers with a recent heartbeat (see rendezvous_owner), takes those that are free or expired, renews the ones it holds and releases
+    the ones that now belong to another worker. A worker that joins gets its units once their holders released them; the units of a
+    worker that died are taken over once its leases expired.
+
+    A unit only runs a cycle while its lease is held (begin/finish), and a lease is never released while its unit is in a cycle. Each
+    finished cycle records how far the unit was analyzed (cover), so a worker that takes a unit over continues exactly where the last
+    holder stopped, and skips a cycle the last holder already ran.
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConnectionPool,
+        units: List[LeaseUnit],
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        worker: Optional[str] = None,
+    ):
+        self.pool = pool
+        self.units = units
+        self.lease_seconds = lease_seconds
+        self.worker = worker or worker_name()
+        self.held: Dict[LeaseUnit, Lease] = {}
+        self.running: Set[LeaseUnit] = set()
+
+    def holds(self, unit: LeaseUnit) -> bool:
+        lease = self.held.get(unit)
+        return lease is not None and lease.valid_until > time.monotonic()
+
+    def covered_until(self, unit: LeaseUnit) -> Optional[datetime]:
+        return self.held[unit].covered_until
+
+    def begin(self, unit: LeaseUnit) -> bool:
+        """Marks a unit as in a cycle if its lease is held, so it isn't released until finish"""
+        if not self.holds(unit):
+            return False
+        self.running.add(unit)
+        return True
+
+    def finish(self, unit: LeaseUnit) -> None:
+        self.running.discard(unit)
+
+    async def cover(self, unit: LeaseUnit, end_time: datetime) -> bool:
+        """Records that the unit was analyzed up to end_time, returns False if the lease was lost to another worker meanwhile"""
+        async with self.pool.connection() as conn:
+            row = await (await conn.execute(COVER_LEASE, (end_time, unit.rules, unit.shard, self.worker))).fetchone()
+            await conn.commit()
+        if row is None:
+            logger.warning(f"Worker {self.worker} lost the lease of rules {unit.rules} shard {unit.shard} during its cycle")
+            self.held.pop(unit, None)
+            return False
+        if unit in self.held:
+            self.held[unit].covered_until = row[0]
+        return True
+
+    async def rebalance(self) -> None:
+        """One round of heartbeat, acquiring, renewing and releasing"""
+        started = time.monotonic()
+        async with self.pool.connection() as conn:
+            await conn.execute(HEARTBEAT, (self.worker,))
+            workers = [row[0] for row in await (await conn.execute(LIVE_WORKERS, (self.lease_seconds,))).fetchall()]
+            await conn.commit()
+            own = {unit for unit in self.units if rendezvous_owner(unit, workers) == self.worker}
+
+            # dropped before the release is sent, so no cycle starts on them meanwhile
+            release = [unit for unit in self.held if unit not in own and unit not in self.running]
+            for unit in release:
+                del self.held[unit]
+            if release:
+                await conn.execute(RELEASE_LEASES, self._parameters(release))
+                logger.info(f"Worker {self.worker} released {[(unit.rules, unit.shard) for unit in release]}")
+
+            wanted = sorted(own | set(self.held), key=lambda unit: (unit.rules, unit.shard))
+            acquired = await (await conn.execute(ACQUIRE_LEASES, self._parameters(wanted))).fetchall() if wanted else []
+            await conn.commit()
+
+        valid_until = started + self.lease_seconds
+        renewed = {LeaseUnit(rules=rules, shard=shard): covered_until for rules, shard, covered_until in acquired}
+        for unit in [unit for unit in self.held if unit not in renewed]:
+            logger.warning(f"Worker {self.worker} lost the lease of rules {unit.rules} shard {unit.shard}")
+            del self.held[unit]
+        new = [unit for unit in renewed if unit not in self.held]
+        for unit, covered_until in renewed.items():
+            if unit in self.held:
+                self.held[unit].valid_until = valid_until
+            else:
+                self.held[unit] = Lease(covered_until=covered_until, valid_until=valid_until)
+        if new:
+            logger.info(f"Worker {self.worker} acquired {[(unit.rules, unit.shard) for unit in new]}")
+        LEASES_HELD.set(len(self.held))
+
+    async def release_all(self) -> None:
+        """Gives up every lease and the heartbeat, so the other workers take the units over right away"""
+        units = list(self.held)
+        self.held.clear()
+        async with self.pool.connection() as conn:
+            if units:
+                await conn.execute(RELEASE_LEASES, self._parameters(units))
+            await conn.execute("DELETE FROM workers WHERE worker = %s", (self.worker,))
+            await conn.commit()
+
+    async def run(self) -> None:
+        """Rebalances until cancelled, then releases the leases"""
+        logger.info(f"Worker {self.worker} sharing {len(self.units)} units")
+        try:
+            while True:
+                try:
+                    await self.rebalance()
+                except (psycopg.OperationalError, PoolTimeout) as e:
+                    # the leases run out on their own if Postgres stays unreachable, holds() stops the cycles once they did
+                    logger.error(f"Database unavailable while renewing the leases of worker {self.worker}: {e}")
+                await asyncio.sleep(self.lease_seconds / RENEWALS_PER_LEASE)
+        finally:
+            try:
+                await asyncio.shield(self.release_all())
+            except (psycopg.OperationalError, PoolTimeout) as e:
+                logger.error(f"Could not release the leases of worker {self.worker}, they expire in {self.lease_seconds}s: {e}")
+
+    def _parameters(self, units: List[LeaseUnit]) -> dict:
+        return {
+            "worker": self.worker,
+            "seconds": self.lease_seconds,
+            "rules": [unit.rules for unit in units],
+            "shards": [unit.shard for unit in units],
+        }
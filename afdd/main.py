@@ -1,7 +1,8 @@
 import pandas as pd
 import datetime
 import psycopg
-from psycopg import Connection
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from prometheus_client import start_http_server
 import os
 import asyncio
 import logging
@@ -10,132 +11,508 @@ from urllib.parse import urlparse
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
 from datetime import timedelta
-from typing import List
+from typing import Callable, Dict, List, Optional
 
 from afdd.logger import logger
-from afdd.models import Rule
-from afdd.utils import round_time, create_anomaly
+from afdd.instrumentation import (
+    ANOMALIES_WRITTEN,
+    CYCLE_ERRORS,
+    DETECTION_LAG,
+    GRAPH_REFRESHES,
+    LAST_DETECTION_LAG,
+    ROWS_FETCHED,
+    monitor_event_loop,
+    rules_label,
+    stage_timer,
+    write_textfile_periodically,
+)
+from afdd.graph_cache import read_graph_cache, write_graph_cache
+from afdd.graph_index import GraphIndex, GraphStore, RuleView, diff_graphs, shard_index
+from afdd.leases import LeaseManager, LeaseUnit
+from afdd.migrations import ensure_timeseries_partitions_async, migrate
+from afdd.models import AnomalyBatch, Rule
+from afdd.open_anomalies import OpenAnomalies
+from afdd.snapshots import SnapshotConfig, configure as configure_snapshots, snapshots_enabled, write_snapshot
+from afdd.utils import anomaly_batch, hit_intervals
+from afdd.planner import FetchGroup, plan_fetches, rule_resample_size
+from afdd.scheduler import DEFAULT_BACKLOG_BATCH_SECONDS, DEFAULT_JITTER_SECONDS, Scheduler, Tick, backlog_ticks, group_period
+from afdd.windows import IncrementalWindow, batch_window, database_partials, resamples_in_database
+from afdd.sql_rules import evaluates_in_database, find_anomalies_in_database_async
 from afdd.db import (
-    load_timeseries,
-    append_anomalies,
+    create_pool,
+    fetch_bucket_aggregates_async,
+    fetch_timeseries_columns_async,
+    pivot_timeseries_columns,
+    fetch_open_anomalies_async,
+    write_open_anomalies_async,
+    fetch_watermark_async,
+    write_watermarks_async,
     load_rules,
     get_rules,
-    load_graph_data,
+    load_graph_index,
 )
 
 
 def analyze_data(graph: pd.DataFrame, timeseries_data: pd.DataFrame, rule: Rule, start_time: str) -> List[tuple]:
-    duration = rule.condition.duration
-    resample_size = int(duration * 0.25)  # increment size of the rolling average (how far it's going to roll each time)
-    rounded_start = round_time(time=start_time, resample_size=resample_size)  # start time rounded to the nearest normalized time
-    throwaway_at_start = rounded_start + timedelta(seconds=int(duration))  # gets rid of the first few values of our table that aren't full windows
-    logger.info(f"throwaway time: {throwaway_at_start}")
-    # normalizes timestamps to intervals of resample size and compute the rolling mean
-    resampled = timeseries_data.groupby(level=0).resample(f"{resample_size}s", level=1).mean()
-    logger.info(f"resampled data:\n {resampled}")
-
-    rolling_mean = resampled.groupby(level=0).rolling(window=5, min_periods=1).mean()
-    rolling_mean = rolling_mean.droplevel(level=0)
-    logger.info(f"df after rolling:\n{rolling_mean}")
-
-    # filter out rows where timestamp is before cutoff_time
-    rolling_mean = rolling_mean.loc[rolling_mean.index.get_level_values("ts") >= throwaway_at_start]
-    logger.info(f"df after throwing away:\n{rolling_mean}")
-
+    """Computes the rolling means of a rule from scratch for data loaded from start_time onwards and returns the anomalies found"""
+    rolling_mean = batch_window(timeseries_data=timeseries_data, rule=rule, start_time=start_time)
+    return find_anomalies(graph=graph, rolling_mean=rolling_mean, rule=rule).to_tuples()
+
+
+def find_anomalies(
+    graph: pd.DataFrame, rolling_mean: pd.DataFrame, rule: Rule, metadata: Optional[pd.DataFrame] = None
+) -> AnomalyBatch:
+    """
+    Evaluates the rule's equation against the rolling means and merges consecutive hits of each component into anomalies. metadata is
+    the rule's precomputed RuleView.metadata, without it the points and metadata of the anomalies are built from graph.
+    """
     # Evaluate the equation
-    rolling_mean["results"] = rolling_mean.eval(rule.condition.equation)
-    logger.info(f"new_df with results column:\n{rolling_mean}")
-
-    # Put Trues in anomaly_df
-    anomaly_df = rolling_mean.loc[rolling_mean["results"] == True]
-    anomaly_df = anomaly_df.drop(columns=["results"])
-
-    anomaly_df.reset_index(level="ts", inplace=True)  # to make the index 'ts' a column
-    anomaly_df.rename(columns={"ts": "end_time"}, inplace=True)
-
-    anomaly_df["start_time"] = anomaly_df["end_time"] - timedelta(seconds=duration)
-    anomaly_df["start_time"] = pd.to_datetime(anomaly_df["start_time"])
-    logger.info(f"anomaly_df after adding start_time:\n {anomaly_df}")
-
-    anomaly_list = []
-    for component, new_df in anomaly_df.groupby(level=0):
-        # new_df = new_df[throwaway::]
-        logger.info(f"component: {component}")
-        logger.info(f"component df:\n {new_df}")
-        combine_mask = new_df["start_time"] <= new_df["end_time"].shift(1)
-
-        group_key = (~combine_mask).cumsum()
-        grouped = new_df.groupby(group_key).agg({"start_time": "min", "end_time": "max"}).reset_index(drop=True)
-        logger.info(f"new_df after combining:\n {grouped}")
-
-        device = graph.loc[graph["componentURI"] == component, "deviceURI"].values[0]
-        points = graph.loc[
-            (graph["componentURI"] == component) & (graph["class"].isin(rule.sensor_types)),
-            "point",
-        ].values
-        grouped["anomaly"] = grouped.apply(
-            lambda row: create_anomaly(
-                row=row,
-                component=component,
-                device=device,
-                rule_id=rule.rule_id,
-                points=points,
-            ),
-            axis=1,
-        )
-        logger.info(f"new_df after adding anomaly column:\n {grouped}")
-        anomaly_list.extend(grouped["anomaly"].tolist())
-
-    return anomaly_list
-
-
-async def start_rule(conn: Connection, graphInfoDF: pd.DataFrame, rule: Rule):
-    """Evaluates a rule against its threshold"""
-    while True:
-        logger.info(
-            "---------------------------------------------------------------------------------------------------------------------------------------------------------"
-        )
-        logger.info(f"*** STARTING ANALYSIS OF RULE {rule.rule_id} ***")
-
-        resample_size = int(rule.condition.duration * 0.25)
-        overlap = (rule.condition.duration / resample_size - 1) * resample_size  # accounts for rolling averages from end of last iteration of loop
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds=rule.condition.sleep_time) - datetime.timedelta(seconds=overlap)
-        end_time = datetime.datetime.now()
-        sensors = rule.sensor_types
+    with stage_timer("eval", rule.rule_id):
+        results = rule.condition.evaluator().evaluate(rolling_mean)
+    if snapshots_enabled(rule.rule_id):
+        write_snapshot("results", rolling_mean.assign(results=results), rule.rule_id)
+
+    # Keep only the timestamps where the rule was violated, each one is the end of a window of length duration
+    hits = rolling_mean.index[results]
+    if hits.empty:
+        return AnomalyBatch.empty(rule_id=rule.rule_id)
+    with stage_timer("assembly", rule.rule_id):
+        return assemble_anomalies(graph=graph, hits=hits, rule=rule, metadata=metadata)
+
+
+def assemble_anomalies(graph: pd.DataFrame, hits: pd.MultiIndex, rule: Rule, metadata: Optional[pd.DataFrame] = None) -> AnomalyBatch:
+    """Merges the (componentURI, ts) hits of a rule into intervals and joins the points and metadata of their components onto them"""
+    intervals = hit_intervals(hits=hits, rule=rule)
+    logger.debug(f"rule {rule.rule_id}: {len(hits)} hits combined into {len(intervals)} anomalies")
+    return anomaly_batch(graph=graph, intervals=intervals, rule=rule, metadata=metadata)
+
+
+def rule_start_time(rule: Rule, tick: Tick) -> datetime.datetime:
+    """
+    Start of the window a rule without carried state has to load for a tick: one duration before the tick starts, so that the first
+    rolling window it emits (see windows.throwaway_time) is the full window of the first bucket of the tick
+    """
+    return tick.start_time - datetime.timedelta(seconds=rule.condition.duration)
+
+
+async def run_group_cycle(
+    pool: AsyncConnectionPool,
+    graph_index: GraphIndex,
+    group: FetchGroup,
+    windows: Dict[int, IncrementalWindow],
+    open_anomalies: Dict[int, OpenAnomalies],
+    tick: Tick,
+    resample_in_database: bool = False,
+    evaluate_in_database: bool = False,
+):
+    """
+    Runs one cycle of every rule in a fetch group. Connections are only borrowed from the pool while a query is running, so the
+    pandas work of one group never holds a connection that another group is waiting for. The cycle analyzes the readings up to the end
+    of its tick, and the rules without carried state emit the rolling windows of every bucket in the tick.
+
+    With resample_in_database, rules whose metric allows it get their resample buckets aggregated by Postgres, one query per resample
+    size, and only the rules with percentile metrics load the raw readings.
+
+    With evaluate_in_database, rules whose metric and equation allow it are run entirely by Postgres over a full window every cycle,
+    and only their anomalies are transferred. The other rules keep using the paths above.
+
+    Every query only covers the group's scope of the graph index, the sensors of the group's component type its equations read.
+    """
+    graph = graph_index.scope(group.key.component_type, group.sensor_types)
+    # precomputed with the index, so no cycle scans the graph rows for the ids it queries
+    timeseries_ids = graph_index.timeseries_ids(group.key.component_type, group.sensor_types)
+    positions = graph_index.timeseries_positions(group.key.component_type, group.sensor_types)
+    # the tick ends on a bucket boundary, the reading at the boundary belongs to the next bucket and is left to the next cycle
+    end_time = tick.end_time - timedelta(microseconds=1)
+
+    sql_rules = [rule for rule in group.rules if evaluate_in_database and evaluates_in_database(rule)]
+    database_rules = [
+        rule for rule in group.rules if rule not in sql_rules and resample_in_database and resamples_in_database(rule.condition.metric)
+    ]
+    raw_rules = [rule for rule in group.rules if rule not in sql_rules and rule not in database_rules]
+    newest_readings = []
+
+    if raw_rules:
+        # the shared frame starts early enough to cover every rule in the group: rules that carry rolling window state from the last
+        # cycle only need the data after their watermark, the others need a full overlapping window
+        start_time = min(windows[rule.rule_id].fetch_start(rule_start_time(rule, tick)) for rule in raw_rules)
         logger.info(f"start_time: {start_time}, end_time: {end_time}")
 
-        logger.info(f"*** LOADING TIMESERIES DATA FOR RULE {rule.rule_id} ***")
-        timeseries_df = load_timeseries(
-            conn=conn,
-            graph=graphInfoDF,
-            start_time=start_time,
-            end_time=end_time,
-            brick_list=sensors,
-        )
-
-        logger.info(f"*** ANALYZING DATA FOR RULE {rule.rule_id} ***")
-        anomaly_list = analyze_data(
-            graph=graphInfoDF,
-            timeseries_data=timeseries_df,
-            rule=rule,
-            start_time=start_time,
+        logger.info(f"*** LOADING TIMESERIES DATA FOR RULES {[rule.rule_id for rule in raw_rules]} ***")
+        with stage_timer("query", group.rule_ids):
+            async with pool.connection() as conn:
+                columns = await fetch_timeseries_columns_async(
+                    conn=conn,
+                    graph=graph,
+                    start_time=start_time,
+                    end_time=end_time,
+                    brick_list=group.sensor_types,
+                    timeseries_ids=timeseries_ids,
+                )
+        ROWS_FETCHED.labels(rules=rules_label(group.rule_ids)).inc(len(columns))
+        with stage_timer("pivot", group.rule_ids):
+            timeseries_df = pivot_timeseries_columns(columns=columns, graph=graph, positions=positions)
+        if not timeseries_df.empty:
+            newest_readings.append(timeseries_df.index.get_level_values("ts").max())
+
+        for rule in raw_rules:
+            logger.info(f"*** ANALYZING DATA FOR RULE {rule.rule_id} ***")
+            rolling_mean = windows[rule.rule_id].update(timeseries_data=timeseries_df, start_time=rule_start_time(rule, tick))
+            await append_rule_anomalies(
+                pool=pool, view=graph_index.view(rule), rolling_mean=rolling_mean, rule=rule, open_anomalies=open_anomalies[rule.rule_id]
+            )
+
+    # rules with the same resample size and watermark share one bucket aggregate query
+    batches: Dict[tuple, List[Rule]] = {}
+    for rule in database_rules:
+        start_time = windows[rule.rule_id].database_fetch_start(rule_start_time(rule, tick))
+        batches.setdefault((rule_resample_size(rule), start_time), []).append(rule)
+
+    for (resample_size, start_time), rules in batches.items():
+        logger.info(f"*** RESAMPLING TIMESERIES DATA IN POSTGRES FOR RULES {[rule.rule_id for rule in rules]} ***")
+        with stage_timer("query", group.rule_ids):
+            async with pool.connection() as conn:
+                aggregates = await fetch_bucket_aggregates_async(
+                    conn=conn,
+                    graph=graph,
+                    start_time=start_time,
+                    end_time=end_time,
+                    brick_list=group.sensor_types,
+                    resample_size=resample_size,
+                    timeseries_ids=timeseries_ids,
+                    positions=positions,
+                )
+        ROWS_FETCHED.labels(rules=rules_label(group.rule_ids)).inc(len(aggregates))
+        if aggregates.watermark is not None:
+            newest_readings.append(aggregates.watermark)
+
+        for rule in rules:
+            logger.info(f"*** ANALYZING DATA FOR RULE {rule.rule_id} ***")
+            rolling_mean = windows[rule.rule_id].update_partials(
+                partials=database_partials(aggregates, rule.condition.metric),
+                watermark=aggregates.watermark,
+                start_time=rule_start_time(rule, tick),
+            )
+            await append_rule_anomalies(
+                pool=pool, view=graph_index.view(rule), rolling_mean=rolling_mean, rule=rule, open_anomalies=open_anomalies[rule.rule_id]
+            )
+
+    for rule in sql_rules:
+        logger.info(f"*** ANALYZING DATA IN POSTGRES FOR RULE {rule.rule_id} ***")
+        view = graph_index.view(rule)
+        with stage_timer("query", rule.rule_id):
+            async with pool.connection() as conn:
+                anomalies = await find_anomalies_in_database_async(
+                    conn=conn,
+                    graph=view.graph,
+                    rule=rule,
+                    start_time=rule_start_time(rule, tick),
+                    end_time=end_time,
+                    metadata=view.metadata,
+                )
+        await insert_rule_anomalies(pool=pool, anomalies=anomalies, rule=rule, open_anomalies=open_anomalies[rule.rule_id])
+
+    if newest_readings:
+        # how far behind the newest reading of this cycle the anomalies were written
+        lag = (datetime.datetime.now(datetime.timezone.utc) - max(newest_readings)).total_seconds()
+        DETECTION_LAG.labels(rules=rules_label(group.rule_ids)).observe(lag)
+        LAST_DETECTION_LAG.labels(rules=rules_label(group.rule_ids)).set(lag)
+
+
+async def append_rule_anomalies(
+    pool: AsyncConnectionPool, view: RuleView, rolling_mean: pd.DataFrame, rule: Rule, open_anomalies: OpenAnomalies
+):
+    """Evaluates a rule against its rolling metric and appends the anomalies it finds"""
+    anomalies = find_anomalies(graph=view.graph, rolling_mean=rolling_mean, rule=rule, metadata=view.metadata)
+    await insert_rule_anomalies(pool=pool, anomalies=anomalies, rule=rule, open_anomalies=open_anomalies)
+
+
+async def insert_rule_anomalies(pool: AsyncConnectionPool, anomalies: AnomalyBatch, rule: Rule, open_anomalies: OpenAnomalies):
+    """
+    Writes the anomalies a rule found in this cycle and counts the new ones: anomalies that continue the open anomaly of their component
+    extend its end_time, the ones it already covers are skipped, and only the rest is inserted. The open anomalies are loaded from the
+    anomalies table the first time the rule finds anomalies, back to the earliest start of those.
+    """
+    logger.info(f"*** APPENDING AND UPDATING ANOMALIES FOR RULE {rule.rule_id} ***")
+    with stage_timer("insert", rule.rule_id):
+        async with pool.connection() as conn:
+            if not open_anomalies.loaded and len(anomalies):
+                since = min(anomalies.start_time)
+                open_anomalies.load(await fetch_open_anomalies_async(conn=conn, rule_id=rule.rule_id, since=since))
+            writes = open_anomalies.split(anomalies)
+            if not writes.empty:
+                written = await write_open_anomalies_async(conn=conn, extensions=writes.extensions, anomaly_list=writes.new.to_tuples())
+                open_anomalies.record(written)
+    logger.debug(
+        f"rule {rule.rule_id}: {len(writes.new)} new anomalies, {len(writes.extensions)} extended, {writes.skipped} already written"
+    )
+    ANOMALIES_WRITTEN.labels(rule=rule.rule_id).inc(len(writes.new))
+
+
+async def start_group(
+    pool: AsyncConnectionPool,
+    graph_store: GraphStore,
+    group: FetchGroup,
+    scheduler: Scheduler,
+    resample_in_database: bool = False,
+    evaluate_in_database: bool = False,
+    shard: int = 0,
+    shards: int = 1,
+    leases: Optional[LeaseManager] = None,
+    backlog_batch_seconds: int = DEFAULT_BACKLOG_BATCH_SECONDS,
+):
+    """
+    Evaluates every rule in a fetch group against its threshold, loading the group's timeseries data once per cycle. The cycles are
+    fired by the scheduler, and each one starts where the last successful one ended, so a failed cycle is covered again by the next
+    one. Each cycle runs against the graph index that is current when it starts; when the graph was refreshed since the last cycle, the
+    rolling window state of components that left a rule's graph is dropped.
+
+    With more than one shard, the group only runs for the components of its shard (see afdd.graph_index.component_shards). With
+    leases, it only runs the cycles during which this worker holds the lease of its (group, shard) unit, starting from where the last
+    cycle of any worker ended. The rolling windows and open anomalies are only carried from a cycle to the next when both ran here.
+
+    Every cycle records how far the group's rules were analyzed in the watermarks table, and the group's first cycle after a restart
+    starts from there, so the time the process was down is analyzed too. A cycle that covers more than backlog_batch_seconds is split
+    into batches of that span (see afdd.scheduler.backlog_ticks), each recorded as soon as it ran.
+    """
+    unit = LeaseUnit.of(group, shard)
+    windows: Dict[int, IncrementalWindow] = {}
+    open_anomalies: Dict[int, OpenAnomalies] = {}
+    # end of the last cycle that ran (on any worker), and of the last one the carried state covers
+    covered_until: Optional[datetime.datetime] = None
+    state_until: Optional[datetime.datetime] = None
+    graph_index: Optional[GraphIndex] = None
+    store_index: Optional[GraphIndex] = None
+    async for tick in scheduler.ticks(group):
+        if leases is not None:
+            if not leases.begin(unit):
+                state_until = None
+                continue
+            covered_until = leases.covered_until(unit)
+        try:
+            try:
+                if covered_until is None:
+                    # nothing ran for the unit yet, it resumes from the watermarks its rules reached before the last restart
+                    async with pool.connection() as conn:
+                        covered_until = await fetch_watermark_async(conn=conn, rule_ids=group.rule_ids, shard=shard, shards=shards)
+                if covered_until is not None:
+                    if covered_until >= tick.end_time:
+                        continue
+                    tick = Tick(start_time=covered_until, end_time=tick.end_time, missed=tick.missed)
+                batches = backlog_ticks(tick, group_period(group), backlog_batch_seconds)
+                if len(batches) > 1:
+                    logger.info(f"Catching up on rules {group.rule_ids} from {tick.start_time} to {tick.end_time} in {len(batches)} batches")
+
+                for batch in batches:
+                    if state_until != batch.start_time:
+                        windows = {rule.rule_id: IncrementalWindow(rule=rule) for rule in group.rules}
+                        open_anomalies = {rule.rule_id: OpenAnomalies(rule=rule) for rule in group.rules}
+
+                    logger.info(
+                        "---------------------------------------------------------------------------------------------------------------------------------------------------------"
+                    )
+                    logger.info(f"*** STARTING ANALYSIS OF RULES {group.rule_ids}{f' SHARD {shard}' if shards > 1 else ''} ***")
+                    if graph_store.index is not store_index:
+                        current = graph_store.index if shards == 1 else shard_index(graph_store.index, group.rules, shard, shards)
+                        if graph_index is not None:
+                            forget_removed_components(
+                                windows=windows, previous=graph_index, current=current, rules=group.rules, open_anomalies=open_anomalies
+                            )
+                        graph_index, store_index = current, graph_store.index
+
+                    with stage_timer("cycle", group.rule_ids):
+                        await run_group_cycle(
+                            pool=pool,
+                            graph_index=graph_index,
+                            group=group,
+                            windows=windows,
+                            open_anomalies=open_anomalies,
+                            tick=batch,
+                            resample_in_database=resample_in_database,
+                            evaluate_in_database=evaluate_in_database,
+                        )
+                    covered_until = state_until = batch.end_time
+                    async with pool.connection() as conn:
+                        await write_watermarks_async(
+                            conn=conn, rule_ids=group.rule_ids, processed_until=batch.end_time, shard=shard, shards=shards
+                        )
+                    if leases is not None and not await leases.cover(unit, batch.end_time):
+                        state_until = None
+                        break
+            except (psycopg.OperationalError, PoolTimeout) as e:
+                # the pool replaces broken connections on its own, so the group just waits for its next cycle
+                CYCLE_ERRORS.labels(rules=rules_label(group.rule_ids)).inc()
+                logger.error(f"Database unavailable while running rules {group.rule_ids}, skipping this cycle: {e}")
+                state_until = None
+        finally:
+            if leases is not None:
+                leases.finish(unit)
+
+        logger.info(f"*** SLEEPING RULES {group.rule_ids} ***")
+
+
+# seconds between attempts to check a graph read from the on-disk cache against Neo4j, when there is no refresh interval
+GRAPH_REVALIDATE_RETRY = 60
+
+
+def forget_removed_components(
+    windows: Dict[int, IncrementalWindow],
+    previous: GraphIndex,
+    current: GraphIndex,
+    rules: List[Rule],
+    open_anomalies: Optional[Dict[int, OpenAnomalies]] = None,
+) -> None:
+    """
+    Tells the rolling windows of the rules which components a graph refresh added to or removed from their graph, and drops the open
+    anomalies of the removed components
+    """
+    for rule in rules:
+        diff = diff_graphs(previous.view(rule).graph, current.view(rule).graph)
+        if diff.added_components or diff.removed_components:
+            logger.info(
+                f"rule {rule.rule_id}: graph refresh added components {list(diff.added_components)} "
+                f"and removed components {list(diff.removed_components)}"
+            )
+        windows[rule.rule_id].forget(diff.removed_components)
+        if open_anomalies is not None:
+            open_anomalies[rule.rule_id].forget(diff.removed_components)
+
+
+async def refresh_graph_periodically(
+    graph_store: GraphStore,
+    load_graph: Callable[[], GraphIndex],
+    interval: float,
+    revalidate: bool = False,
+    save_graph: Optional[Callable[[GraphIndex], None]] = None,
+) -> None:
+    """
+    Reloads the graph from Neo4j every interval seconds and swaps the new index into graph_store when it changed. Loading, indexing and
+    diffing run in a thread, so the rules keep running on the current graph meanwhile; a failed load keeps the current graph.
+
+    With revalidate the first reload runs right away, which is how a graph read from the on-disk cache is checked against Neo4j. Without
+    an interval the refresher stops after that check succeeded, and retries a failed one every GRAPH_REVALIDATE_RETRY seconds. save_graph
+    is called in a thread with the current index after every successful load.
+    """
+    delay = 0 if revalidate else interval
+    while True:
+        await asyncio.sleep(delay)
+        delay = interval if interval > 0 else GRAPH_REVALIDATE_RETRY
+        try:
+            graph_index = await asyncio.to_thread(load_graph)
+        except Exception as e:
+            GRAPH_REFRESHES.labels(result="failed").inc()
+            logger.error(f"Graph refresh failed, keeping the current graph: {e}")
+            continue
+
+        diff = await asyncio.to_thread(diff_graphs, graph_store.index.graph, graph_index.graph)
+        if diff.empty:
+            GRAPH_REFRESHES.labels(result="unchanged").inc()
+            logger.info("Graph refresh: no changes")
+        else:
+            graph_store.swap(graph_index)
+            GRAPH_REFRESHES.labels(result="swapped").inc()
+            logger.info(
+                f"Graph refresh: version {graph_store.version}, {diff.changed_rows} rows changed, "
+                f"{len(diff.added_components)} components added, {len(diff.removed_components)} removed, "
+                f"{len(diff.added_points)} points added, {len(diff.removed_points)} removed"
+            )
+
+        if save_graph is not None:
+            try:
+                await asyncio.to_thread(save_graph, graph_store.index)
+            except OSError as e:
+                logger.error(f"Could not save the graph cache: {e}")
+        if interval <= 0:
+            return
+
+
+# seconds between checks that the timeseries partitions of the coming months exist
+PARTITION_MAINTENANCE_SECONDS = 24 * 3600
+
+
+async def maintain_partitions_periodically(pool: AsyncConnectionPool, interval: float = PARTITION_MAINTENANCE_SECONDS) -> None:
+    """
+    Creates the upcoming monthly timeseries partitions every interval seconds (see afdd.migrations.ensure_timeseries_partitions), so a
+    service that runs for months keeps writing its readings into partitions instead of timeseries_default. migrate creates them at
+    startup, so the first check runs after one interval.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with pool.connection() as conn:
+                await ensure_timeseries_partitions_async(conn)
+        except (psycopg.OperationalError, PoolTimeout) as e:
+            logger.error(f"Database unavailable while creating the timeseries partitions, trying again in {interval}s: {e}")
+
+
+async def start(
+    pool: AsyncConnectionPool,
+    graph_store: GraphStore,
+    rules_list: List[Rule],
+    metrics_textfile: Optional[str] = None,
+    resample_in_database: bool = False,
+    evaluate_in_database: bool = False,
+    load_graph: Optional[Callable[[], GraphIndex]] = None,
+    graph_refresh_interval: float = 0,
+    revalidate_graph: bool = False,
+    save_graph: Optional[Callable[[GraphIndex], None]] = None,
+    scheduler_jitter: float = DEFAULT_JITTER_SECONDS,
+    shards: int = 1,
+    lease_seconds: Optional[float] = None,
+    backlog_batch_seconds: int = DEFAULT_BACKLOG_BATCH_SECONDS,
+):
+    """
+    Plans the shared timeseries fetches for the rules_list and creates a start_group() coroutine object for each fetch group and
+    component shard, all fired by one Scheduler that delays every cycle by up to scheduler_jitter seconds. With lease_seconds the
+    (group, shard) units are shared with the other workers through a LeaseManager, and this worker only runs the ones it holds the
+    lease of. A group resuming from its watermarks catches up in batches of backlog_batch_seconds. With a load_graph function the graph
+    is also refreshed in the background every graph_refresh_interval seconds, and/or checked against Neo4j right away with
+    revalidate_graph (see refresh_graph_periodically). The timeseries partitions of the coming months are created once a day.
+    """
+    coro_list = [monitor_event_loop(), maintain_partitions_periodically(pool)]
+    if metrics_textfile:
+        coro_list.append(write_textfile_periodically(metrics_textfile))
+    if load_graph is not None and (graph_refresh_interval > 0 or revalidate_graph):
+        coro_list.append(
+            refresh_graph_periodically(
+                graph_store=graph_store,
+                load_graph=load_graph,
+                interval=graph_refresh_interval,
+                revalidate=revalidate_graph,
+                save_graph=save_graph,
+            )
         )
 
-        logger.info(f"*** APPENDING AND UPDATING ANOMALIES FOR RULE {rule.rule_id} ***")
-        append_anomalies(conn=conn, anomaly_list=anomaly_list)
-
-        logger.info(f"*** SLEEPING RULE {rule.rule_id} ***")
-        await asyncio.sleep(rule.condition.sleep_time)
-
-
-async def start(conn: Connection, graphInfoDF: pd.DataFrame, rules_list: List[Rule]):
-    """Creates a start_rule() coroutine object for each rule in the rules_list"""
-    coro_list = []
-
-    for rule in rules_list:
-        coro_list.append(start_rule(conn=conn, graphInfoDF=graphInfoDF, rule=rule))
-
-    await asyncio.gather(*coro_list)
+    groups = plan_fetches(rules_list)
+    logger.info(f"fetch groups: {[group.rule_ids for group in groups]}")
+    scheduler = Scheduler(jitter=scheduler_jitter)
+    leases = None
+    if lease_seconds:
+        leases = LeaseManager(pool, [LeaseUnit.of(group, shard) for group in groups for shard in range(shards)], lease_seconds)
+        coro_list.append(leases.run())
+
+    async with pool:
+        if leases is not None:
+            # the first cycles run right away, so they need the leases before the first tick
+            await leases.rebalance()
+        for group in groups:
+            for shard in range(shards):
+                coro_list.append(
+                    start_group(
+                        pool=pool,
+                        graph_store=graph_store,
+                        group=group,
+                        scheduler=scheduler,
+                        resample_in_database=resample_in_database,
+                        evaluate_in_database=evaluate_in_database,
+                        shard=shard,
+                        shards=shards,
+                        leases=leases,
+                        backlog_batch_seconds=backlog_batch_seconds,
+                    )
+                )
+
+        await asyncio.gather(*coro_list)
 
 
 def main():
@@ -152,21 +529,81 @@ def main():
         auth=(neo4j_conn_string.username, neo4j_conn_string.password),
         max_connection_lifetime=200,
     )
-    neo4j_driver.verify_connectivity()
+
+    # Brings the schema up to date and creates the upcoming timeseries partitions
+    migrate(conn=conn)
 
     # Loads rules.json into postgres then gets rules from postgres
     load_rules(conn=conn, rules_json="rules.json")
     rules_list = get_rules(conn=conn)
     logger.info(f"rules_list: {rules_list}")
 
-    # Load graph data from neo4j
-    graph_df = load_graph_data(driver=neo4j_driver, rules_list=rules_list)
-    logger.info(f"graph_df: {graph_df}")
-
-    neo4j_driver.close()
+    configure_snapshots(SnapshotConfig.from_env())
+
+    # AFDD_GRAPH_REFRESH_SECONDS keeps the neo4j driver open and reloads the graph on that interval, so new components and sensors are
+    # picked up without a restart
+    graph_refresh_interval = float(os.environ.get("AFDD_GRAPH_REFRESH_SECONDS") or 0)
+    # AFDD_GRAPH_CACHE_DIR keeps the graph on disk, a restart starts from it and checks it against neo4j in the background
+    graph_cache_dir = os.environ.get("AFDD_GRAPH_CACHE_DIR")
+    component_types = {rule.component_type for rule in rules_list}
+    cached = read_graph_cache(directory=graph_cache_dir, component_types=component_types) if graph_cache_dir else None
+
+    if cached is not None:
+        graph_index = GraphIndex(cached.graph, rules_list)
+    else:
+        # Load graph data from neo4j, interned and split into the part of the graph every rule reads once here
+        neo4j_driver.verify_connectivity()
+        graph_index = load_graph_index(driver=neo4j_driver, rules_list=rules_list, close_driver=False)
+        if graph_cache_dir:
+            write_graph_cache(directory=graph_cache_dir, graph=graph_index.graph, component_types=component_types)
+    logger.info(f"graph: {len(graph_index.graph)} rows, {graph_index.graph['componentURI'].nunique()} components")
+
+    if graph_refresh_interval <= 0 and cached is None:
+        neo4j_driver.close()
+    conn.close()
+
+    # optional prometheus metrics, served over http and/or written to a file for the node_exporter textfile collector
+    if os.environ.get("AFDD_METRICS_PORT"):
+        metrics_host, metrics_port = os.environ.get("AFDD_METRICS_HOST", "127.0.0.1"), int(os.environ["AFDD_METRICS_PORT"])
+        start_http_server(port=metrics_port, addr=metrics_host)
+        logger.info(f"Serving metrics on http://{metrics_host}:{metrics_port}/metrics")
 
     # running anomaly detect in sleep time cycle
-    asyncio.run(start(conn=conn, graphInfoDF=graph_df, rules_list=rules_list))
+    pool = create_pool(conninfo=postgres_conn_string, max_size=int(os.environ.get("POSTGRES_POOL_SIZE", 10)))
+    # AFDD_RESAMPLE_IN_DATABASE lets Postgres aggregate the resample buckets, so only one row per sensor and bucket is transferred
+    resample_in_database = os.environ.get("AFDD_RESAMPLE_IN_DATABASE", "").lower() in ("1", "true", "yes")
+    # AFDD_EVALUATE_IN_DATABASE runs whole rules in Postgres when their metric and equation allow it, only anomalies are transferred
+    evaluate_in_database = os.environ.get("AFDD_EVALUATE_IN_DATABASE", "").lower() in ("1", "true", "yes")
+    # AFDD_SCHEDULER_JITTER_SECONDS spreads the cycles that are due at the same boundary over up to that many seconds
+    scheduler_jitter = float(os.environ.get("AFDD_SCHEDULER_JITTER_SECONDS") or DEFAULT_JITTER_SECONDS)
+    # AFDD_LEASE_SECONDS shares the rules with the other afdd workers on the same database, split into AFDD_COMPONENT_SHARDS shards of
+    # components per fetch group
+    lease_seconds = float(os.environ.get("AFDD_LEASE_SECONDS") or 0) or None
+    shards = int(os.environ.get("AFDD_COMPONENT_SHARDS") or 1)
+    # AFDD_BACKLOG_BATCH_SECONDS is the longest span a cycle that catches up after a restart or an overrun analyzes at once
+    backlog_batch_seconds = int(os.environ.get("AFDD_BACKLOG_BATCH_SECONDS") or DEFAULT_BACKLOG_BATCH_SECONDS)
+    asyncio.run(
+        start(
+            pool=pool,
+            graph_store=GraphStore(graph_index),
+            rules_list=rules_list,
+            metrics_textfile=os.environ.get("AFDD_METRICS_TEXTFILE"),
+            resample_in_database=resample_in_database,
+            evaluate_in_database=evaluate_in_database,
+            load_graph=lambda: load_graph_index(driver=neo4j_driver, rules_list=rules_list, close_driver=False, raise_errors=True),
+            graph_refresh_interval=graph_refresh_interval,
+            revalidate_graph=cached is not None,
+            save_graph=(
+                (lambda index: write_graph_cache(directory=graph_cache_dir, graph=index.graph, component_types=component_types))
+                if graph_cache_dir
+                else None
+            ),
+            scheduler_jitter=scheduler_jitter,
+            shards=shards,
+            lease_seconds=lease_seconds,
+            backlog_batch_seconds=backlog_batch_seconds,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Set
+
+from psycopg import AsyncConnection, Connection
+
+from afdd.logger import logger
+
+# key of the advisory lock held while migrating, so that several services starting at once apply every migration only once
+MIGRATIONS_LOCK = 4_810_013
+PARTITION_MONTHS_AHEAD = 3
+PARTITIONED_TIMESERIES_VERSION = 2  # the migration that creates create_timeseries_partition
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    One step of the database schema. Migrations are applied in version order, each in its own transaction, and recorded in the
+    schema_migrations table. Once released, a migration must never be edited: change the schema by adding a new one.
+    """
+
+    version: int
+    name: str
+    sql: str
+
+
+MIGRATIONS = (
+    Migration(
+        version=1,
+        name="initial schema",
+        sql="""
+          CREATE TABLE IF NOT EXISTS timeseries (
+            timeseriesid TEXT NOT NULL,
+            value FLOAT NOT NULL,
+            ts TIMESTAMPTZ NOT NULL
+          );
+
+          CREATE TABLE IF NOT EXISTS rules (
+            rule_id INT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            condition JSONB NOT NULL,
+            component_type TEXT NOT NULL,
+            sensor_types JSONB NOT NULL
+          );
+
+          CREATE TABLE IF NOT EXISTS anomalies (
+            start_time TIMESTAMPTZ NOT NULL,
+            end_time TIMESTAMPTZ NOT NULL,
+            rule_id INT,
+            anomaly_id INT GENERATED ALWAYS AS IDENTITY,
+            metadata JSONB NOT NULL,
+            points JSONB NOT NULL,
+            PRIMARY KEY(anomaly_id),
+            CONSTRAINT fk_rules
+              FOREIGN KEY(rule_id)
+                REFERENCES rules(rule_id)
+          );
+        """,
+    ),
+    Migration(
+        version=PARTITIONED_TIMESERIES_VERSION,
+        name="partition timeseries by month",
+        # the existing readings are copied into monthly partitions, which locks the table for the duration of the copy
+        sql="""
+          ALTER TABLE timeseries RENAME TO timeseries_unpartitioned;
+
+          CREATE TABLE timeseries (
+            timeseriesid TEXT NOT NULL,
+            value FLOAT NOT NULL,
+            ts TIMESTAMPTZ NOT NULL
+          ) PARTITION BY RANGE (ts);
+
+          -- catches readings of months without a partition yet, create_timeseries_partition moves them out
+          CREATE TABLE timeseries_default PARTITION OF timeseries DEFAULT;
+
+          CREATE FUNCTION create_timeseries_partition(month_start TIMESTAMPTZ) RETURNS BOOLEAN AS $$
+          DECLARE
+            month_utc TIMESTAMP := date_trunc('month', month_start AT TIME ZONE 'UTC');
+            lower_bound TIMESTAMPTZ := month_utc AT TIME ZONE 'UTC';
+            upper_bound TIMESTAMPTZ := (month_utc + INTERVAL '1 month') AT TIME ZONE 'UTC';
+            partition_name TEXT := 'timeseries_' || to_char(month_utc, 'YYYY_MM');
+          BEGIN
+            IF to_regclass(partition_name) IS NOT NULL THEN
+              RETURN false;
+            END IF;
+            EXECUTE format('CREATE TABLE %I (LIKE timeseries)', partition_name);
+            EXECUTE format(
+              'WITH moved AS (DELETE FROM timeseries_default WHERE ts >= $1 AND ts < $2 RETURNING timeseriesid, value, ts) '
+              'INSERT INTO %I SELECT * FROM moved',
+              partition_name
+            ) USING lower_bound, upper_bound;
+            EXECUTE format('ALTER TABLE timeseries ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, lower_bound, upper_bound);
+            RETURN true;
+          END
+          $$ LANGUAGE plpgsql;
+
+          -- only months with readings get a partition, so an old outlier doesn't create one partition per month since then
+          SELECT create_timeseries_partition(month)
+          FROM (SELECT DISTINCT date_trunc('month', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS month FROM timeseries_unpartitioned) months;
+
+          INSERT INTO timeseries SELECT timeseriesid, value, ts FROM timeseries_unpartitioned;
+          DROP TABLE timeseries_unpartitioned;
+
+          -- created after the copy, and inherited by every partition created later
+          CREATE INDEX timeseries_timeseriesid_ts_idx ON timeseries (timeseriesid, ts);
+          CREATE INDEX timeseries_ts_brin_idx ON timeseries USING BRIN (ts);
+        """,
+    ),
+    Migration(
+        version=3,
+        name="index anomalies",
+        sql="""
+          CREATE INDEX IF NOT EXISTS anomalies_rule_id_start_time_idx ON anomalies (rule_id, start_time, end_time);
+          CREATE INDEX IF NOT EXISTS anomalies_start_time_brin_idx ON anomalies USING BRIN (start_time);
+        """,
+    ),
+    Migration(
+        version=4,
+        name="unique anomaly key",
+        # exact duplicates (every column but anomaly_id) are deleted before the unique index is built, the oldest row is kept
+        sql="""
+          -- the epoch of a timestamptz doesn't depend on the session's time zone, so the key is immutable even though extract is stable
+          CREATE FUNCTION anomaly_key(rule_id INT, start_time TIMESTAMPTZ, end_time TIMESTAMPTZ, points JSONB, metadata JSONB) RETURNS UUID AS $$
+            SELECT md5(concat_ws('|', rule_id, extract(epoch FROM start_time), extract(epoch FROM end_time), points::text, metadata::text))::uuid
+          $$ LANGUAGE sql IMMUTABLE;
+
+          ALTER TABLE anomalies
+            ADD COLUMN anomaly_key UUID GENERATED ALWAYS AS (anomaly_key(rule_id, start_time, end_time, points, metadata)) STORED;
+
+          DELETE FROM anomalies duplicate USING anomalies kept
+          WHERE duplicate.anomaly_key = kept.anomaly_key AND duplicate.anomaly_id > kept.anomaly_id;
+
+          CREATE UNIQUE INDEX anomalies_anomaly_key_idx ON anomalies (anomaly_key);
+        """,
+    ),
+    Migration(
+        version=5,
+        name="worker leases",
+        # see afdd.leases: which afdd worker runs each (fetch group, component shard), and up to where the unit was analyzed
+        sql="""
+          CREATE TABLE workers (
+            worker TEXT PRIMARY KEY,
+            heartbeat TIMESTAMPTZ NOT NULL
+          );
+
+          CREATE TABLE leases (
+            rules TEXT NOT NULL,
+            shard INT NOT NULL,
+            worker TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            covered_until TIMESTAMPTZ,
+            PRIMARY KEY (rules, shard)
+          );
+        """,
+    ),
+    Migration(
+        version=6,
+        name="rule watermarks",
+        # see afdd.db.fetch_watermark_async: up to where every rule was analyzed, for each number of component shards it ran with
+        sql="""
+          CREATE TABLE watermarks (
+            rule_id INT NOT NULL REFERENCES rules (rule_id) ON DELETE CASCADE,
+            shards INT NOT NULL,
+            shard INT NOT NULL,
+            processed_until TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (rule_id, shards, shard)
+          );
+        """,
+    ),
+)
+
+
+def applied_versions(conn: Connection) -> Set[int]:
+    """The versions recorded in schema_migrations, which is created if it doesn't exist yet"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+              version INT PRIMARY KEY,
+              name TEXT NOT NULL,
+              applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )"""
+        )
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def pending_migrations(applied: Iterable[int], target: Optional[int] = None) -> List[Migration]:
+    """The migrations that haven't been applied yet, up to and including target (or all of them), in the order they must run"""
+    applied = set(applied)
+    return [
+        migration
+        for migration in sorted(MIGRATIONS, key=lambda migration: migration.version)
+        if migration.version not in applied and (target is None or migration.version <= target)
+    ]
+
+
+def migrate(conn: Connection, target: Optional[int] = None) -> List[Migration]:
+    """
+    Brings the schema up to date: applies every pending migration (up to target) in its own transaction, then makes sure the
+    timeseries partitions for the next PARTITION_MONTHS_AHEAD months exist.
+
+    Returns:
+        The migrations that were applied
+    """
+    applied = []
+    conn.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK,))
+    conn.commit()
+    try:
+        for migration in pending_migrations(applied_versions(conn), target):
+            logger.info(f"Applying migration {migration.version}: {migration.name}")
+            with conn.transaction():
+                conn.execute(migration.sql)
+                conn.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (migration.version, migration.name))
+            applied.append(migration)
+        if PARTITIONED_TIMESERIES_VERSION in applied_versions(conn):
+            ensure_timeseries_partitions(conn)
+    finally:
+        conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK,))
+        conn.commit()
+    return applied
+
+
+# the partitions of the current month and months_ahead months after it, and of every month with readings in the default partition
+PARTITIONS_QUERY = """
+  SELECT count(*) FILTER (WHERE create_timeseries_partition(month))
+  FROM (
+    SELECT generate_series(
+      date_trunc('month', now() AT TIME ZONE 'UTC'),
+      date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => %s),
+      INTERVAL '1 month'
+    ) AT TIME ZONE 'UTC' AS month
+    UNION
+    SELECT DISTINCT date_trunc('month', ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' FROM timeseries_default
+  ) months
+"""
+
+
+def ensure_timeseries_partitions(conn: Connection, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """
+    Creates the monthly timeseries partitions from the current month to months_ahead months from now, and for every month whose
+    readings ended up in the default partition, moving those readings into it.
+
+    Returns:
+        The number of partitions created
+    """
+    with conn.transaction():
+        (created,) = conn.execute(PARTITIONS_QUERY, (months_ahead,)).fetchone()
+    if created:
+        logger.info(f"Created {created} timeseries partitions")
+    return created
+
+
+async def ensure_timeseries_partitions_async(conn: AsyncConnection, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """
+    Same as ensure_timeseries_partitions on an async connection, for the running service (see afdd.main.maintain_partitions_periodically).
+    It waits for the migrations lock, so it never runs at the same time as a migration or the same check of another service.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK,))
+        (created,) = await (await conn.execute(PARTITIONS_QUERY, (months_ahead,))).fetchone()
+    if created:
+        logger.info(f"Created {created} timeseries partitions")
+    return created
@@ -1,8 +1,11 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 from enum import Enum
 import json
 import numpy as np
+import pandas as pd
+
+from afdd.equation import CompiledEquation, compile_equation
 
 
 @dataclass
@@ -10,6 +13,19 @@ class Metric(Enum):
     AVERAGE = "average"
     MAX = "max"
     MIN = "min"
+    MEDIAN = "median"
+    P90 = "p90"
+    P95 = "p95"
+    P99 = "p99"
+
+    @property
+    def quantile(self) -> Optional[float]:
+        """The quantile computed by a percentile metric, None for the other metrics"""
+        if self is Metric.MEDIAN:
+            return 0.5
+        if self.value.startswith("p"):
+            return int(self.value[1:]) / 100
+        return None
 
 
 @dataclass
@@ -26,6 +42,17 @@ class Condition:
     duration: int  # in seconds
     sleep_time: int  # in seconds
     severity: Severity
+    compiled: Optional[CompiledEquation] = field(default=None, repr=False, compare=False)  # set when the rule is loaded
+
+    def evaluator(self) -> CompiledEquation:
+        """The compiled form of the equation, compiling it now if the rule was built without going through get_rules"""
+        if self.compiled is None:
+            self.compiled = compile_equation(self.equation)
+        return self.compiled
+
+    def __getstate__(self):
+        # the compiled equation holds code objects, which can't be pickled (e.g. to send rules to worker processes); it is compiled again
+        return {**self.__dict__, "compiled": None}
 
     def to_dict(self):
         condition_dict = {
@@ -69,6 +96,40 @@ class Anomaly:
         return anomaly_tuple
 
 
+@dataclass
+class AnomalyBatch:
+    """
+    A columnar batch of anomalies found for one rule. Every array holds one entry per anomaly, and points and metadata are already
+    JSON encoded, so the batch can be handed to the database without building an Anomaly object per row. components holds the
+    componentURI of every anomaly when the batch was built from intervals.
+    """
+
+    start_time: np.ndarray
+    end_time: np.ndarray
+    rule_id: int
+    points: np.ndarray
+    metadata: np.ndarray
+    components: Optional[np.ndarray] = None
+
+    @classmethod
+    def empty(cls, rule_id: int) -> "AnomalyBatch":
+        return cls(
+            start_time=np.array([], dtype=object),
+            end_time=np.array([], dtype=object),
+            rule_id=rule_id,
+            points=np.array([], dtype=object),
+            metadata=np.array([], dtype=object),
+            components=np.array([], dtype=object),
+        )
+
+    def __len__(self):
+        return len(self.start_time)
+
+    def to_tuples(self) -> List[tuple]:
+        """Returns the anomalies in the same format as Anomaly.to_tuple, ready to be inserted into the anomalies table"""
+        return list(zip(self.start_time, self.end_time, [self.rule_id] * len(self), self.points, self.metadata))
+
+
 @dataclass
 class Rule:
     rule_id: int
@@ -95,3 +156,57 @@ class PointReading:
     ts: str
     value: float
     timeseriesid: str
+
+
+@dataclass
+class IngestStats:
+    """Throughput of a bulk load of timeseries readings"""
+
+    rows: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+@dataclass
+class TimeseriesColumns:
+    """
+    The readings returned by a timeseries query as typed arrays, one entry per reading. Each reading's timeseriesid is stored as its
+    position in timeseries_ids, so every id string is only held once.
+
+    Attributes:
+        ts: Timestamps as int64 nanoseconds since the unix epoch (UTC)
+        value: float64 values
+        point: int32 positions into timeseries_ids
+        timeseries_ids: The timeseriesids that were queried
+    """
+
+    ts: np.ndarray
+    value: np.ndarray
+    point: np.ndarray
+    timeseries_ids: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+
+@dataclass
+class BucketAggregates:
+    """
+    Resample buckets that were aggregated by Postgres instead of in pandas, in the same layout as windows.bucket_partials.
+
+    Attributes:
+        partials: sum, count, min and max of every occupied bucket, indexed by (componentURI, ts) with a column per brick class
+        watermark: The newest reading that went into the buckets, None if there were no readings
+        rows: Number of (timeseriesid, bucket) rows that were transferred
+    """
+
+    partials: Dict[str, pd.DataFrame]
+    watermark: Optional[pd.Timestamp]
+    rows: int
+
+    def __len__(self) -> int:
+        return self.rows
@@ -0,0 +1,110 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from afdd.models import AnomalyBatch, Rule
+
+# one row per component, indexed by componentURI
+OPEN_COLUMNS = ["anomaly_id", "start_time", "end_time"]
+
+
+@dataclass
+class AnomalyWrites:
+    """
+    What a cycle's anomalies change in the anomalies table once they were compared with the open anomalies of their rule.
+
+    Attributes:
+        extensions: (anomaly_id, end_time) of every open anomaly that a new interval continues
+        new: The anomalies that don't overlap the open anomaly of their component
+        skipped: Number of anomalies that were already covered by an open anomaly
+    """
+
+    extensions: List[Tuple[int, datetime]]
+    new: AnomalyBatch
+    skipped: int = 0
+
+    @property
+    def empty(self) -> bool:
+        return not self.extensions and not len(self.new)
+
+
+@dataclass
+class OpenAnomalies:
+    """
+    The latest anomaly of every component of one rule, carried from one cycle to the next.
+
+    Each cycle re-reads part of the last one, so a long excursion is found again by every cycle it lasts. Instead of writing it again,
+    an interval that overlaps the latest anomaly of its component extends that anomaly's end_time, an interval that lies inside it is
+    skipped, and only intervals that start after it are inserted. The state is loaded from the anomalies table before the first cycle
+    (see afdd.db.fetch_open_anomalies_async), so anomalies are continued across restarts too.
+    """
+
+    rule: Rule
+    # None until the latest anomalies were loaded from the database
+    latest: Optional[pd.DataFrame] = field(default=None, repr=False)
+
+    @property
+    def loaded(self) -> bool:
+        return self.latest is not None
+
+    def load(self, rows: Iterable[tuple]) -> None:
+        """Starts from (componentURI, anomaly_id, start_time, end_time) rows, the latest anomaly of each component"""
+        self.latest = self._frame(rows)
+
+    def split(self, anomalies: AnomalyBatch) -> AnomalyWrites:
+        """
+        Compares a cycle's anomalies with the latest anomaly of their component. Every component's intervals are disjoint, so at most one
+        of them can continue its open anomaly; the ones before it were written by an earlier cycle.
+        """
+        if not len(anomalies):
+            return AnomalyWrites(extensions=[], new=anomalies)
+        intervals = pd.DataFrame(
+            {
+                "componentURI": anomalies.components,
+                "start_time": pd.DatetimeIndex(anomalies.start_time),
+                "end_time": pd.DatetimeIndex(anomalies.end_time),
+            }
+        )
+        latest = self.latest.reindex(intervals["componentURI"])
+        open_end = pd.DatetimeIndex(latest["end_time"])
+        covered = (intervals["end_time"] <= open_end).to_numpy()
+        continues = ~covered & (intervals["start_time"] <= open_end).to_numpy()
+
+        extensions = list(zip(latest["anomaly_id"].to_numpy()[continues].astype(int).tolist(), anomalies.end_time[continues]))
+        new = ~covered & ~continues
+        return AnomalyWrites(
+            extensions=extensions,
+            new=AnomalyBatch(
+                start_time=anomalies.start_time[new],
+                end_time=anomalies.end_time[new],
+                rule_id=anomalies.rule_id,
+                points=anomalies.points[new],
+                metadata=anomalies.metadata[new],
+                components=anomalies.components[new],
+            ),
+            skipped=int(covered.sum()),
+        )
+
+    def record(self, rows: Iterable[tuple]) -> None:
+        """Takes the (componentURI, anomaly_id, start_time, end_time) rows that were written, the latest one of a component is kept"""
+        rows = list(rows)
+        if rows:
+            self.latest = self._frame([*self.latest.reset_index().itertuples(index=False, name=None), *rows])
+
+    def forget(self, components) -> None:
+        """Drops the open anomalies of components that are no longer in the rule's graph"""
+        if self.latest is None or not len(components):
+            return
+        self.latest = self.latest.loc[~self.latest.index.isin(components)]
+
+    @staticmethod
+    def _frame(rows: Iterable[tuple]) -> pd.DataFrame:
+        frame = pd.DataFrame(list(rows), columns=["componentURI", *OPEN_COLUMNS])
+        frame["anomaly_id"] = frame["anomaly_id"].astype(np.int64)
+        frame["start_time"] = pd.to_datetime(frame["start_time"], utc=True)
+        frame["end_time"] = pd.to_datetime(frame["end_time"], utc=True)
+        frame = frame.sort_values(["componentURI", "end_time"]).drop_duplicates("componentURI", keep="last")
+        return frame.set_index("componentURI")
@@ -0,0 +1,74 @@
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from afdd.models import Rule
+
+
+def rule_resample_size(rule: Rule) -> int:
+    """Size of the resample buckets for a rule, in seconds (one fourth of the rule's duration)"""
+    return int(rule.condition.duration * 0.25)
+
+
+def resample_alignment(rules: List[Rule]) -> int:
+    """The least common multiple of the rules' resample sizes, in seconds: every epoch aligned multiple of it is a bucket boundary of every rule"""
+    return math.lcm(*(rule_resample_size(rule) for rule in rules))
+
+
+def rule_columns(rule: Rule) -> Tuple[str, ...]:
+    """The sensor classes a rule's equation reads, which is all the timeseries data that has to be loaded for the rule"""
+    return rule.condition.evaluator().columns
+
+
+@dataclass(frozen=True)
+class FetchKey:
+    """
+    Rules with the same FetchKey read exactly the same timeseries data on the same cycle. sensor_types only holds the sensor classes
+    the rules' equations actually read.
+    """
+
+    component_type: str
+    sensor_types: Tuple[str, ...]
+    sleep_time: int
+
+
+@dataclass
+class FetchGroup:
+    """A set of rules that are served by one timeseries query and one pivot per cycle"""
+
+    key: FetchKey
+    rules: List[Rule] = field(default_factory=list)
+
+    @property
+    def sensor_types(self) -> List[str]:
+        return list(self.key.sensor_types)
+
+    @property
+    def sleep_time(self) -> int:
+        return self.key.sleep_time
+
+    @property
+    def rule_ids(self) -> List[int]:
+        return [rule.rule_id for rule in self.rules]
+
+
+def fetch_key(rule: Rule) -> FetchKey:
+    return FetchKey(
+        component_type=rule.component_type,
+        sensor_types=tuple(sorted(set(rule_columns(rule)))),
+        sleep_time=rule.condition.sleep_time,
+    )
+
+
+def plan_fetches(rules_list: List[Rule]) -> List[FetchGroup]:
+    """
+    Groups rules that read the same sensors of the same component type on the same cycle, so that each group only loads and pivots its
+    timeseries data once per cycle. Groups keep the order in which their first rule appears in rules_list.
+    """
+    groups: Dict[FetchKey, FetchGroup] = {}
+    for rule in rules_list:
+        key = fetch_key(rule)
+        if key not in groups:
+            groups[key] = FetchGroup(key=key)
+        groups[key].rules.append(rule)
+    return list(groups.values())
@@ -0,0 +1,117 @@
+import asyncio
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from afdd.instrumentation import MISSED_CYCLES, rules_label
+from afdd.logger import logger
+from afdd.planner import FetchGroup, resample_alignment
+
+DEFAULT_JITTER_SECONDS = 10.0
+# the jitter never delays a cycle by more than this fraction of its period
+MAX_JITTER_FRACTION = 0.1
+# longest span a catch-up cycle loads at once, see backlog_ticks
+DEFAULT_BACKLOG_BATCH_SECONDS = 24 * 3600
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass(frozen=True)
+class Tick:
+    """
+    One cycle of a fetch group: the readings in (start_time, end_time] are new to it. Both are epoch aligned boundaries of the group's
+    period, so every cycle covers the same span no matter how late it runs.
+
+    Attributes:
+        start_time: End of the previous cycle's window
+        end_time: The boundary the cycle analyzes up to
+        missed: Boundaries that passed while the previous cycle was still running, coalesced into this catch-up cycle
+    """
+
+    start_time: datetime
+    end_time: datetime
+    missed: int = 0
+
+    @property
+    def seconds(self) -> float:
+        return (self.end_time - self.start_time).total_seconds()
+
+
+def group_period(group: FetchGroup) -> int:
+    """Seconds between two cycles of a group: its sleep_time rounded up to a bucket boundary of every rule in the group"""
+    alignment = resample_alignment(group.rules)
+    return max(math.ceil(group.sleep_time / alignment), 1) * alignment
+
+
+def last_boundary(time: datetime, period: int) -> datetime:
+    """The latest epoch aligned multiple of period at or before time"""
+    return EPOCH + timedelta(seconds=math.floor((time - EPOCH).total_seconds() / period) * period)
+
+
+def backlog_ticks(tick: Tick, period: int, batch_seconds: int = DEFAULT_BACKLOG_BATCH_SECONDS) -> List[Tick]:
+    """
+    Splits a tick that covers a backlog, e.g. from a watermark before a restart up to now, into consecutive ticks of at most
+    batch_seconds (rounded down to whole periods, at least one) that end on epoch aligned multiples of that span, oldest first. Each
+    batch is analyzed in one go, so catching up takes a few large cycles instead of one per missed period, with bounded memory.
+    """
+    step = max(period, batch_seconds // period * period)
+    ticks = []
+    start_time = tick.start_time
+    boundary = last_boundary(start_time, step) + timedelta(seconds=step)
+    while boundary < tick.end_time:
+        ticks.append(Tick(start_time=start_time, end_time=boundary))
+        start_time = boundary
+        boundary += timedelta(seconds=step)
+    ticks.append(Tick(start_time=start_time, end_time=tick.end_time, missed=tick.missed))
+    return ticks
+
+
+class Scheduler:
+    """
+    Fires the cycles of every fetch group at epoch aligned boundaries of its period (see group_period), instead of sleeping sleep_time
+    after each cycle, so slow cycles don't shift the windows of the later ones.
+
+    A group's first cycle covers the period that ended at the last boundary and starts a random delay of up to jitter seconds after
+    the start, every later cycle the same after its boundary, so groups with the same period don't all query Postgres in the same
+    second. A cycle that runs past the next boundary is an overrun: the boundaries it missed are coalesced into one catch-up cycle that
+    starts as soon as it finished and covers everything up to the last boundary.
+    """
+
+    def __init__(
+        self,
+        jitter: float = DEFAULT_JITTER_SECONDS,
+        clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc),
+        sleep: Callable[[float], Awaitable] = asyncio.sleep,
+        rng: Optional[random.Random] = None,
+    ):
+        self.jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+
+    async def ticks(self, group: FetchGroup) -> AsyncIterator[Tick]:
+        """The cycles of a group, each one is only produced once the previous one finished"""
+        period = group_period(group)
+        jitter = min(self.jitter, period * MAX_JITTER_FRACTION)
+        end_time = last_boundary(self.clock(), period)
+        tick = Tick(start_time=end_time - timedelta(seconds=period), end_time=end_time)
+        if jitter:
+            await self.sleep(self.rng.uniform(0, jitter))
+        while True:
+            yield tick
+            next_boundary = tick.end_time + timedelta(seconds=period)
+            now = self.clock()
+            if now < next_boundary:
+                await self.sleep((next_boundary - now).total_seconds() + self.rng.uniform(0, jitter))
+                tick = Tick(start_time=tick.end_time, end_time=next_boundary)
+                continue
+
+            end_time = last_boundary(now, period)
+            missed = round((end_time - next_boundary).total_seconds() / period)
+            MISSED_CYCLES.labels(rules=rules_label(group.rule_ids)).inc(missed)
+            logger.warning(
+                f"Cycle of rules {group.rule_ids} ran past its next boundary {next_boundary}, catching up on {missed + 1} periods up to {end_time}"
+            )
+            tick = Tick(start_time=tick.end_time, end_time=end_time, missed=missed)
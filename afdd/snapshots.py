@@ -0,0 +1,86 @@
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import FrozenSet, Optional
+
+import pandas as pd
+
+from afdd.logger import logger
+
+
+@dataclass(frozen=True)
+class SnapshotConfig:
+    """
+    Which intermediate frames get written to disk.
+
+    Attributes:
+        directory: Folder the snapshots are written to, one sub folder per rule
+        rule_ids: Rules to snapshot, empty means every rule
+        components: Components to keep in the snapshots, empty means every component
+    """
+
+    directory: str
+    rule_ids: FrozenSet[int] = frozenset()
+    components: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def from_env(cls) -> Optional["SnapshotConfig"]:
+        """
+        Reads AFDD_SNAPSHOT_RULES (comma separated rule ids or *) and AFDD_SNAPSHOT_COMPONENTS (comma separated component URIs).
+        Snapshots are disabled unless at least one of them is set. AFDD_SNAPSHOT_DIR defaults to ./snapshots.
+        """
+        rules = os.environ.get("AFDD_SNAPSHOT_RULES", "").strip()
+        components = os.environ.get("AFDD_SNAPSHOT_COMPONENTS", "").strip()
+        if not rules and not components:
+            return None
+        return cls(
+            directory=os.environ.get("AFDD_SNAPSHOT_DIR", "./snapshots"),
+            rule_ids=frozenset() if rules in ("", "*") else frozenset(int(rule_id) for rule_id in rules.split(",")),
+            components=frozenset(component.strip() for component in components.split(",") if component.strip()),
+        )
+
+    def enabled_for(self, rule_id: int) -> bool:
+        return not self.rule_ids or rule_id in self.rule_ids
+
+
+_config: Optional[SnapshotConfig] = None
+
+
+def configure(config: Optional[SnapshotConfig]) -> None:
+    """Turns snapshots on with the given config, or off with None"""
+    global _config
+    _config = config
+    if config is not None:
+        logger.info(f"Writing debug snapshots to {config.directory} for rules {sorted(config.rule_ids) or 'all'}")
+
+
+def snapshots_enabled(rule_id: int) -> bool:
+    """Cheap check for the hot path, callers only build the frames they want to snapshot when this is True"""
+    return _config is not None and _config.enabled_for(rule_id)
+
+
+def write_snapshot(stage: str, frame: pd.DataFrame, rule_id: int) -> Optional[str]:
+    """
+    Writes an intermediate frame of a rule cycle (raw, resampled, rolling, results) as a zstd compressed Parquet file. The index is
+    written as regular columns and only numeric and boolean columns are kept.
+
+    Returns:
+        The path of the file, or None if snapshots are disabled for the rule
+    """
+    if not snapshots_enabled(rule_id):
+        return None
+
+    if _config.components and isinstance(frame.index, pd.MultiIndex):
+        frame = frame.loc[frame.index.get_level_values(0).isin(_config.components)]
+    frame = frame.select_dtypes(include=["number", "bool"]).reset_index()
+
+    directory = os.path.join(_config.directory, f"rule_{rule_id}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}_{stage}.parquet")
+    try:
+        frame.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+    except Exception as e:
+        # a snapshot is only for debugging, it must never stop the rule from running
+        logger.warning(f"Could not write {stage} snapshot of rule {rule_id}: {e}")
+        return None
+    return path
@@ -0,0 +1,264 @@
+import ast
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from psycopg import AsyncConnection, Connection
+
+from afdd.equation import FUNCTIONS, EquationError
+from afdd.graph import graph_timeseries_ids
+from afdd.logger import logger
+from afdd.models import AnomalyBatch, Metric, Rule
+from afdd.planner import rule_columns, rule_resample_size
+from afdd.utils import component_metadata
+from afdd.windows import ROLLING_WINDOW, resamples_in_database, throwaway_time
+
+# aggregate of the readings in a bucket and of the buckets in a rolling window, by metric value
+BUCKET_AGGREGATES = {Metric.AVERAGE.value: "avg", Metric.MAX.value: "max", Metric.MIN.value: "min"}
+
+COMPARISONS = {ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=", ast.Eq: "=", ast.NotEq: "<>"}
+ARITHMETIC = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*"}
+
+
+class _SqlTranslator:
+    """
+    Translates a rule equation into a SQL predicate that gives the same answer as CompiledEquation.evaluate: every comparison is true
+    or false (comparisons with missing values are false, except != which is true), and arithmetic that gives NaN in numpy gives NULL.
+    Equations with operations whose edge cases Postgres handles differently (e.g. it raises on the power of a negative number where
+    numpy returns NaN) raise an EquationError and are evaluated in pandas instead.
+    """
+
+    def __init__(self, equation: str, columns: Dict[str, str]):
+        self.equation = equation
+        self.columns = columns
+
+    def unsupported(self, node: ast.AST) -> EquationError:
+        return EquationError(f"Equation {self.equation!r} can't be evaluated in Postgres: {ast.unparse(node)!r} is not supported")
+
+    def predicate(self, node: ast.AST) -> str:
+        """SQL for a node that is an array of booleans in numpy"""
+        if isinstance(node, ast.Expression):
+            return self.predicate(node.body)
+        if isinstance(node, ast.Compare):
+            operands = [node.left, *node.comparators]
+            pairs = [self.compare(operands[i], op, operands[i + 1]) for i, op in enumerate(node.ops)]
+            return "(" + " AND ".join(pairs) + ")"
+        if isinstance(node, ast.BoolOp):
+            joiner = " AND " if isinstance(node.op, ast.And) else " OR "
+            return "(" + joiner.join(self.predicate(value) for value in node.values) + ")"
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            joiner = " AND " if isinstance(node.op, ast.BitAnd) else " OR "
+            return f"({self.predicate(node.left)}{joiner}{self.predicate(node.right)})"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+            return f"(NOT {self.predicate(node.operand)})"
+        raise self.unsupported(node)
+
+    def compare(self, left: ast.AST, op: ast.cmpop, right: ast.AST) -> str:
+        missing = "true" if isinstance(op, ast.NotEq) else "false"
+        return f"COALESCE({self.number(left)} {COMPARISONS[type(op)]} {self.number(right)}, {missing})"
+
+    def number(self, node: ast.AST) -> str:
+        """SQL for a node that is an array of floats in numpy, missing values and NaN are NULL"""
+        if isinstance(node, ast.Name) and node.id in self.columns:
+            return self.columns[node.id]
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            value = float(node.value)
+            if np.isinf(value):
+                return "'Infinity'::float8" if value > 0 else "'-Infinity'::float8"
+            return f"{value!r}::float8"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return f"(-{self.number(node.operand)})"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self.number(node.operand)
+        if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC:
+            # inf - inf and inf * 0 are NaN, which Postgres sorts above every number instead of failing every comparison
+            return f"NULLIF({self.number(node.left)} {ARITHMETIC[type(node.op)]} {self.number(node.right)}, 'NaN'::float8)"
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+            # numpy divides by zero to +-inf (NaN for 0 / 0) where Postgres raises
+            left, right = self.number(node.left), self.number(node.right)
+            return (
+                f"(CASE WHEN {right} = 0 THEN CASE WHEN {left} > 0 THEN 'Infinity'::float8 WHEN {left} < 0 THEN '-Infinity'::float8 END "
+                f"ELSE NULLIF({left} / {right}, 'NaN'::float8) END)"
+            )
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and len(node.args) == 1:
+            argument = self.number(node.args[0])
+            if node.func.id == "abs":
+                return f"abs({argument})"
+            if node.func.id == "sqrt":
+                return f"(CASE WHEN {argument} >= 0 THEN sqrt({argument}) END)"
+            if node.func.id == "log":
+                return f"(CASE WHEN {argument} > 0 THEN ln({argument}) WHEN {argument} = 0 THEN '-Infinity'::float8 END)"
+        raise self.unsupported(node)
+
+
+def equation_to_sql(equation: str, columns: Dict[str, str]) -> str:
+    """
+    Translates a rule equation into a SQL predicate. columns maps the sensor classes the equation reads to the SQL expressions holding
+    their values.
+
+    Raises:
+        EquationError: If the equation uses an operation that can't be evaluated in Postgres with the same results
+    """
+    tree = ast.parse(equation.strip(), mode="eval")
+    return _SqlTranslator(equation, columns).predicate(tree)
+
+
+def evaluates_in_database(rule: Rule) -> bool:
+    """Whether a whole rule can be evaluated by Postgres with the same results as the pandas path"""
+    if not resamples_in_database(rule.condition.metric):
+        return False
+    try:
+        columns = rule_columns(rule)
+        equation_to_sql(rule.condition.equation, {column: f"c{i}" for i, column in enumerate(columns)})
+    except EquationError as e:
+        logger.debug(f"rule {rule.rule_id} is evaluated in pandas: {e}")
+        return False
+    return True
+
+
+def rule_query(graph: pd.DataFrame, rule: Rule, start_time: str | datetime, end_time: str | datetime) -> Tuple[str, dict]:
+    """
+    Compiles a rule into one query that does everything analyze_data does with the readings between start_time and end_time:
+
+    1. averages (or the max or min of) the readings of every component and sensor class in buckets of the rule's resample size
+    2. fills in the empty buckets between each component's first and last bucket, like pandas resampling does
+    3. takes the rolling metric over the last ROLLING_WINDOW buckets and drops the buckets before the throwaway time
+    4. evaluates the equation and merges the hits of each component whose [ts - duration, ts] intervals overlap (gaps and islands)
+
+    Only the merged (componentURI, start_time, end_time) intervals are returned.
+    """
+    columns = rule_columns(rule)
+    aliases = {column: f"c{i}" for i, column in enumerate(columns)}
+    aggregate = BUCKET_AGGREGATES[rule.condition.metric.value]
+    predicate = equation_to_sql(rule.condition.equation, {column: f"w.{alias}" for column, alias in aliases.items()})
+
+    in_rule = graph["class"].isin(columns).to_numpy()
+    points = pd.DataFrame({
+        "timeseriesid": graph_timeseries_ids(graph)[in_rule],
+        "componentURI": graph["componentURI"].to_numpy(dtype=object)[in_rule],
+        "class": graph["class"].to_numpy(dtype=object)[in_rule],
+    }).drop_duplicates()
+    bucket_columns = ",\n".join(f"{aggregate}(t.value) FILTER (WHERE p.class = %(class_{alias})s) AS {alias}" for alias in aliases.values())
+    window_columns = ",\n".join(f"{aggregate}(b.{alias}) OVER rolling AS {alias}" for alias in aliases.values())
+
+    query = f"""
+      WITH points AS (
+        SELECT * FROM unnest(%(timeseries_ids)s::text[], %(components)s::text[], %(classes)s::text[]) AS p(timeseriesid, component, class)
+      ),
+      buckets AS (
+        SELECT
+          p.component,
+          date_bin(make_interval(secs => %(resample_size)s), t.ts, TIMESTAMPTZ 'epoch') AS bucket,
+          {bucket_columns}
+        FROM points p
+        JOIN timeseries t ON t.timeseriesid = p.timeseriesid
+        WHERE t.ts >= %(start_time)s AND t.ts <= %(end_time)s AND t.value <> 'NaN'
+        GROUP BY 1, 2
+      ),
+      series AS (
+        SELECT component, generate_series(min(bucket), max(bucket), make_interval(secs => %(resample_size)s)) AS bucket
+        FROM buckets
+        GROUP BY component
+      ),
+      w AS (
+        SELECT
+          s.component,
+          s.bucket,
+          {window_columns}
+        FROM series s
+        LEFT JOIN buckets b ON b.component = s.component AND b.bucket = s.bucket
+        WINDOW rolling AS (PARTITION BY s.component ORDER BY s.bucket ROWS BETWEEN {ROLLING_WINDOW - 1} PRECEDING AND CURRENT ROW)
+      ),
+      hits AS (
+        SELECT w.component, w.bucket - make_interval(secs => %(duration)s) AS start_time, w.bucket AS end_time
+        FROM w
+        WHERE w.bucket >= %(throwaway_time)s AND {predicate}
+      ),
+      flagged AS (
+        SELECT
+          *,
+          CASE WHEN start_time <= lag(end_time) OVER (PARTITION BY component ORDER BY end_time) THEN 0 ELSE 1 END AS new_island
+        FROM hits
+      ),
+      islands AS (
+        SELECT *, sum(new_island) OVER (PARTITION BY component ORDER BY end_time) AS island
+        FROM flagged
+      )
+      SELECT component, min(start_time), max(end_time)
+      FROM islands
+      GROUP BY component, island
+      ORDER BY component, min(start_time)
+    """
+    parameters = {
+        "timeseries_ids": points["timeseriesid"].tolist(),
+        "components": points["componentURI"].tolist(),
+        "classes": points["class"].tolist(),
+        "resample_size": rule_resample_size(rule),
+        "duration": int(rule.condition.duration),
+        "start_time": start_time,
+        "end_time": end_time,
+        "throwaway_time": throwaway_time(rule, start_time),
+        **{f"class_{alias}": column for column, alias in aliases.items()},
+    }
+    return query, parameters
+
+
+def _anomaly_batch(rows: List[tuple], graph: pd.DataFrame, rule: Rule, metadata: Optional[pd.DataFrame]) -> AnomalyBatch:
+    if not rows:
+        return AnomalyBatch.empty(rule_id=rule.rule_id)
+    intervals = pd.DataFrame(rows, columns=["componentURI", "start_time", "end_time"])
+    components = intervals["componentURI"].unique()
+    if metadata is None:
+        metadata = component_metadata(graph=graph, components=components, sensor_types=rule.sensor_types)
+    else:
+        metadata = metadata.reindex(components)
+    intervals = intervals.join(metadata, on="componentURI")
+    logger.debug(f"rule {rule.rule_id}: {len(intervals)} anomalies found in Postgres")
+
+    return AnomalyBatch(
+        start_time=pd.DatetimeIndex(pd.to_datetime(intervals["start_time"], utc=True)).to_pydatetime(),
+        end_time=pd.DatetimeIndex(pd.to_datetime(intervals["end_time"], utc=True)).to_pydatetime(),
+        rule_id=rule.rule_id,
+        points=intervals["points"].to_numpy(),
+        metadata=intervals["metadata"].to_numpy(),
+        components=intervals["componentURI"].to_numpy(dtype=object),
+    )
+
+
+def find_anomalies_in_database(
+    conn: Connection,
+    graph: pd.DataFrame,
+    rule: Rule,
+    start_time: str | datetime,
+    end_time: str | datetime,
+    metadata: Optional[pd.DataFrame] = None,
+) -> AnomalyBatch:
+    """
+    Runs a whole rule in Postgres over the readings between start_time and end_time. Gives the same anomalies as analyze_data over the
+    same readings, but only the merged intervals are transferred. Check evaluates_in_database before calling it. metadata is the
+    rule's precomputed RuleView.metadata, without it the points and metadata of the anomalies are built from graph.
+    """
+    query, parameters = rule_query(graph, rule, start_time, end_time)
+    with conn.cursor() as cur:
+        cur.execute(query, parameters)
+        rows = cur.fetchall()
+        conn.commit()
+    return _anomaly_batch(rows, graph, rule, metadata)
+
+
+async def find_anomalies_in_database_async(
+    conn: AsyncConnection,
+    graph: pd.DataFrame,
+    rule: Rule,
+    start_time: str | datetime,
+    end_time: str | datetime,
+    metadata: Optional[pd.DataFrame] = None,
+) -> AnomalyBatch:
+    """Same as find_anomalies_in_database, but awaits the query on an async connection so other rules can run while it is in flight"""
+    query, parameters = rule_query(graph, rule, start_time, end_time)
+    async with conn.cursor() as cur:
+        await cur.execute(query, parameters)
+        rows = await cur.fetchall()
+        await conn.commit()
+    return _anomaly_batch(rows, graph, rule, metadata)
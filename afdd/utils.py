@@ -1,8 +1,11 @@
 from rdflib import Graph, Literal, URIRef
 from datetime import datetime, timedelta, timezone
+import json
+import numpy as np
 import pandas as pd
-from afdd.models import Anomaly, Metadata
-from typing import List
+from afdd.graph import identifier_codes
+from afdd.models import Anomaly, AnomalyBatch, Metadata, Rule
+from typing import List, Optional
 
 
 def load_graph(devices: str) -> pd.DataFrame:
@@ -130,3 +133,85 @@ def create_anomaly(row, component, device, rule_id: int, points: List[URIRef]) -
     )
     anomaly_tuple = anomaly.to_tuple()
     return anomaly_tuple
+
+
+def merge_intervals(components: pd.Index, start_time: pd.Index, end_time: pd.Index) -> pd.DataFrame:
+    """
+    Combines overlapping [start_time, end_time] intervals of the same component in one pass over all components. The inputs have to be
+    sorted by component and then by start_time, like the hits of a rolling mean dataframe (their windows all have the same length).
+
+    Returns:
+        pd.DataFrame: A dataframe with one row per merged interval and the columns componentURI, start_time and end_time
+    """
+    intervals = pd.DataFrame({"componentURI": components, "start_time": start_time, "end_time": end_time})
+    same_component = intervals["componentURI"] == intervals["componentURI"].shift(1)
+    # an interval can lie inside an earlier one, so it is compared with the latest end so far
+    latest_end = intervals.groupby("componentURI", sort=False, observed=True)["end_time"].cummax()
+    overlaps_previous = intervals["start_time"] <= latest_end.shift(1)
+    interval_id = (~(same_component & overlaps_previous)).cumsum()
+    return intervals.groupby(interval_id).agg({"componentURI": "first", "start_time": "min", "end_time": "max"}).reset_index(drop=True)
+
+
+def component_metadata(graph: pd.DataFrame, components: np.ndarray, sensor_types: List[str]) -> pd.DataFrame:
+    """
+    Builds the JSON encoded points and metadata columns of the anomalies table for the given components.
+
+    Returns:
+        pd.DataFrame: A dataframe indexed by componentURI with the columns:
+            - points: JSON list of the URIs of the component's points that have one of the sensor_types
+            - metadata: JSON object with the device and the component
+    """
+    # the graph rows are matched to the components by their codes, only the devices and points that end up in the JSON are decoded
+    component_codes, component_uris = identifier_codes(graph["componentURI"])
+    component = np.append(pd.Index(components).get_indexer(component_uris), -1)[component_codes]
+    rows = np.flatnonzero(component >= 0)
+
+    # the device of a component is the one of its first graph row
+    first_components, first_rows = np.unique(component[rows], return_index=True)
+    devices = np.full(len(components), None, dtype=object)
+    devices[first_components] = graph["deviceURI"].to_numpy(dtype=object)[rows[first_rows]]
+
+    # points of the sensor types, grouped by component in graph order
+    rows = rows[graph["class"].isin(sensor_types).to_numpy()[rows]]
+    rows = rows[np.argsort(component[rows], kind="stable")]
+    points = graph["point"].to_numpy(dtype=object)[rows]
+    counts = np.bincount(component[rows], minlength=len(components))
+    ends = np.cumsum(counts)
+
+    metadata = pd.DataFrame(index=pd.Index(components, name="componentURI"))
+    metadata["points"] = [json.dumps(points[start:end].tolist()) for start, end in zip(ends - counts, ends)]
+    metadata["metadata"] = [
+        json.dumps(Metadata(device=None if pd.isna(device) else device, component=component).to_dict())
+        for component, device in zip(components, devices)
+    ]
+    return metadata
+
+
+def hit_intervals(hits: pd.MultiIndex, rule: Rule) -> pd.DataFrame:
+    """Merges the (componentURI, ts) hits of a rule, each the end of a window of duration seconds, into anomaly intervals"""
+    end_time = hits.get_level_values("ts")
+    return merge_intervals(
+        components=hits.get_level_values(0),
+        start_time=end_time - timedelta(seconds=rule.condition.duration),
+        end_time=end_time,
+    )
+
+
+def anomaly_batch(graph: pd.DataFrame, intervals: pd.DataFrame, rule: Rule, metadata: Optional[pd.DataFrame] = None) -> AnomalyBatch:
+    """Joins the points and metadata of their components onto anomaly intervals"""
+    # points and metadata are encoded once per component and joined onto every interval of that component
+    components = intervals["componentURI"].unique()
+    if metadata is None:
+        metadata = component_metadata(graph=graph, components=components, sensor_types=rule.sensor_types)
+    else:
+        metadata = metadata.reindex(components)
+    intervals = intervals.join(metadata, on="componentURI")
+
+    return AnomalyBatch(
+        start_time=pd.DatetimeIndex(intervals["start_time"]).to_pydatetime(),
+        end_time=pd.DatetimeIndex(intervals["end_time"]).to_pydatetime(),
+        rule_id=rule.rule_id,
+        points=intervals["points"].to_numpy(),
+        metadata=intervals["metadata"].to_numpy(),
+        components=intervals["componentURI"].to_numpy(dtype=object),
+    )
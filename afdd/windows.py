@@ -0,0 +1,366 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from afdd.instrumentation import stage_timer
+from afdd.logger import logger
+from afdd.snapshots import snapshots_enabled, write_snapshot
+from afdd.kernels import sketch_bins, sliding_quantiles
+from afdd.models import BucketAggregates, Metric, Rule
+from afdd.planner import rule_resample_size
+from afdd.utils import round_time
+
+ROLLING_WINDOW = 5  # number of resample buckets in each rolling window
+
+# partial aggregates of the metrics whose buckets Postgres can aggregate, by metric value (see afdd.db.fetch_bucket_aggregates)
+DATABASE_PARTIALS = {Metric.AVERAGE.value: ("sum", "count"), Metric.MAX.value: ("max",), Metric.MIN.value: ("min",)}
+
+
+def bucket_partials(timeseries_data: pd.DataFrame, resample_size: int, metric: Metric) -> Dict[str, pd.DataFrame]:
+    """
+    Normalizes the timestamps of a (componentURI, ts) indexed dataframe to buckets of resample_size seconds and reduces every bucket to
+    the partial aggregates the metric needs: sums and counts for AVERAGE, the maximum for MAX, the minimum for MIN and a quantile sketch
+    for the percentile metrics. Partial aggregates of the same bucket can be combined with combine_partials, so a bucket that is still
+    filling up can be carried over to the next cycle. Buckets are aligned to the epoch so that the same bucket boundaries are used no
+    matter where a fetch window starts, and buckets without any readings are left out.
+    """
+    if metric.quantile is not None:
+        return {"sketch": bucket_sketches(timeseries_data, resample_size)}
+
+    resampler = timeseries_data.groupby(level=0).resample(f"{resample_size}s", level=1, origin="epoch")
+    counts = resampler.count()
+    occupied = counts.sum(axis=1) > 0
+
+    if metric is Metric.AVERAGE:
+        partials = {"sum": resampler.sum(), "count": counts}
+    elif metric is Metric.MAX:
+        partials = {"max": resampler.max()}
+    else:
+        partials = {"min": resampler.min()}
+    return {name: partial.loc[occupied] for name, partial in partials.items()}
+
+
+def bucket_sketches(timeseries_data: pd.DataFrame, resample_size: int) -> pd.DataFrame:
+    """
+    The quantile sketch of every column in every occupied bucket: how many of its readings fall into each bin (see kernels.sketch_bins),
+    indexed by (componentURI, ts, bin). The readings of all buckets are binned and counted at once.
+    """
+    values = timeseries_data.to_numpy(dtype=float)
+    rows, columns = np.nonzero(~np.isnan(values))
+    index = timeseries_data.index
+    readings = pd.DataFrame({
+        index.names[0]: index.get_level_values(0)[rows],
+        index.names[1]: index.get_level_values(1)[rows].floor(f"{resample_size}s"),
+        "bin": sketch_bins(values[rows, columns]),
+        "column": columns,
+    })
+    counts = readings.groupby([*index.names, "bin", "column"], observed=True).size().unstack("column", fill_value=0)
+    counts = counts.reindex(columns=range(values.shape[1]), fill_value=0)
+    counts.columns = timeseries_data.columns
+    return counts
+
+
+def combine_partials(partials: Dict[str, pd.DataFrame], other: Dict[str, pd.DataFrame], metric: Metric) -> Dict[str, pd.DataFrame]:
+    """Combines two sets of partial aggregates, adding up the buckets (and the bins of the sketches) that appear in both"""
+    combined = {}
+    for name, partial in partials.items():
+        grouped = pd.concat([partial, other[name]]).groupby(level=list(range(partial.index.nlevels)))
+        if name == "max":
+            combined[name] = grouped.max()
+        elif name == "min":
+            combined[name] = grouped.min()
+        else:
+            combined[name] = grouped.sum()
+    return combined
+
+
+def bucket_values(partials: Dict[str, pd.DataFrame], resample_size: int, metric: Metric) -> pd.DataFrame:
+    """
+    Turns partial aggregates into one value per bucket (the mean, maximum, minimum or quantile sketch of the bucket). Empty buckets are
+    filled in with NaN (or an empty sketch) so that a rolling window over ROLLING_WINDOW buckets always covers the same amount of time.
+    """
+    if metric is Metric.AVERAGE:
+        values = partials["sum"] / partials["count"].where(partials["count"] > 0)
+    else:
+        (values,) = partials.values()
+    return fill_buckets(values, resample_size, metric)
+
+
+def fill_buckets(values: pd.DataFrame, resample_size: int, metric: Metric) -> pd.DataFrame:
+    """Adds the empty buckets between the first and the last bucket of every component to the bucket values of a metric"""
+    if metric.quantile is None:
+        return values.groupby(level=0).resample(f"{resample_size}s", level=1, origin="epoch").first()
+    buckets = values.index.droplevel(2).unique()
+    grid = pd.Series(0, index=buckets).groupby(level=0).resample(f"{resample_size}s", level=1, origin="epoch").first().index
+    return pd.concat([values, empty_buckets(values, grid.difference(buckets), metric)]).sort_index()
+
+
+def empty_buckets(values: pd.DataFrame, buckets: pd.MultiIndex, metric: Metric) -> pd.DataFrame:
+    """Bucket values of a metric for (componentURI, ts) buckets without any readings: NaN, or a sketch with a single empty bin"""
+    if metric.quantile is None:
+        return pd.DataFrame(index=buckets.set_names(values.index.names), columns=values.columns).astype(values.dtypes)
+    index = pd.MultiIndex.from_arrays(
+        [buckets.get_level_values(0), buckets.get_level_values(1), np.zeros(len(buckets), dtype=np.int64)], names=values.index.names
+    )
+    return pd.DataFrame(0, index=index, columns=values.columns)
+
+
+def rolling_window(values: pd.DataFrame, metric: Metric) -> pd.DataFrame:
+    """Computes the metric over the last ROLLING_WINDOW buckets of each component"""
+    if metric.quantile is not None:
+        return sliding_quantiles(values, ROLLING_WINDOW, metric.quantile)
+    rolling = values.groupby(level=0).rolling(window=ROLLING_WINDOW, min_periods=1)
+    if metric is Metric.AVERAGE:
+        return rolling.mean().droplevel(level=0)
+    if metric is Metric.MAX:
+        return rolling.max().droplevel(level=0)
+    return rolling.min().droplevel(level=0)
+
+
+def throwaway_time(rule: Rule, start_time: str | datetime) -> datetime:
+    """The first bucket after start_time whose rolling window only contains data loaded from start_time onwards"""
+    rounded_start = round_time(time=start_time, resample_size=rule_resample_size(rule))  # start time rounded to the nearest normalized time
+    return rounded_start + timedelta(seconds=int(rule.condition.duration))
+
+
+def batch_window(timeseries_data: pd.DataFrame, rule: Rule, start_time: str | datetime) -> pd.DataFrame:
+    """
+    Computes the rolling metric of a rule from scratch for data loaded from start_time onwards, throwing away the first few buckets
+    that aren't full windows.
+    """
+    if snapshots_enabled(rule.rule_id):
+        write_snapshot("raw", timeseries_data, rule.rule_id)
+
+    resample_size = rule_resample_size(rule)
+    metric = rule.condition.metric
+    with stage_timer("resample", rule.rule_id):
+        resampled = bucket_values(bucket_partials(timeseries_data, resample_size, metric), resample_size, metric)
+    return _window_from_values(resampled, rule, start_time)
+
+
+def partials_window(partials: Dict[str, pd.DataFrame], rule: Rule, start_time: str | datetime) -> pd.DataFrame:
+    """Same as batch_window for buckets that were already reduced to partial aggregates, e.g. by Postgres (see database_partials)"""
+    resample_size = rule_resample_size(rule)
+    with stage_timer("resample", rule.rule_id):
+        resampled = bucket_values(partials, resample_size, rule.condition.metric)
+    return _window_from_values(resampled, rule, start_time)
+
+
+def _window_from_values(resampled: pd.DataFrame, rule: Rule, start_time: str | datetime) -> pd.DataFrame:
+    throwaway_at_start = throwaway_time(rule, start_time)
+    logger.debug(f"throwaway time: {throwaway_at_start}")
+    if snapshots_enabled(rule.rule_id):
+        write_snapshot("resampled", resampled, rule.rule_id)
+
+    with stage_timer("rolling", rule.rule_id):
+        rolling_mean = rolling_window(resampled, rule.condition.metric)
+
+    # filter out rows where timestamp is before cutoff_time
+    rolling_mean = rolling_mean.loc[rolling_mean.index.get_level_values("ts") >= throwaway_at_start]
+    if snapshots_enabled(rule.rule_id):
+        write_snapshot("rolling", rolling_mean, rule.rule_id)
+    return rolling_mean
+
+
+def resamples_in_database(metric: Metric) -> bool:
+    """
+    Whether the buckets of a metric can be aggregated by Postgres. Sums, counts, minimums and maximums can be combined across
+    timeseriesids and cycles; the quantile sketches of the percentile metrics are always built from the raw readings.
+    """
+    return metric.value in DATABASE_PARTIALS
+
+
+def database_partials(aggregates: BucketAggregates, metric: Metric) -> Dict[str, pd.DataFrame]:
+    """Picks the partial aggregates a metric needs out of the buckets Postgres aggregated, in the layout of bucket_partials"""
+    return {name: aggregates.partials[name] for name in DATABASE_PARTIALS[metric.value]}
+
+
+@dataclass
+class IncrementalWindow:
+    """
+    Rolling window state of one rule that is carried from one cycle to the next.
+
+    Instead of re-reading an overlap window every cycle, the per-component partial aggregates (see bucket_partials) of the last
+    ROLLING_WINDOW resample buckets are kept in memory. Each cycle only needs the data newer than the watermark (the newest timestamp already folded into the buckets);
+    the new readings are combined with the carried buckets and the rolling metric is recomputed for the buckets that changed. The results are
+    the same as running batch_window over the whole history.
+    """
+
+    rule: Rule
+    watermark: Optional[pd.Timestamp] = None
+    partials: Optional[Dict[str, pd.DataFrame]] = field(default=None, repr=False)
+    # throwaway time of the first cycle, no bucket before it is ever emitted
+    first_bucket: Optional[pd.Timestamp] = None
+
+    @property
+    def resample_size(self) -> int:
+        return rule_resample_size(self.rule)
+
+    @property
+    def metric(self) -> Metric:
+        return self.rule.condition.metric
+
+    def fetch_start(self, default_start: datetime) -> datetime:
+        """Where this cycle's fetch has to start: the watermark once there is state, otherwise the usual overlapping window"""
+        if self.watermark is None:
+            return default_start
+        return self.watermark.to_pydatetime()
+
+    def update(self, timeseries_data: pd.DataFrame, start_time: datetime) -> pd.DataFrame:
+        """
+        Folds the readings newer than the watermark into the carried buckets and returns the rolling metric of every bucket that changed.
+        On the first cycle this behaves exactly like batch_window with the same start_time.
+        """
+        if self.watermark is None:
+            if timeseries_data.empty:
+                # e.g. a shard without any components, the first cycle with readings starts the state
+                return timeseries_data
+            rolling_mean = batch_window(timeseries_data, self.rule, start_time)
+            self.first_bucket = pd.Timestamp(throwaway_time(self.rule, start_time))
+            self._carry(timeseries_data)
+            return rolling_mean
+
+        ts = timeseries_data.index.get_level_values("ts")
+        new_data = timeseries_data.loc[ts > self.watermark]
+        if new_data.empty:
+            return new_data
+
+        with stage_timer("resample", self.rule.rule_id):
+            new_partials = bucket_partials(new_data, self.resample_size, self.metric)
+        if snapshots_enabled(self.rule.rule_id):
+            write_snapshot("raw", new_data, self.rule.rule_id)
+        return self._fold(new_partials, new_data.index.get_level_values("ts").max())
+
+    def database_fetch_start(self, default_start: datetime) -> datetime:
+        """
+        Where this cycle's bucket aggregate query has to start. Postgres aggregates the readings before they arrive, so they can't be
+        filtered by the watermark afterwards; the query starts right after it instead (timestamps have microsecond precision).
+        """
+        if self.watermark is None:
+            return default_start
+        return (self.watermark + pd.Timedelta(microseconds=1)).to_pydatetime()
+
+    def update_partials(self, partials: Dict[str, pd.DataFrame], watermark: Optional[pd.Timestamp], start_time: datetime) -> pd.DataFrame:
+        """
+        Same as update for buckets that Postgres already aggregated (see database_partials). The partials must only hold readings loaded
+        from database_fetch_start onwards, and watermark is the newest of them.
+        """
+        if watermark is None:
+            # no buckets, e.g. a quiet sensor or a shard without any components; on the first cycle the first one with buckets starts the state
+            return next(iter(partials.values()))
+        if self.watermark is None:
+            rolling_mean = partials_window(partials, self.rule, start_time)
+            self.first_bucket = pd.Timestamp(throwaway_time(self.rule, start_time))
+            self.partials = partials
+            self.watermark = watermark
+            self._trim()
+            return rolling_mean
+        return self._fold(partials, watermark)
+
+    def forget(self, components) -> None:
+        """Drops the carried buckets of components that are no longer in the rule's graph, so they aren't folded or kept any longer"""
+        if self.partials is None or not len(components):
+            return
+        self.partials = {
+            name: partial.loc[~partial.index.get_level_values(0).isin(components)] for name, partial in self.partials.items()
+        }
+
+    def next_buckets(self) -> pd.Series:
+        """
+        The first bucket of every carried component that hasn't been emitted yet. A later cycle emits no rows before it, but may emit the
+        rows between it and its first new bucket once the component has readings again.
+        """
+        if self.partials is None:
+            return pd.Series(dtype=object)
+        carried = next(iter(self.partials.values())).index
+        last_carried = pd.Series(carried.get_level_values(1), index=carried.get_level_values(0)).groupby(level=0, observed=True).max()
+        return last_carried + pd.Timedelta(seconds=self.resample_size)
+
+    def absorb(self, partials: Dict[str, pd.DataFrame]) -> None:
+        """
+        Takes over the carried buckets of a window that ran over a later, adjacent time range (e.g. the next partition of a parallel
+        backfill). Buckets both windows carry were aggregated from the same readings and are kept once.
+        """
+        if self.partials is not None:
+            partials = {name: pd.concat([self.partials[name], partial]) for name, partial in partials.items()}
+            partials = {name: partial.loc[~partial.index.duplicated(keep="last")].sort_index() for name, partial in partials.items()}
+        if next(iter(partials.values())).empty:
+            return
+        self.partials = partials
+        self._trim()
+
+    def gap_rows(self, resume: pd.Series) -> pd.DataFrame:
+        """
+        The rolling metric of the empty buckets between every carried component's last bucket and the bucket of its next reading (resume,
+        by component, which isn't included). These are the rows a full pass has over a gap in a component's readings.
+        """
+        next_buckets = self.next_buckets()
+        components = next_buckets.index.intersection(resume.index)
+        if not len(components):
+            return pd.DataFrame()
+        partials = {name: partial.loc[partial.index.get_level_values(0).isin(components)] for name, partial in self.partials.items()}
+        values = bucket_values(partials, self.resample_size, self.metric)
+        resume_buckets = pd.Series(pd.DatetimeIndex(resume.loc[components]).floor(f"{self.resample_size}s"), index=components)
+        # an empty bucket where the readings resume makes the resampling fill in the whole gap
+        placeholder = empty_buckets(values, pd.MultiIndex.from_arrays([components, resume_buckets.to_numpy()]), self.metric)
+        values = fill_buckets(pd.concat([values, placeholder]).sort_index(), self.resample_size, self.metric)
+
+        rolling_mean = rolling_window(values, self.metric)
+        ts = rolling_mean.index.get_level_values("ts")
+        owners = rolling_mean.index.get_level_values(0)
+        in_gap = (ts >= owners.map(next_buckets)) & (ts < owners.map(resume_buckets))
+        if self.first_bucket is not None:
+            in_gap &= ts >= self.first_bucket
+        return rolling_mean.loc[in_gap]
+
+    def _fold(self, new_partials: Dict[str, pd.DataFrame], newest: pd.Timestamp) -> pd.DataFrame:
+        """Combines the partials of new readings with the carried buckets and returns the rolling metric of the buckets that changed"""
+        # rows up to the last carried bucket of every component were emitted on an earlier cycle; the rows after it over empty buckets
+        # weren't, since a full pass only has them once the component has readings again
+        after_carried = self.next_buckets()
+        with stage_timer("resample", self.rule.rule_id):
+            self.partials = combine_partials(self.partials, new_partials, self.metric)
+            values = bucket_values(self.partials, self.resample_size, self.metric)
+        # first bucket touched by this cycle for every component, it has to be emitted again if it was still filling up
+        new_buckets = next(iter(new_partials.values())).index
+        first_new_bucket = pd.Series(new_buckets.get_level_values(1), index=new_buckets.get_level_values(0)).groupby(level=0).min()
+        after_carried = after_carried.reindex(first_new_bucket.index)
+        first_changed = first_new_bucket.where(after_carried.isna() | (first_new_bucket < after_carried), after_carried)
+        self.watermark = max(self.watermark, newest)
+
+        with stage_timer("rolling", self.rule.rule_id):
+            rolling_mean = rolling_window(values, self.metric)
+        ts = rolling_mean.index.get_level_values("ts")
+        cutoff = rolling_mean.index.get_level_values(0).map(first_changed)
+        emitted = ts >= cutoff
+        if self.first_bucket is not None:
+            emitted &= ts >= self.first_bucket
+        rolling_mean = rolling_mean.loc[emitted]
+        logger.debug(f"incremental rolling {self.metric.value} for rule {self.rule.rule_id}: {len(rolling_mean)} buckets changed")
+        if snapshots_enabled(self.rule.rule_id):
+            write_snapshot("resampled", values, self.rule.rule_id)
+            write_snapshot("rolling", rolling_mean, self.rule.rule_id)
+
+        self._trim()
+        return rolling_mean
+
+    def _carry(self, timeseries_data: pd.DataFrame) -> None:
+        if timeseries_data.empty:
+            return
+        self.partials = bucket_partials(timeseries_data, self.resample_size, self.metric)
+        self.watermark = timeseries_data.index.get_level_values("ts").max()
+        self._trim()
+
+    def _trim(self) -> None:
+        """
+        Only the last ROLLING_WINDOW buckets of every component (including the bucket that is still filling up) are needed for the next
+        cycle. They are kept per component, so a component that stops reporting still has its windows when its readings come back.
+        """
+        index = next(iter(self.partials.values())).index
+        buckets = pd.Series(index.get_level_values("ts"), index=index.get_level_values(0))
+        oldest = buckets.groupby(level=0).transform("max") - pd.Timedelta(seconds=self.resample_size * (ROLLING_WINDOW - 1))
+        keep = (buckets >= oldest).to_numpy()
+        self.partials = {name: partial.loc[keep] for name, partial in self.partials.items()}
@@ -0,0 +1,123 @@
+import argparse
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import psycopg
+from dotenv import load_dotenv
+
+from afdd.db import _timeseries_query, copy_timeseries, load_timeseries, pivot_timeseries
+
+BRICK_CLASSES = ["CO2_Sensor", "PM10_Level_Sensor", "PM25_Level_Sensor"]
+START_TIME = pd.Timestamp("2000-01-01", tz="UTC")
+
+
+def load_timeseries_rows(conn, graph, start_time, end_time, brick_list) -> pd.DataFrame:
+    """The row based path load_timeseries used before the columnar fetch: fetchall into tuples, then merge and pivot_table"""
+    query, parameters = _timeseries_query(graph, start_time, end_time, brick_list)
+    with conn.cursor() as cur:
+        cur.execute(query, parameters)
+        rows = cur.fetchall()
+        conn.commit()
+    return pivot_timeseries(rows, graph)
+
+
+PATHS = {"rows": load_timeseries_rows, "columnar": load_timeseries}
+
+
+def benchmark_graph(points: int) -> pd.DataFrame:
+    """Three sensors per component, the timeseriesids are prefixed so the benchmark never touches real readings"""
+    return pd.DataFrame({
+        "class": [BRICK_CLASSES[i % len(BRICK_CLASSES)] for i in range(points)],
+        "timeseriesid": [f"benchmark-{i}" for i in range(points)],
+        "componentURI": [f"benchmark-component-{i // len(BRICK_CLASSES)}" for i in range(points)],
+    })
+
+
+def max_rss_bytes() -> int:
+    """Peak resident memory of the process, which also counts what libpq and numpy allocate outside of tracemalloc's view"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def time_path(path: str, conn_string: str, graph: pd.DataFrame, end_time: pd.Timestamp) -> float:
+    with psycopg.connect(conn_string) as conn:
+        start = time.perf_counter()
+        PATHS[path](conn, graph, START_TIME, end_time, BRICK_CLASSES)
+        return time.perf_counter() - start
+
+
+def measure_path_memory(path: str, conn_string: str, graph: pd.DataFrame, end_time: pd.Timestamp) -> dict:
+    """Memory is measured in a separate run because tracemalloc slows down every allocation, which would distort the timings"""
+    with psycopg.connect(conn_string) as conn:
+        rss_before = max_rss_bytes()
+        tracemalloc.start()
+        df = PATHS[path](conn, graph, START_TIME, end_time, BRICK_CLASSES)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "traced_peak_mb": traced_peak / 2**20,
+        "rss_growth_mb": (max_rss_bytes() - rss_before) / 2**20,
+        "rows": len(df),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares time and peak memory of the row based and columnar load_timeseries paths.")
+    parser.add_argument("--readings", type=int, default=1_000_000, help="number of synthetic readings to load")
+    parser.add_argument("--points", type=int, default=300, help="number of synthetic timeseriesids")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per path, the fastest run is reported")
+    args = parser.parse_args()
+
+    env_files = {"local": ".env", "dev": ".env.dev"}
+
+    load_dotenv()
+    try:
+        env_file = env_files[os.environ["ENV"]]
+    except KeyError:
+        env_file = env_files["local"]
+    load_dotenv(env_file, override=True)
+
+    conn_string = os.environ["POSTGRES_CONNECTION_STRING"]
+    graph = benchmark_graph(args.points)
+    readings_per_point = args.readings // args.points
+    end_time = START_TIME + pd.Timedelta(minutes=readings_per_point)
+
+    rng = np.random.default_rng(0)
+    with psycopg.connect(conn_string) as conn:
+        stats = copy_timeseries(
+            conn,
+            (
+                {
+                    "ts": pd.date_range(START_TIME, periods=readings_per_point, freq="min"),
+                    "value": rng.uniform(0, 2000, readings_per_point),
+                    "timeseriesid": timeseriesid,
+                }
+                for timeseriesid in graph["timeseriesid"]
+            ),
+        )
+        print(f"loaded {stats.rows} readings at {stats.rows_per_second:.0f} rows/s")
+
+        try:
+            results = []
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn"), max_tasks_per_child=1) as executor:
+                # every run gets a fresh process, so that the peak RSS of one path doesn't hide the other
+                for path in PATHS:
+                    seconds = min(executor.submit(time_path, path, conn_string, graph, end_time).result() for _ in range(args.repeat))
+                    memory = executor.submit(measure_path_memory, path, conn_string, graph, end_time).result()
+                    results.append({"path": path, "seconds": seconds, **memory})
+            print(pd.DataFrame(results).set_index("path").round(3).to_string())
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM timeseries WHERE timeseriesid LIKE 'benchmark-%'")
+            conn.commit()
+
+
+if __name__ == "__main__":
+    main()
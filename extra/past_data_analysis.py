@@ -1,6 +1,8 @@
 import argparse
-from rdflib import Graph
+from datetime import datetime
+from typing import Dict, List, Optional
 from psycopg import Connection
+import pandas as pd
 import psycopg
 import os
 import json
@@ -8,10 +10,9 @@ from afdd.logger import logger
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
 
-from afdd.models import Rule, Condition, Metric, Severity
-from afdd.db import load_timeseries, append_past_anomalies, load_graph_neo4j
-from afdd.main import analyze_data
-from afdd.utils import load_graph
+from afdd.models import AnomalyBatch
+from afdd.db import append_past_anomalies, get_rules, load_graph_index
+from afdd.backfill import DEFAULT_CHUNK_SECONDS, backfill, parallel_backfill
 
 
 def analyze_past_data(
@@ -19,87 +20,98 @@ def analyze_past_data(
     driver: GraphDatabase.driver,
     start_time: str,
     end_time: str,
-    rule_id: int,
+    rule_ids: List[int],
+    chunk_hours: float = DEFAULT_CHUNK_SECONDS / 3600,
+    processes: int = 1,
+    conninfo: Optional[str] = None,
 ):
     """
-    Creates a json file with all anomalies that happened between start and end time for a specified rule and appends them to Postgresql anomalies table
+    Creates a json file per rule with all anomalies that happened between start and end time for the specified rules and appends them to
+    Postgresql anomalies table. The range is analyzed in chunks of chunk_hours, so only one chunk of readings is in memory at a time.
+    With more than one process, the components and the range are split between a pool of processes that connect to conninfo.
     """
     logger.info("---------------------------------------------------------------------------------")
     logger.info(f"*** STARTED ANALYZING PAST DATA FROM {start_time} to {end_time} ***")
 
-    # create rule object by querying rules table using rule_id
-    query = """SELECT * FROM rules WHERE rule_id=%s"""
-
-    with conn.cursor() as cur:
-        cur.execute(query, (rule_id,))
-        result = cur.fetchone()
-        # print(f"query result: {result}")
-        # result = result[0]
-        # print(type(result[5]))
-
-    rule_object = Rule(
-        rule_id=result[0],
-        name=result[1],
-        component_type=result[4],
-        sensor_types=result[5],
-        description=result[2],
-        condition=Condition(
-            equation=result[3]["equation"],
-            metric=Metric[result[3]["metric"].upper()],
-            duration=result[3]["duration"],
-            sleep_time=result[3]["sleep_time"],
-            severity=Severity[result[3]["severity"].upper()],
-        ),
+    # create rule objects from the rules table
+    rules_list = [rule for rule in get_rules(conn=conn) if rule.rule_id in rule_ids]
+    missing = set(rule_ids) - {rule.rule_id for rule in rules_list}
+    if missing:
+        raise ValueError(f"Rules {sorted(missing)} don't exist")
+
+    # Load graph data for every rule's component type
+    graph_index = load_graph_index(driver=driver, rules_list=rules_list, close_driver=False)
+    logger.info(f"graph: {len(graph_index.graph)} rows, {graph_index.graph['componentURI'].nunique()} components")
+
+    anomalies_by_rule: Dict[int, List[tuple]] = {rule.rule_id: [] for rule in rules_list}
+    new_anomalies = 0
+
+    def write(anomalies: AnomalyBatch):
+        nonlocal new_anomalies
+        anomalies_list = anomalies.to_tuples()
+        anomalies_by_rule[anomalies.rule_id].extend(anomalies_list)
+        # anomalies found by an earlier run over the same range are skipped
+        new_anomalies += append_past_anomalies(conn=conn, anomaly_list=anomalies_list)
+
+    # AFDD_EVALUATE_IN_DATABASE runs the whole rule in Postgres when its metric and equation allow it, only anomalies are transferred
+    arguments = dict(
+        graph_index=graph_index,
+        rules=rules_list,
+        start_time=parse_time(start_time),
+        end_time=parse_time(end_time),
+        write=write,
+        chunk_seconds=int(chunk_hours * 3600),
+        evaluate_in_database=os.environ.get("AFDD_EVALUATE_IN_DATABASE", "").lower() in ("1", "true", "yes"),
     )
-
-    # Load graph data into dataframe
-    graph = load_graph_neo4j(driver=driver, component_class=rule_object.component_type)
-    logger.info(f"graph dataframe: \n {graph.to_string()}")
-
-    brick_list = rule_object.sensor_types
-    timeseries_df = load_timeseries(
-        conn=conn,
-        graph=graph,
-        start_time=start_time,
-        end_time=end_time,
-        brick_list=brick_list,
-    )
-    anomalies_list = analyze_data(
-        graph=graph,
-        start_time=start_time,
-        timeseries_data=timeseries_df,
-        rule=rule_object,
-    )
-
-    # convert the anomalies list of tuples to a list of dictionaries in order to make it a json file
-    dict_list = []
-    for anomaly in anomalies_list:
-        dict = {
-            "start_time": str(anomaly[0]),
-            "end_time": str(anomaly[1]),
-            "rule_id": anomaly[2],
-            "points": anomaly[3],
-            "metadata": anomaly[4],
-        }
-        dict_list.append(dict)
-
-    # taking colons out of times because they can't be used in filenames on windows
-    start_time_no_colon = start_time.replace(":", "")
-    end_time_no_colon = end_time.replace(":", "")
-    file_name = f"{start_time_no_colon}_to_{end_time_no_colon}_anomalies_{rule_id}.json"
-    with open(file_name, "w") as f:
-        json.dump(dict_list, f, indent=3)
-
-    append_past_anomalies(conn=conn, anomaly_list=anomalies_list)
-
-    return f"Report file generated: {file_name}"
+    if processes > 1:
+        progress = parallel_backfill(conninfo=conninfo, processes=processes, **arguments)
+    else:
+        progress = backfill(conn=conn, **arguments)
+    logger.info(f"*** ANALYZED {progress.rows} READINGS IN {progress.elapsed:.1f}s ({progress.rows_per_second:.0f} READINGS/s) ***")
+    logger.info(f"*** {progress.anomalies} ANOMALIES FOUND, {new_anomalies} OF THEM NEW ***")
+
+    file_names = []
+    for rule_id, anomalies_list in anomalies_by_rule.items():
+        # convert the anomalies list of tuples to a list of dictionaries in order to make it a json file
+        dict_list = []
+        for anomaly in anomalies_list:
+            dict = {
+                "start_time": str(anomaly[0]),
+                "end_time": str(anomaly[1]),
+                "rule_id": anomaly[2],
+                "points": anomaly[3],
+                "metadata": anomaly[4],
+            }
+            dict_list.append(dict)
+
+        # taking colons out of times because they can't be used in filenames on windows
+        start_time_no_colon = start_time.replace(":", "")
+        end_time_no_colon = end_time.replace(":", "")
+        file_name = f"{start_time_no_colon}_to_{end_time_no_colon}_anomalies_{rule_id}.json"
+        with open(file_name, "w") as f:
+            json.dump(dict_list, f, indent=3)
+        file_names.append(file_name)
+
+    return f"Report files generated: {', '.join(file_names)}"
+
+
+def parse_time(time: str) -> datetime:
+    """Parses an iso formatted time, times without a timezone are taken as UTC"""
+    timestamp = pd.Timestamp(time)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp.to_pydatetime()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Analyze past timeseries data for anomalies.")
     parser.add_argument("--start_time", required=True, help="start time in iso format")
     parser.add_argument("--end_time", required=True, help="end time in iso format")
-    parser.add_argument("--rule_id", required=True, help="id of desired rule to be run")
+    parser.add_argument("--rule_id", required=True, help="id of desired rule to be run, or comma separated ids of several rules")
+    parser.add_argument(
+        "--chunk_hours", type=float, default=DEFAULT_CHUNK_SECONDS / 3600, help="hours of readings analyzed at a time (default 24)"
+    )
+    parser.add_argument("--processes", type=int, default=1, help="number of processes to analyze with (default 1)")
     args = parser.parse_args()
 
     env_files = {"local": ".env", "dev": ".env.dev"}
@@ -126,7 +138,10 @@ def main():
         driver=neo4j_driver,
         start_time=args.start_time,
         end_time=args.end_time,
-        rule_id=args.rule_id,
+        rule_ids=[int(rule_id) for rule_id in args.rule_id.split(",")],
+        chunk_hours=args.chunk_hours,
+        processes=args.processes,
+        conninfo=postgres_conn_string,
     )
     neo4j_driver.close()
 
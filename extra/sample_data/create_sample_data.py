@@ -4,9 +4,13 @@ import psycopg
 import os
 import asyncio
 import logging
+from dataclasses import asdict
+
+import pandas as pd
 
 from afdd.models import PointReading
-from afdd.db import insert_timeseries
+from afdd.db import copy_timeseries, insert_timeseries
+from afdd.migrations import migrate
 
 timeseriesid_co2_1 = [
     "8493663d-21bf-4fa7-ba8a-163308655319-co2",
@@ -78,7 +82,8 @@ def create_24h_data():
             )
         )
         start_time += datetime.timedelta(minutes=5)
-    insert_timeseries(conn=conn, data=point_reading_list)
+    stats = copy_timeseries(conn=conn, data=pd.DataFrame([asdict(reading) for reading in point_reading_list]))
+    logging.info(f"loaded {stats.rows} readings in {stats.seconds:.2f} seconds")
 
 
 async def start():
@@ -91,8 +96,11 @@ async def start():
 
 
 def main():
+    # the sample data can start before the service does, so it brings the schema up to date itself
+    migrate(conn)
     asyncio.run(start())
 
 
 if __name__ == "__main__":
+    migrate(conn)
     create_24h_data()
@@ -1,51 +1,37 @@
+import argparse
 import psycopg
 import os
 from dotenv import load_dotenv
 
+from afdd.migrations import MIGRATIONS, applied_versions, migrate
+
 
 def main():
-    """Sets up rules and anomalies table if they're not already there."""
+    """Creates or upgrades the timeseries, rules and anomalies tables by applying the pending schema migrations."""
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations.")
+    parser.add_argument("--target", type=int, help="stop after this migration version (default: apply all)")
+    parser.add_argument("--status", action="store_true", help="list the migrations and whether they're applied, without applying any")
+    args = parser.parse_args()
+
     env_files = {"local": ".env", "dev": ".env.dev"}
 
     load_dotenv()
     try:
         env_file = env_files[os.environ["ENV"]]
-    except KeyError as e:
+    except KeyError:
         env_file = env_files["local"]
     load_dotenv(env_file, override=True)
 
     postgres_conn_string = os.environ["POSTGRES_CONNECTION_STRING"]
-    conn = psycopg.connect(postgres_conn_string)
-
-    create_rules_query = """CREATE TABLE IF NOT EXISTS rules (
-  rule_id INT PRIMARY KEY,
-  name TEXT NOT NULL,
-  sensor_type TEXT NOT NULL,
-  description TEXT NOT NULL,
-  condition jsonb NOT NULL
-  )"""
-    create_anomalies_query = """CREATE TABLE IF NOT EXISTS anomalies (
-  start_time TIMESTAMPTZ NOT NULL,
-  end_time TIMESTAMPTZ NOT NULL,
-  rule_id INT,
-  anomaly_id INT GENERATED ALWAYS AS IDENTITY,
-  value FLOAT NOT NULL,
-  timeseriesid TEXT NOT NULL,
-  metadata jsonb NOT NULL,
-  PRIMARY KEY(anomaly_id),
-  CONSTRAINT fk_rules
-    FOREIGN KEY(rule_id) 
-      REFERENCES rules(rule_id)
-  );"""
-
-    try:
-        with conn.cursor() as cur:
-            cur.execute(create_rules_query)
-            cur.execute(create_anomalies_query)
-            conn.commit()
-
-    except Exception as e:
-        raise e
+    with psycopg.connect(postgres_conn_string) as conn:
+        if args.status:
+            applied = applied_versions(conn)
+            for migration in MIGRATIONS:
+                print(f"{migration.version:>4} {'applied' if migration.version in applied else 'pending':<8} {migration.name}")
+            return
+
+        migrations = migrate(conn, target=args.target)
+    print(f"applied {len(migrations)} migrations: {[migration.version for migration in migrations]}")
 
 
 if __name__ == "__main__":
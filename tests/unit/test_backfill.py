@@ -0,0 +1,160 @@
+import pickle
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from afdd.backfill import (
+    INTERVAL_COLUMNS,
+    BackfillProgress,
+    PartitionResult,
+    backfill_chunks,
+    backfill_partitions,
+    chunk_alignment,
+    close_intervals,
+    rule_hits,
+    stitch_partitions,
+)
+from afdd.utils import hit_intervals
+from afdd.models import Condition, Metric, Rule, Severity
+from afdd.windows import IncrementalWindow, batch_window
+
+
+def make_rule(rule_id: int, duration: int, equation: str = "CO2_Sensor > 1000") -> Rule:
+    return Rule(
+        rule_id=rule_id,
+        name="rule",
+        component_type="AHU",
+        sensor_types=["CO2_Sensor"],
+        description="",
+        condition=Condition(equation=equation, metric=Metric.AVERAGE, duration=duration, sleep_time=1800, severity=Severity.HIGH),
+    )
+
+
+def make_intervals(*rows):
+    return pd.DataFrame(
+        [(component, pd.Timestamp(start, tz="UTC"), pd.Timestamp(end, tz="UTC")) for component, start, end in rows], columns=INTERVAL_COLUMNS
+    )
+
+
+def test_chunk_alignment_is_a_multiple_of_every_resample_size():
+    assert chunk_alignment([make_rule(1, 600), make_rule(2, 3600)]) == 900
+    assert chunk_alignment([make_rule(1, 600)]) == 150
+
+
+def test_backfill_chunks_end_on_aligned_boundaries():
+    start = datetime(2024, 10, 1, 0, 20, tzinfo=timezone.utc)
+    end = datetime(2024, 10, 1, 3, 5, tzinfo=timezone.utc)
+
+    chunks = backfill_chunks(start, end, chunk_seconds=3700, alignment=900)
+
+    assert chunks[0] == (start, datetime(2024, 10, 1, 1, 15, tzinfo=timezone.utc) - timedelta(microseconds=1))
+    assert [chunk_start for chunk_start, _ in chunks[1:]] == [
+        datetime(2024, 10, 1, 1, 15, tzinfo=timezone.utc),
+        datetime(2024, 10, 1, 2, 15, tzinfo=timezone.utc),
+    ]
+    assert chunks[-1][1] == end
+    assert backfill_chunks(start, end, chunk_seconds=86400, alignment=900) == [(start, end)]
+
+
+def test_close_intervals_keeps_the_ones_a_later_chunk_can_extend_open():
+    open_intervals = make_intervals(("c1", "2024-10-01 00:00", "2024-10-01 00:50"))
+    new_intervals = make_intervals(
+        ("c1", "2024-10-01 00:45", "2024-10-01 01:00"),
+        ("c2", "2024-10-01 00:10", "2024-10-01 00:20"),
+        ("c2", "2024-10-01 00:55", "2024-10-01 01:00"),
+    )
+    cutoff = pd.Timestamp("2024-10-01 00:50", tz="UTC")
+
+    closed, still_open = close_intervals(open_intervals, new_intervals, cutoff)
+
+    assert closed.values.tolist() == make_intervals(("c2", "2024-10-01 00:10", "2024-10-01 00:20")).values.tolist()
+    assert still_open.values.tolist() == make_intervals(
+        ("c1", "2024-10-01 00:00", "2024-10-01 01:00"), ("c2", "2024-10-01 00:55", "2024-10-01 01:00")
+    ).values.tolist()
+    closed, still_open = close_intervals(still_open, new_intervals.iloc[:0], None)
+    assert len(closed) == 2 and still_open.empty
+
+
+def test_close_intervals_waits_for_components_whose_readings_stopped():
+    new_intervals = make_intervals(("c1", "2024-10-01 00:10", "2024-10-01 00:20"), ("c2", "2024-10-01 00:10", "2024-10-01 00:20"))
+    cutoff = pd.Timestamp("2024-10-01 00:50", tz="UTC")
+    # c1's last bucket was at 00:15, its rows from 00:17:30 on can still be emitted once it reports again
+    component_cutoffs = pd.Series([pd.Timestamp("2024-10-01 00:07:30", tz="UTC")], index=["c1"])
+
+    closed, still_open = close_intervals(new_intervals.iloc[:0], new_intervals, cutoff, component_cutoffs=component_cutoffs)
+
+    assert closed["componentURI"].tolist() == ["c2"]
+    assert still_open["componentURI"].tolist() == ["c1"]
+
+
+def test_backfill_partitions_load_a_window_before_their_start():
+    start = datetime(2024, 10, 1, 0, 0, 7, tzinfo=timezone.utc)
+    end = datetime(2024, 10, 1, 6, 0, tzinfo=timezone.utc)
+
+    partitions = backfill_partitions(start, end, [make_rule(1, 600), make_rule(2, 3600)], partitions=3)
+
+    assert [partition_start for partition_start, _, _ in partitions] == [
+        start,
+        datetime(2024, 10, 1, 2, 0, tzinfo=timezone.utc),
+        datetime(2024, 10, 1, 4, 0, tzinfo=timezone.utc),
+    ]
+    assert partitions[0][2] == start
+    assert [load_start for _, _, load_start in partitions[1:]] == [
+        datetime(2024, 10, 1, 1, 0, tzinfo=timezone.utc),
+        datetime(2024, 10, 1, 3, 0, tzinfo=timezone.utc),
+    ]
+    assert partitions[-1][1] == end
+
+
+@pytest.mark.parametrize("equation", ["CO2_Sensor > 1100", "CO2_Sensor != 1000"])
+def test_stitched_partitions_match_one_pass(equation):
+    rule = make_rule(1, 600, equation)
+    start = datetime(2024, 10, 1, 0, 0, 7, tzinfo=timezone.utc)
+    end = datetime(2024, 10, 1, 6, 0, tzinfo=timezone.utc)
+    rng = np.random.default_rng(0)
+    frames = []
+    for component in ("c1", "c2"):
+        ts = pd.date_range(start, end, freq="20s")
+        frames.append(pd.DataFrame({"componentURI": component, "ts": ts, "CO2_Sensor": rng.integers(800, 1300, size=len(ts)).astype(float)}))
+    data = pd.concat(frames).set_index(["componentURI", "ts"]).sort_index()
+    ts = data.index.get_level_values("ts")
+    # c1 stops reporting from before the first partition edge until after the second one
+    gap = (data.index.get_level_values(0) == "c1") & (ts >= "2024-10-01 01:50") & (ts < "2024-10-01 04:20")
+    data = data.loc[~gap]
+    ts = data.index.get_level_values("ts")
+    expected = hit_intervals(hits=rule_hits(batch_window(data, rule, start), rule), rule=rule)
+
+    results = []
+    for number, (partition_start, partition_end, load_start) in enumerate(backfill_partitions(start, end, [rule], partitions=3)):
+        window = IncrementalWindow(rule=rule)
+        loaded = data.loc[(ts >= load_start) & (ts <= partition_end)]
+        rolling_mean = window.update(loaded, load_start)
+        loaded_ts = loaded.index.get_level_values("ts")
+        resumes = pd.Series(loaded_ts, index=loaded.index.get_level_values(0))[loaded_ts >= partition_start].groupby(level=0).min()
+        results.append(
+            PartitionResult(
+                shard=0,
+                partition=number,
+                intervals={1: hit_intervals(hits=rule_hits(rolling_mean, rule), rule=rule)},
+                partials={1: window.partials},
+                resumes={1: resumes},
+                progress=BackfillProgress(chunks_done=1, chunks_total=1, covered_until=partition_end),
+            )
+        )
+
+    stitched = stitch_partitions(results[::-1], [rule], start)[1]
+
+    assert stitched.values.tolist() == expected.values.tolist()
+
+
+def test_rules_are_sent_to_worker_processes_without_their_compiled_equation():
+    rule = make_rule(1, 600)
+    rule.condition.evaluator()
+
+    copy = pickle.loads(pickle.dumps(rule))
+
+    assert copy == rule
+    assert copy.condition.compiled is None
+    assert rule.condition.compiled is not None
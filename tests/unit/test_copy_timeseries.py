@@ -0,0 +1,57 @@
+import struct
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from afdd.db import _timeseries_chunks, encode_timeseries_copy
+
+
+def decode_rows(payload: bytes):
+    """Reads rows of the Postgres binary COPY format back into (ts, value, timeseriesid) tuples"""
+    rows = []
+    offset = 0
+    while offset < len(payload):
+        (fields,) = struct.unpack_from("!h", payload, offset)
+        assert fields == 3
+        _, ts, _, value, id_len = struct.unpack_from("!iqidi", payload, offset + 2)
+        offset += 2 + 4 + 8 + 4 + 8 + 4
+        timeseriesid = payload[offset : offset + id_len].decode()
+        offset += id_len
+        rows.append((datetime(2000, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=ts), value, timeseriesid))
+    return rows
+
+
+def test_encode_timeseries_copy_round_trips():
+    data = pd.DataFrame({
+        "ts": ["2024-10-24T12:00:00", "2024-10-24T12:00:00.5", "1999-12-31T23:59:59"],
+        "value": [100.0, -1.25, np.nan],
+        "timeseriesid": ["ts1", "a-much-longer-timeseries-id", "ts1"],
+    })
+
+    rows = decode_rows(encode_timeseries_copy(data))
+
+    assert rows[0] == (datetime(2024, 10, 24, 12, tzinfo=timezone.utc), 100.0, "ts1")
+    assert rows[1] == (datetime(2024, 10, 24, 12, 0, 0, 500000, tzinfo=timezone.utc), -1.25, "a-much-longer-timeseries-id")
+    assert rows[2][0] == datetime(1999, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+    assert np.isnan(rows[2][1])
+    assert rows[2][2] == "ts1"
+
+
+def test_encode_timeseries_copy_writes_the_id_of_every_row():
+    rng = np.random.default_rng(0)
+    ids = np.array([f"sensör-{i}-{'x' * (i % 5)}" for i in range(500)])[rng.integers(0, 500, size=2000)]
+    data = pd.DataFrame({"ts": ["2024-10-24T12:00:00"] * 2000, "value": np.arange(2000.0), "timeseriesid": ids})
+
+    rows = decode_rows(encode_timeseries_copy(data))
+
+    assert [timeseriesid for _, _, timeseriesid in rows] == ids.tolist()
+    assert [value for _, value, _ in rows] == data["value"].tolist()
+
+
+def test_timeseries_chunks_accepts_frames_dicts_and_iterables():
+    frame = pd.DataFrame({"ts": ["2024-10-24T12:00:00"] * 5, "value": range(5), "timeseriesid": ["ts1"] * 5})
+
+    assert [len(chunk) for chunk in _timeseries_chunks(frame, 2)] == [2, 2, 1]
+    assert [len(chunk) for chunk in _timeseries_chunks(frame.to_dict("list"), 10)] == [5]
+    assert [len(chunk) for chunk in _timeseries_chunks(iter([frame, frame.iloc[:3]]), 4)] == [4, 1, 3]
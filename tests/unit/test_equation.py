@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from afdd.equation import EquationError, compile_equation
+
+
+@pytest.mark.parametrize(
+    "equation",
+    [
+        "1000 < CO2_Sensor < 1500",
+        "CO2_Sensor > 1500",
+        "(PM25_Level_Sensor + PM10_Level_Sensor) > 70",
+        "PM25_Level_Sensor > 35 and not PM10_Level_Sensor > 150",
+        "PM25_Level_Sensor > 35 or PM10_Level_Sensor * 2 >= 150",
+        "abs(PM25_Level_Sensor - PM10_Level_Sensor) > 10",
+    ],
+)
+def test_compiled_equation_matches_pandas_eval(equation):
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame(
+        {
+            "CO2_Sensor": rng.integers(800, 1800, size=200).astype(float),
+            "PM25_Level_Sensor": rng.integers(0, 80, size=200).astype(float),
+            "PM10_Level_Sensor": rng.integers(0, 200, size=200).astype(float),
+        }
+    )
+    frame.iloc[::7] = np.nan
+
+    compiled = compile_equation(equation)
+
+    expected = frame.eval(equation).to_numpy()
+    np.testing.assert_array_equal(compiled.evaluate(frame), expected)
+
+
+def test_compile_equation_derives_columns():
+    compiled = compile_equation("(PM25_Level_Sensor + PM10_Level_Sensor) > 70 and PM25_Level_Sensor < 500")
+
+    assert compiled.columns == ("PM25_Level_Sensor", "PM10_Level_Sensor")
+
+
+def test_compile_equation_rejects_unknown_sensor():
+    with pytest.raises(EquationError, match="CO2_Sensr"):
+        compile_equation("CO2_Sensr > 1500", sensor_types=["CO2_Sensor"])
+
+
+@pytest.mark.parametrize("equation", ["CO2_Sensor >", "__import__('os')", "CO2_Sensor.real > 1", "'a' < CO2_Sensor", "1 > 0"])
+def test_compile_equation_rejects_invalid_equations(equation):
+    with pytest.raises(EquationError):
+        compile_equation(equation)
+
+
+def test_missing_column_evaluates_to_false():
+    compiled = compile_equation("CO2_Sensor > 1500")
+
+    assert not compiled.evaluate(pd.DataFrame({"PM10_Level_Sensor": [1.0, 2.0]})).any()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from afdd.db import pivot_timeseries, pivot_timeseries_columns
+from afdd.db import brick_class_uri
+from afdd.graph import (
+    IdentifierEncoder,
+    brick_timeseries_ids,
+    graph_timeseries_ids,
+    identifier_codes,
+    intern_graph,
+    timeseries_positions,
+)
+from afdd.models import TimeseriesColumns
+
+
+def make_graph():
+    return pd.DataFrame({
+        "point": ["p1", "p2", "p3", "p3"],
+        "class": ["PM10_Level_Sensor", "CO2_Sensor", "CO2_Sensor", "CO2_Sensor"],
+        "timeseriesid": [" pm10-1", "co2-1 ", "co2-2", "co2-2"],
+        "deviceURI": ["d1", "d1", "d2", "d2"],
+        "componentURI": ["component2", "component2", "component1", "component1"],
+    })
+
+
+def test_intern_graph_encodes_identifiers_without_touching_the_input():
+    graph = make_graph()
+
+    interned = intern_graph(graph)
+
+    assert len(interned) == 3
+    assert all(isinstance(interned[column].dtype, pd.CategoricalDtype) for column in interned.columns)
+    assert interned["timeseriesid"].tolist() == ["pm10-1", "co2-1", "co2-2"]
+    assert graph["timeseriesid"].tolist() == [" pm10-1", "co2-1 ", "co2-2", "co2-2"]
+
+
+def test_identifier_helpers_match_on_plain_and_interned_graphs():
+    graph = make_graph().drop_duplicates()
+    interned = intern_graph(graph)
+
+    for column in ("componentURI", "class"):
+        plain_codes, plain_values = identifier_codes(graph[column])
+        codes, values = identifier_codes(interned[column])
+        assert values.tolist() == sorted(values.tolist())
+        assert values[codes].tolist() == plain_values[plain_codes].tolist() == graph[column].tolist()
+
+    assert graph_timeseries_ids(graph).tolist() == graph_timeseries_ids(interned).tolist() == ["pm10-1", "co2-1", "co2-2"]
+    ids = brick_timeseries_ids(interned, ["CO2_Sensor"])
+    assert ids.tolist() == ["co2-1", "co2-2"]
+    assert timeseries_positions(interned, ids).tolist() == timeseries_positions(graph, ids).tolist() == [-1, 0, 1]
+
+
+def test_pivots_give_the_same_frame_for_an_interned_graph():
+    graph = make_graph()
+    ts = pd.to_datetime(["2024-10-24T12:00:00", "2024-10-24T12:00:00", "2024-10-24T12:05:00"], utc=True)
+    timeseries_ids = np.array(["co2-1", "co2-2", "pm10-1"], dtype=object)
+    columns = TimeseriesColumns(
+        ts=ts.asi8, value=np.array([400.0, 410.0, 20.0]), point=np.array([0, 1, 2], dtype=np.int32), timeseries_ids=timeseries_ids
+    )
+
+    expected = pivot_timeseries(list(zip(ts, columns.value, timeseries_ids)), graph)
+    result = pivot_timeseries_columns(columns, intern_graph(graph))
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert result.index.levels[0].dtype == object
+    # pivot_timeseries strips a copy of the timeseriesids instead of the caller's graph
+    assert graph["timeseriesid"].tolist()[0] == " pm10-1"
+
+
+def test_identifier_encoder_interns_pages_like_intern_graph():
+    encoder = IdentifierEncoder()
+    encoder.extend(["component2", "component1", None])
+    encoder.extend(["component2", "component3"])
+
+    column = pd.Series(encoder.to_categorical())
+
+    assert column.cat.categories.tolist() == ["component1", "component2", "component3"]
+    assert column.tolist()[:2] == ["component2", "component1"] and pd.isna(column[2])
+    assert column.tolist()[3:] == ["component2", "component3"]
+
+
+def test_brick_class_uri():
+    assert brick_class_uri("IAQ_Sensor_Equipment") == "https://brickschema.org/schema/Brick#IAQ_Sensor_Equipment"
+    assert brick_class_uri("https://example.com/schema#AHU") == "https://example.com/schema#AHU"
@@ -0,0 +1,44 @@
+import os
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from afdd.graph import intern_graph
+from afdd.graph_cache import graph_cache_path, read_graph_cache, write_graph_cache
+
+
+def make_graph():
+    return intern_graph(
+        pd.DataFrame({
+            "point": ["p1", "p2", "p3"],
+            "class": ["CO2_Sensor", "PM10_Level_Sensor", "CO2_Sensor"],
+            "timeseriesid": ["co2-1", "pm10-1", "co2-2"],
+            "deviceURI": ["d1", "d1", "d2"],
+            "componentURI": ["ahu1", "ahu1", "vav1"],
+            "component_type": ["AHU", "AHU", "VAV"],
+        })
+    )
+
+
+def test_graph_cache_round_trips_the_interned_graph(tmp_path):
+    graph = make_graph()
+    loaded_at = datetime(2024, 10, 24, 12, tzinfo=timezone.utc)
+
+    path = write_graph_cache(str(tmp_path), graph, ["VAV", "AHU"], loaded_at=loaded_at)
+    cached = read_graph_cache(str(tmp_path), {"AHU", "VAV"})
+
+    assert path == graph_cache_path(str(tmp_path), ["AHU", "VAV"])
+    assert not os.path.exists(f"{path}.tmp")
+    pd.testing.assert_frame_equal(cached.graph, graph)
+    assert cached.loaded_at == loaded_at
+    assert cached.age > 0
+
+
+def test_graph_cache_misses(tmp_path):
+    write_graph_cache(str(tmp_path), make_graph(), ["AHU", "VAV"])
+
+    assert read_graph_cache(str(tmp_path), ["AHU"]) is None
+
+    with open(graph_cache_path(str(tmp_path), ["AHU"]), "wb") as file:
+        file.write(b"not parquet")
+    assert read_graph_cache(str(tmp_path), ["AHU"]) is None
@@ -0,0 +1,205 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pytest
+
+from afdd.db import BRICK_NAMESPACE, load_graph_index
+from afdd.graph import brick_timeseries_ids, timeseries_positions
+from afdd.graph_index import GraphIndex, GraphStore, component_shards, diff_graphs, shard_index
+from afdd.main import forget_removed_components, refresh_graph_periodically
+from afdd.windows import IncrementalWindow
+from afdd.models import Condition, Metric, Rule, Severity
+from afdd.utils import component_metadata
+
+
+def make_rule(rule_id: int, component_type: str, equation: str) -> Rule:
+    return Rule(
+        rule_id=rule_id,
+        name="rule",
+        component_type=component_type,
+        sensor_types=["CO2_Sensor", "PM10_Level_Sensor"],
+        description="",
+        condition=Condition(equation=equation, metric=Metric.AVERAGE, duration=600, sleep_time=1800, severity=Severity.HIGH),
+    )
+
+
+def make_component_graphs():
+    ahu = pd.DataFrame({
+        "point": ["p1", "p2", "p3", "p4"],
+        "class": ["brick#CO2_Sensor", "brick#PM10_Level_Sensor", "brick#CO2_Sensor", "brick#Zone_Air_Temperature_Sensor"],
+        "timeseriesid": ["co2-1", " pm10-1", "co2-2", "temp-1"],
+        "deviceURI": ["d1", "d1", "d2", "d2"],
+        "componentURI": ["ahu1", "ahu1", "ahu2", "ahu2"],
+    })
+    vav = pd.DataFrame({
+        "point": ["p5"],
+        "class": ["brick#CO2_Sensor"],
+        "timeseriesid": ["co2-3"],
+        "deviceURI": ["d3"],
+        "componentURI": ["vav1"],
+    })
+    return {"AHU": ahu, "VAV": vav, "Empty": pd.DataFrame()}
+
+
+def test_scope_only_holds_the_sensors_of_the_component_type():
+    rules = [make_rule(1, "AHU", "CO2_Sensor > 1000"), make_rule(2, "VAV", "CO2_Sensor > 1000")]
+    index = GraphIndex.from_component_graphs(make_component_graphs(), rules)
+
+    ahu = index.scope("AHU", ["CO2_Sensor"])
+    assert ahu["componentURI"].tolist() == ["ahu1", "ahu2"]
+    assert ahu["componentURI"].cat.categories.tolist() == ["ahu1", "ahu2"]
+    assert index.timeseries_ids("AHU", ["CO2_Sensor"]).tolist() == ["co2-1", "co2-2"]
+    assert index.timeseries_ids("VAV", ["CO2_Sensor"]).tolist() == ["co2-3"]
+    # the precomputed positions are the ones a fetch would look up from the scope
+    ids = index.timeseries_ids("AHU", ["CO2_Sensor", "PM10_Level_Sensor"])
+    scope = index.scope("AHU", ["CO2_Sensor", "PM10_Level_Sensor"])
+    assert index.timeseries_positions("AHU", ["CO2_Sensor", "PM10_Level_Sensor"]).tolist() == timeseries_positions(scope, ids).tolist()
+    assert sorted(ids.tolist()) == sorted(brick_timeseries_ids(scope, ["CO2_Sensor", "PM10_Level_Sensor"]).tolist())
+    assert index.scope("AHU", ["CO2_Sensor"]) is index.view(rules[0]).graph
+
+
+def test_view_metadata_matches_the_metadata_built_from_the_graph():
+    rule = make_rule(1, "AHU", "CO2_Sensor > 1000 or PM10_Level_Sensor > 50")
+    graphs = make_component_graphs()
+    index = GraphIndex.from_component_graphs(graphs, [rule])
+    graph = graphs["AHU"].assign(**{"class": graphs["AHU"]["class"].str.split("#").str[-1]})
+
+    view = index.view(rule)
+
+    pd.testing.assert_frame_equal(
+        view.metadata, component_metadata(graph=graph, components=["ahu1", "ahu2"], sensor_types=rule.sensor_types)
+    )
+    assert view.metadata.loc["ahu1", "points"] == '["p1", "p2"]'
+    assert index.rule_ids == [1]
+
+
+def test_shards_split_the_components_without_splitting_any_component():
+    rules = [make_rule(1, "AHU", "CO2_Sensor > 1000"), make_rule(2, "VAV", "CO2_Sensor > 1000")]
+    index = GraphIndex.from_component_graphs(make_component_graphs(), rules)
+
+    shards = [shard_index(index, rules, shard, 2) for shard in range(2)]
+
+    components = [set(shard.graph["componentURI"].dropna()) for shard in shards]
+    assert components[0] | components[1] == {"ahu1", "ahu2", "vav1"}
+    assert not components[0] & components[1]
+    assert sum(len(shard.graph) for shard in shards) == index.graph["componentURI"].notna().sum()
+    # the shard of a component only depends on its URI
+    assert (component_shards(index.graph["componentURI"], 2) == component_shards(index.graph["componentURI"].astype(str).astype("category"), 2)).all()
+
+
+def make_driver(records, page_size):
+    """A Neo4j driver mock whose session returns the records page by page"""
+    pages = [records[i : i + page_size] for i in range(0, len(records), page_size)] + [[]]
+    driver = MagicMock()
+    session = driver.session.return_value.__enter__.return_value
+    session.run.return_value.fetch.side_effect = pages
+    return driver
+
+
+def test_load_graph_index_streams_every_component_type_in_one_query_and_closes_the_driver():
+    records = [
+        (BRICK_NAMESPACE + component_type, *row)
+        for component_type, graph in make_component_graphs().items()
+        if not graph.empty
+        for row in graph.itertuples(index=False)
+    ]
+    driver = make_driver(records, page_size=2)
+    rules = [make_rule(1, "AHU", "CO2_Sensor > 1000"), make_rule(2, "VAV", "CO2_Sensor > 1000")]
+
+    with patch("afdd.db.GRAPH_PAGE_SIZE", 2):
+        index = load_graph_index(driver=driver, rules_list=rules)
+
+    session = driver.session.return_value.__enter__.return_value
+    session.run.assert_called_once()
+    assert sorted(session.run.call_args.kwargs["class_uris"]) == [BRICK_NAMESPACE + "AHU", BRICK_NAMESPACE + "VAV"]
+    assert index.graph["component_type"].value_counts().to_dict() == {"AHU": 4, "VAV": 1}
+    assert index.scope("AHU", ["CO2_Sensor"])["point"].tolist() == ["p1", "p3"]
+    driver.close.assert_called_once()
+
+
+def test_load_graph_index_without_raise_errors_builds_an_empty_index():
+    driver = MagicMock()
+    driver.session.side_effect = ConnectionError("neo4j is down")
+    rule = make_rule(1, "AHU", "CO2_Sensor > 1000")
+
+    index = load_graph_index(driver=driver, rules_list=[rule])
+
+    assert index.view(rule).graph.empty
+    with pytest.raises(ConnectionError):
+        load_graph_index(driver=driver, rules_list=[rule], raise_errors=True)
+
+
+def test_diff_graphs_finds_added_and_removed_components_and_points():
+    old = make_component_graphs()["AHU"]
+    new = pd.concat([old.iloc[:2], make_component_graphs()["VAV"]], ignore_index=True)
+    new.loc[0, "deviceURI"] = "d9"
+
+    diff = diff_graphs(old, new)
+
+    assert diff.added_components == ("vav1",)
+    assert diff.removed_components == ("ahu2",)
+    assert diff.added_points == ("p5",)
+    assert diff.removed_points == ("p3", "p4")
+    assert diff.changed_rows == 5
+    assert diff_graphs(old, old.iloc[::-1]).empty
+
+
+def test_refresh_swaps_in_a_changed_graph_and_the_windows_forget_removed_components():
+    rule = make_rule(1, "AHU", "CO2_Sensor > 1000")
+    graphs = make_component_graphs()
+    store = GraphStore(GraphIndex.from_component_graphs(graphs, [rule]))
+    first = store.index
+    refreshed = GraphIndex.from_component_graphs({"AHU": graphs["AHU"].iloc[:2]}, [rule])
+    loads = iter([first, refreshed])
+
+    async def refresh():
+        task = asyncio.create_task(refresh_graph_periodically(graph_store=store, load_graph=lambda: next(loads), interval=0.001))
+        while store.version == 0:
+            await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(refresh())
+    assert store.index is refreshed and store.version == 1
+
+    window = IncrementalWindow(rule=rule)
+    window.partials = {"sum": pd.DataFrame({"CO2_Sensor": [1.0, 2.0]}, index=pd.MultiIndex.from_tuples([("ahu1", 0), ("ahu2", 0)]))}
+    forget_removed_components(windows={1: window}, previous=first, current=store.index, rules=[rule])
+    assert window.partials["sum"].index.get_level_values(0).tolist() == ["ahu1"]
+
+
+def test_failed_refresh_keeps_the_current_graph():
+    rule = make_rule(1, "AHU", "CO2_Sensor > 1000")
+    store = GraphStore(GraphIndex.from_component_graphs(make_component_graphs(), [rule]))
+    first = store.index
+    attempts = []
+
+    def load_graph():
+        attempts.append(1)
+        raise ConnectionError("neo4j is down")
+
+    async def refresh():
+        task = asyncio.create_task(refresh_graph_periodically(graph_store=store, load_graph=load_graph, interval=0.001))
+        while len(attempts) < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+
+    asyncio.run(refresh())
+    assert store.index is first and store.version == 0
+
+
+def test_revalidation_checks_a_cached_graph_once_and_saves_it():
+    rule = make_rule(1, "AHU", "CO2_Sensor > 1000")
+    graphs = make_component_graphs()
+    store = GraphStore(GraphIndex.from_component_graphs({"AHU": graphs["AHU"].iloc[:2]}, [rule]))
+    loaded = GraphIndex.from_component_graphs(graphs, [rule])
+    saved = []
+
+    asyncio.run(
+        refresh_graph_periodically(graph_store=store, load_graph=lambda: loaded, interval=0, revalidate=True, save_graph=saved.append)
+    )
+
+    assert store.index is loaded
+    assert saved == [loaded]
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from afdd.instrumentation import LEASES_HELD, ROWS_FETCHED, rules_label, stage_timer, write_textfile_periodically
+
+
+def test_stage_timer_observes_the_stage_of_the_rules():
+    labels = {"stage": "query", "rules": "1,2"}
+    before = REGISTRY.get_sample_value("afdd_stage_duration_seconds_count", labels) or 0
+
+    with stage_timer("query", [1, 2]):
+        pass
+
+    assert REGISTRY.get_sample_value("afdd_stage_duration_seconds_count", labels) == before + 1
+
+
+def test_rules_label_joins_rule_ids():
+    assert rules_label([3, 1]) == "3,1"
+    assert rules_label(7) == "7"
+
+
+def test_textfile_holds_the_afdd_metrics(tmp_path):
+    ROWS_FETCHED.labels(rules="99").inc(3)
+    LEASES_HELD.set(2)
+    path = tmp_path / "afdd.prom"
+
+    with pytest.raises(asyncio.TimeoutError):
+        # the first file is written right away, the next one only after the interval
+        asyncio.run(asyncio.wait_for(write_textfile_periodically(str(path), interval=60), timeout=1))
+
+    lines = path.read_text().splitlines()
+    assert 'afdd_rows_fetched_total{rules="99"} 3.0' in lines
+    assert "afdd_leases_held 2.0" in lines
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from afdd.kernels import bin_values, sketch_bins, sliding_quantiles
+
+
+def sketches(buckets, components=None):
+    """Quantile sketches of the values of every bucket, indexed by (componentURI, ts, bin) like windows.bucket_sketches"""
+    components = components or ["component1"] * len(buckets)
+    frames = []
+    for position, (component, values) in enumerate(zip(components, buckets)):
+        bins, counts = np.unique(sketch_bins(np.asarray(values, dtype=float)), return_counts=True)
+        if not len(bins):
+            bins, counts = np.array([0]), np.array([0])
+        frames.append(pd.DataFrame({"componentURI": component, "ts": position, "bin": bins, "CO2_Sensor": counts}))
+    return pd.concat(frames).set_index(["componentURI", "ts", "bin"]).sort_index()
+
+
+def test_sketch_bins_sort_like_values_and_stay_within_relative_accuracy():
+    values = np.array([-1e6, -3.5, -1e-3, 0.0, 1e-3, 0.7, 1.0, 2.5, 1e9])
+
+    bins = sketch_bins(values)
+
+    assert (np.diff(bins) > 0).all()
+    np.testing.assert_allclose(bin_values(bins), values, rtol=0.01)
+    assert bin_values(bins)[3] == 0.0
+
+
+@pytest.mark.parametrize("q", [0.0, 0.5, 0.95, 1.0])
+def test_sliding_quantile_is_within_relative_accuracy(q):
+    rng = np.random.default_rng(2)
+    values = rng.lognormal(mean=6, sigma=1, size=10000)
+
+    result = sliding_quantiles(sketches([values]), window=5, q=q)
+
+    exact = np.quantile(values, q, method="lower")
+    assert abs(result["CO2_Sensor"].iloc[0] - exact) <= 0.01 * exact
+
+
+def test_sliding_quantile_of_merged_buckets_matches_one_bucket_of_all_values():
+    rng = np.random.default_rng(3)
+    first, second = rng.normal(size=1000), rng.normal(loc=5, size=1000)
+
+    merged = sliding_quantiles(sketches([first, second]), window=2, q=0.9)
+    both = sliding_quantiles(sketches([np.concatenate([first, second])]), window=1, q=0.9)
+
+    assert merged["CO2_Sensor"].iloc[1] == both["CO2_Sensor"].iloc[0]
+
+
+def test_sliding_quantile_skips_empty_buckets():
+    result = sliding_quantiles(sketches([[1.0, 2.0], [], [100.0]]), window=2, q=1.0)
+
+    assert result.index.tolist() == [("component1", 0), ("component1", 1), ("component1", 2)]
+    assert result["CO2_Sensor"].tolist() == pytest.approx([2.0, 2.0, 100.0], rel=0.01)
+
+
+def test_sliding_quantile_of_empty_window_is_nan():
+    result = sliding_quantiles(sketches([[1.0], [], []]), window=2, q=0.5)
+
+    assert np.isnan(result["CO2_Sensor"].iloc[2])
+
+
+def test_sliding_quantile_does_not_cross_components():
+    result = sliding_quantiles(sketches([[10.0], [1.0], [2.0], [3.0]], ["c1", "c1", "c2", "c2"]), window=5, q=1.0)
+
+    assert result["CO2_Sensor"].tolist() == pytest.approx([10.0, 10.0, 2.0, 3.0], rel=0.01)
@@ -0,0 +1,43 @@
+from afdd.leases import LeaseManager, LeaseUnit, rendezvous_owner
+from afdd.models import Condition, Metric, Rule, Severity
+from afdd.planner import plan_fetches
+
+
+def make_units(count):
+    return [LeaseUnit(rules=str(rule_id), shard=shard) for rule_id in range(count) for shard in range(4)]
+
+
+def test_lease_unit_of_a_fetch_group_uses_its_rules_label():
+    rules = [
+        Rule(
+            rule_id=rule_id,
+            name="CO2 High",
+            component_type="AHU",
+            sensor_types=["CO2_Sensor"],
+            description="",
+            condition=Condition(equation="CO2_Sensor > 1000", metric=Metric.AVERAGE, duration=600, sleep_time=1800, severity=Severity.HIGH),
+        )
+        for rule_id in (2, 1)
+    ]
+
+    assert LeaseUnit.of(plan_fetches(rules)[0], 3) == LeaseUnit(rules="1,2", shard=3)
+
+
+def test_rendezvous_owner_spreads_units_and_a_joining_worker_only_takes_its_own():
+    units = make_units(25)
+    before = {unit: rendezvous_owner(unit, ["a", "b"]) for unit in units}
+    after = {unit: rendezvous_owner(unit, ["c", "b", "a"]) for unit in units}
+
+    assert set(before.values()) == {"a", "b"}
+    assert set(after.values()) == {"a", "b", "c"}
+    # only units that now belong to the new worker changed hands
+    assert all(after[unit] in (before[unit], "c") for unit in units)
+    assert rendezvous_owner(units[0], []) is None
+
+
+def test_units_only_begin_while_their_lease_is_held():
+    unit = LeaseUnit(rules="1", shard=0)
+    leases = LeaseManager(pool=None, units=[unit], worker="a")
+
+    assert not leases.begin(unit)
+    assert leases.running == set()
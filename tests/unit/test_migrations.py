@@ -0,0 +1,15 @@
+from afdd.migrations import MIGRATIONS, pending_migrations
+
+
+def test_migration_versions_are_unique_and_ordered():
+    versions = [migration.version for migration in MIGRATIONS]
+
+    assert versions == sorted(set(versions))
+    assert versions[0] == 1
+
+
+def test_pending_migrations():
+    assert [migration.version for migration in pending_migrations([])] == [migration.version for migration in MIGRATIONS]
+    assert [migration.version for migration in pending_migrations([1, 3], target=3)] == [2]
+    assert [migration.version for migration in pending_migrations([1], target=2)] == [2]
+    assert pending_migrations([migration.version for migration in MIGRATIONS]) == []
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from afdd.models import AnomalyBatch, Condition, Metric, Rule, Severity
+from afdd.open_anomalies import OpenAnomalies
+
+
+def make_rule():
+    return Rule(
+        rule_id=1,
+        name="CO2 High",
+        component_type="AHU",
+        sensor_types=["CO2_Sensor"],
+        description="",
+        condition=Condition(equation="CO2_Sensor > 1000", metric=Metric.AVERAGE, duration=600, sleep_time=1800, severity=Severity.HIGH),
+    )
+
+
+def ts(time: str) -> pd.Timestamp:
+    return pd.Timestamp(f"2024-10-24 {time}", tz="UTC")
+
+
+def make_batch(*rows):
+    components, starts, ends = zip(*rows)
+    return AnomalyBatch(
+        start_time=np.array([ts(start).to_pydatetime() for start in starts], dtype=object),
+        end_time=np.array([ts(end).to_pydatetime() for end in ends], dtype=object),
+        rule_id=1,
+        points=np.array(["[]"] * len(rows), dtype=object),
+        metadata=np.array([f'{{"device": null, "component": "{component}"}}' for component in components], dtype=object),
+        components=np.array(components, dtype=object),
+    )
+
+
+def test_split_extends_open_anomalies_and_only_keeps_new_ones():
+    open_anomalies = OpenAnomalies(rule=make_rule())
+    open_anomalies.load([("c1", 7, ts("12:00"), ts("12:30")), ("c2", 8, ts("12:00"), ts("12:30"))])
+
+    writes = open_anomalies.split(
+        make_batch(
+            # c1: re-found inside its open anomaly, continued, then a new excursion
+            ("c1", "11:50", "12:20"),
+            ("c1", "12:25", "12:45"),
+            ("c1", "13:00", "13:10"),
+            # c2 stopped before this cycle's interval started, c3 has no open anomaly
+            ("c2", "12:35", "12:50"),
+            ("c3", "12:10", "12:20"),
+        )
+    )
+
+    assert writes.extensions == [(7, ts("12:45").to_pydatetime())]
+    assert writes.new.components.tolist() == ["c1", "c2", "c3"]
+    assert writes.new.start_time.tolist() == [ts(time).to_pydatetime() for time in ("13:00", "12:35", "12:10")]
+    assert writes.skipped == 1
+
+
+def test_record_keeps_the_latest_anomaly_of_every_component():
+    open_anomalies = OpenAnomalies(rule=make_rule())
+    open_anomalies.load([])
+    assert open_anomalies.loaded and open_anomalies.split(make_batch(("c1", "12:00", "12:10"))).extensions == []
+
+    open_anomalies.record([("c1", 1, ts("12:00"), ts("12:10")), ("c1", 2, ts("12:20"), ts("12:30"))])
+    open_anomalies.record([("c2", 3, ts("12:00"), ts("12:10"))])
+
+    assert open_anomalies.latest["anomaly_id"].to_dict() == {"c1": 2, "c2": 3}
+    writes = open_anomalies.split(make_batch(("c1", "12:25", "12:40")))
+    assert writes.extensions == [(2, ts("12:40").to_pydatetime())] and not len(writes.new)
+
+
+def test_forget_drops_open_anomalies_of_removed_components():
+    open_anomalies = OpenAnomalies(rule=make_rule())
+    open_anomalies.load([("c1", 1, ts("12:00"), ts("12:10")), ("c2", 2, ts("12:00"), ts("12:10"))])
+
+    open_anomalies.forget(["c2"])
+
+    assert open_anomalies.latest.index.tolist() == ["c1"]
+    assert len(open_anomalies.split(make_batch(("c2", "12:05", "12:20"))).new) == 1
@@ -0,0 +1,56 @@
+from afdd.models import Rule, Condition, Metric, Severity
+from afdd.planner import plan_fetches
+
+
+def make_rule(rule_id, sensor_types, duration=600, sleep_time=1800, component_type="IAQ_Sensor_Equipment"):
+    return Rule(
+        rule_id=rule_id,
+        name=f"Rule {rule_id}",
+        component_type=component_type,
+        sensor_types=sensor_types,
+        description="",
+        condition=Condition(
+            equation=" + ".join(sensor_types) + " > 0",
+            metric=Metric.AVERAGE,
+            duration=duration,
+            sleep_time=sleep_time,
+            severity=Severity.HIGH,
+        ),
+    )
+
+
+def test_plan_fetches_groups_rules_reading_same_sensors():
+    rules = [
+        make_rule(1, ["CO2_Sensor"]),
+        make_rule(2, ["CO2_Sensor"]),
+        make_rule(3, ["PM10_Level_Sensor"], duration=86400, sleep_time=86400),
+        make_rule(5, ["PM25_Level_Sensor", "PM10_Level_Sensor"], duration=86400, sleep_time=86400),
+        make_rule(6, ["CO2_Sensor"]),
+        make_rule(7, ["PM10_Level_Sensor", "PM25_Level_Sensor"], duration=3600, sleep_time=86400),
+    ]
+
+    groups = plan_fetches(rules)
+
+    assert [group.rule_ids for group in groups] == [[1, 2, 6], [3], [5, 7]]
+    assert groups[0].sensor_types == ["CO2_Sensor"]
+    assert groups[2].sensor_types == ["PM10_Level_Sensor", "PM25_Level_Sensor"]
+
+
+def test_plan_fetches_separates_component_types_and_cycles():
+    rules = [
+        make_rule(1, ["CO2_Sensor"]),
+        make_rule(2, ["CO2_Sensor"], component_type="AHU"),
+        make_rule(3, ["CO2_Sensor"], sleep_time=900),
+    ]
+
+    assert len(plan_fetches(rules)) == 3
+
+
+def test_plan_fetches_only_loads_columns_the_equation_reads():
+    rule = make_rule(1, ["PM25_Level_Sensor", "PM10_Level_Sensor"])
+    rule.condition.equation = "PM25_Level_Sensor > 35"
+
+    (group,) = plan_fetches([rule, make_rule(2, ["PM25_Level_Sensor"])])
+
+    assert group.sensor_types == ["PM25_Level_Sensor"]
+    assert group.rule_ids == [1, 2]
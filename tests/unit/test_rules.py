@@ -6,6 +6,7 @@ from contextlib import contextmanager
 
 from afdd.models import Rule, Metric, Severity
 from afdd.db import load_rules, get_rules
+from afdd.equation import EquationError
 
 # Test data
 SAMPLE_RULES_JSON = """[
@@ -142,3 +143,22 @@ def test_get_rules_empty_database(mock_connection):
 
     assert len(rules) == 0
     assert isinstance(rules, list)
+
+
+def test_get_rules_rejects_equation_with_unknown_sensor(mock_connection):
+    """Test that a typo in an equation's sensor name fails when the rules are loaded"""
+    conn, cursor = mock_connection
+
+    cursor.fetchall.return_value = [
+        (
+            1,
+            "CO2 High",
+            "Triggers when average CO2 level is between 1000 and 1500 ppm for 10 minutes",
+            {"equation": "1000 < CO2_Sensr < 1500", "metric": "average", "duration": 600, "sleep_time": 1800, "severity": "high"},
+            "IAQ_Sensor_Equipment",
+            ["CO2_Sensor"],
+        )
+    ]
+
+    with pytest.raises(EquationError):
+        get_rules(conn=conn)
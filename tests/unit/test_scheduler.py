@@ -0,0 +1,115 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from afdd.models import Condition, Metric, Rule, Severity
+from afdd.planner import plan_fetches
+from afdd.scheduler import Scheduler, Tick, backlog_ticks, group_period, last_boundary
+
+
+def make_group(duration=600, sleep_time=1800):
+    rule = Rule(
+        rule_id=1,
+        name="CO2 High",
+        component_type="AHU",
+        sensor_types=["CO2_Sensor"],
+        description="",
+        condition=Condition(equation="CO2_Sensor > 1000", metric=Metric.AVERAGE, duration=duration, sleep_time=sleep_time, severity=Severity.HIGH),
+    )
+    return plan_fetches([rule])[0]
+
+
+class FakeClock:
+    def __init__(self, now: datetime):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += timedelta(seconds=seconds)
+
+
+def run_cycles(scheduler: Scheduler, clock: FakeClock, group, cycle_seconds):
+    """Collects the ticks of a group whose cycles take cycle_seconds each"""
+
+    async def collect():
+        ticks = []
+        async for tick in scheduler.ticks(group):
+            ticks.append(tick)
+            if len(ticks) == len(cycle_seconds):
+                return ticks
+            clock.now += timedelta(seconds=cycle_seconds[len(ticks) - 1])
+
+    return asyncio.run(collect())
+
+
+def at(time: str) -> datetime:
+    return datetime.fromisoformat(f"2024-10-24T{time}+00:00")
+
+
+def test_group_period_is_rounded_up_to_a_bucket_boundary():
+    assert group_period(make_group(duration=600, sleep_time=1800)) == 1800
+    assert group_period(make_group(duration=600, sleep_time=100)) == 150
+    assert group_period(make_group(duration=3600, sleep_time=1000)) == 1800
+    assert last_boundary(at("12:44:59"), 900) == at("12:30:00")
+
+
+def test_ticks_are_aligned_and_do_not_drift():
+    clock = FakeClock(at("12:10:00"))
+    scheduler = Scheduler(jitter=0, clock=clock, sleep=clock.sleep)
+
+    ticks = run_cycles(scheduler, clock, make_group(), cycle_seconds=[200, 1700, 0])
+
+    # the first cycle covers the period that ended before the start, the slow second cycle doesn't shift the third
+    assert ticks == [
+        Tick(start_time=at("11:30:00"), end_time=at("12:00:00")),
+        Tick(start_time=at("12:00:00"), end_time=at("12:30:00")),
+        Tick(start_time=at("12:30:00"), end_time=at("13:00:00")),
+    ]
+    assert clock.sleeps == [1000, 100]
+
+
+def test_missed_boundaries_are_coalesced_into_one_catch_up_cycle():
+    clock = FakeClock(at("12:00:00"))
+    scheduler = Scheduler(jitter=0, clock=clock, sleep=clock.sleep)
+
+    ticks = run_cycles(scheduler, clock, make_group(), cycle_seconds=[5000, 0])
+
+    # the first cycle ran until 13:23:20, so 12:30 and 13:00 passed meanwhile
+    assert ticks[1] == Tick(start_time=at("12:00:00"), end_time=at("13:00:00"), missed=1)
+    assert ticks[1].seconds == 3600
+    assert clock.sleeps == []
+
+
+def test_jitter_delays_cycles_without_moving_their_window():
+    clock = FakeClock(at("12:00:00"))
+    scheduler = Scheduler(jitter=60, clock=clock, sleep=clock.sleep, rng=random.Random(0))
+
+    ticks = run_cycles(scheduler, clock, make_group(duration=600, sleep_time=300), cycle_seconds=[0, 0, 0])
+
+    # the jitter is capped at a tenth of the 300 second period
+    assert [tick.end_time for tick in ticks] == [at("12:00:00"), at("12:05:00"), at("12:10:00")]
+    # every cycle, the first one too, starts up to 30 seconds after its boundary
+    assert 0 < clock.sleeps[0] <= 30
+    assert 300 < sum(clock.sleeps[:2]) <= 330
+    assert 600 < sum(clock.sleeps) <= 630
+
+
+def test_backlog_is_split_into_aligned_batches():
+    tick = Tick(start_time=at("09:10:00"), end_time=at("13:00:00"), missed=7)
+
+    batches = backlog_ticks(tick, period=1800, batch_seconds=4000)
+
+    # 4000 seconds round down to two periods, the first batch ends on the next multiple of an hour after the watermark
+    assert batches == [
+        Tick(start_time=at("09:10:00"), end_time=at("10:00:00")),
+        Tick(start_time=at("10:00:00"), end_time=at("11:00:00")),
+        Tick(start_time=at("11:00:00"), end_time=at("12:00:00")),
+        Tick(start_time=at("12:00:00"), end_time=at("13:00:00"), missed=7),
+    ]
+    assert backlog_ticks(Tick(start_time=at("12:30:00"), end_time=at("13:00:00")), period=1800) == [
+        Tick(start_time=at("12:30:00"), end_time=at("13:00:00"))
+    ]
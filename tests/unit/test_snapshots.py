@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from afdd import snapshots
+from afdd.main import analyze_data
+from afdd.models import Rule, Condition, Metric, Severity
+from afdd.snapshots import SnapshotConfig, configure, write_snapshot
+
+
+@pytest.fixture(autouse=True)
+def reset_snapshots():
+    yield
+    configure(None)
+
+
+def make_data():
+    graph = pd.DataFrame(
+        {
+            "point": ["p1", "p2"],
+            "class": ["CO2_Sensor", "CO2_Sensor"],
+            "timeseriesid": ["ts1", "ts2"],
+            "deviceURI": ["d1", "d2"],
+            "componentURI": ["c1", "c2"],
+        }
+    )
+    start = datetime(2024, 10, 24, 12, 0, tzinfo=timezone.utc)
+    ts = [start + timedelta(seconds=30 * i) for i in range(60)]
+    timeseries_data = pd.DataFrame(
+        {"componentURI": ["c1"] * 60 + ["c2"] * 60, "ts": ts + ts, "CO2_Sensor": [1200.0] * 60 + [400.0] * 60}
+    ).set_index(["componentURI", "ts"])
+    rule = Rule(
+        rule_id=1,
+        name="CO2 High",
+        component_type="IAQ_Sensor_Equipment",
+        sensor_types=["CO2_Sensor"],
+        description="",
+        condition=Condition(equation="CO2_Sensor > 1000", metric=Metric.AVERAGE, duration=600, sleep_time=1800, severity=Severity.HIGH),
+    )
+    return graph, timeseries_data, rule, start
+
+
+def test_snapshots_are_written_for_enabled_rules_and_components(tmp_path):
+    graph, timeseries_data, rule, start = make_data()
+    configure(SnapshotConfig(directory=str(tmp_path), rule_ids=frozenset({1}), components=frozenset({"c2"})))
+
+    analyze_data(graph=graph, timeseries_data=timeseries_data, rule=rule, start_time=start)
+
+    files = sorted(path.name.split("_", 1)[1] for path in (tmp_path / "rule_1").iterdir())
+    assert files == ["raw.parquet", "resampled.parquet", "results.parquet", "rolling.parquet"]
+    results = pd.read_parquet(next((tmp_path / "rule_1").glob("*_results.parquet")))
+    assert set(results["componentURI"]) == {"c2"}
+    assert list(results.columns) == ["componentURI", "ts", "CO2_Sensor", "results"]
+
+
+def test_snapshots_are_skipped_for_other_rules(tmp_path):
+    graph, timeseries_data, rule, start = make_data()
+    configure(SnapshotConfig(directory=str(tmp_path), rule_ids=frozenset({2})))
+
+    analyze_data(graph=graph, timeseries_data=timeseries_data, rule=rule, start_time=start)
+
+    assert not tmp_path.joinpath("rule_1").exists()
+    assert write_snapshot("raw", timeseries_data, rule_id=1) is None
+
+
+def test_snapshot_config_from_env(monkeypatch):
+    assert SnapshotConfig.from_env() is None
+
+    monkeypatch.setenv("AFDD_SNAPSHOT_RULES", "1, 6")
+    monkeypatch.setenv("AFDD_SNAPSHOT_DIR", "/tmp/afdd")
+    config = SnapshotConfig.from_env()
+
+    assert config == SnapshotConfig(directory="/tmp/afdd", rule_ids=frozenset({1, 6}))
+    assert config.enabled_for(6) and not config.enabled_for(2)
+    assert snapshots._config is None
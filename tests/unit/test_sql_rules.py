@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from afdd.equation import EquationError
+from afdd.models import Condition, Metric, Rule, Severity
+from afdd.sql_rules import equation_to_sql, evaluates_in_database, rule_query
+
+
+def make_rule(equation: str, metric: Metric = Metric.AVERAGE) -> Rule:
+    return Rule(
+        rule_id=1,
+        name="rule",
+        component_type="AHU",
+        sensor_types=["CO2_Sensor", "PM10_Level_Sensor"],
+        description="",
+        condition=Condition(equation=equation, metric=metric, duration=600, sleep_time=1800, severity=Severity.HIGH),
+    )
+
+
+def test_equation_to_sql_gives_missing_values_the_numpy_answer():
+    columns = {"CO2_Sensor": "w.c0", "PM10_Level_Sensor": "w.c1"}
+
+    assert equation_to_sql("CO2_Sensor > 1000", columns) == "(COALESCE(w.c0 > 1000.0::float8, false))"
+    assert equation_to_sql("CO2_Sensor != 0", columns) == "(COALESCE(w.c0 <> 0.0::float8, true))"
+    assert equation_to_sql("1000 < CO2_Sensor < 1500 and not PM10_Level_Sensor > 50", columns) == (
+        "((COALESCE(1000.0::float8 < w.c0, false) AND COALESCE(w.c0 < 1500.0::float8, false)) AND "
+        "(NOT (COALESCE(w.c1 > 50.0::float8, false))))"
+    )
+    assert "'Infinity'::float8" in equation_to_sql("CO2_Sensor / PM10_Level_Sensor > 2", columns)
+
+
+@pytest.mark.parametrize(
+    "equation",
+    ["CO2_Sensor ** 2 > 10", "CO2_Sensor % 2 == 1", "exp(CO2_Sensor) > 1", "CO2_Sensor", "(CO2_Sensor > 1) == (PM10_Level_Sensor > 1)"],
+)
+def test_equation_to_sql_rejects_what_postgres_evaluates_differently(equation):
+    with pytest.raises(EquationError):
+        equation_to_sql(equation, {"CO2_Sensor": "c0", "PM10_Level_Sensor": "c1"})
+
+
+def test_evaluates_in_database():
+    assert evaluates_in_database(make_rule("CO2_Sensor > 1000 or abs(PM10_Level_Sensor) > 50", Metric.MAX))
+    assert not evaluates_in_database(make_rule("CO2_Sensor > 1000", Metric.P95))
+    assert not evaluates_in_database(make_rule("CO2_Sensor ** 2 > 1000"))
+
+
+def test_rule_query_only_sends_the_rule_sensors():
+    graph = pd.DataFrame({
+        "class": ["CO2_Sensor", "PM10_Level_Sensor", "Zone_Air_Temperature_Sensor"],
+        "timeseriesid": [" co2-1", "pm10-1", "temp-1"],
+        "componentURI": ["component1", "component1", "component1"],
+    })
+    start_time = datetime(2024, 10, 24, 12, 0, 10, tzinfo=timezone.utc)
+
+    query, parameters = rule_query(graph, make_rule("CO2_Sensor > 1000"), start_time, datetime(2024, 10, 24, 13, tzinfo=timezone.utc))
+
+    assert parameters["timeseries_ids"] == ["co2-1"]
+    assert parameters["class_c0"] == "CO2_Sensor"
+    assert parameters["resample_size"] == 150
+    assert parameters["throwaway_time"] == datetime(2024, 10, 24, 12, 10, tzinfo=timezone.utc)
+    assert "ROWS BETWEEN 4 PRECEDING AND CURRENT ROW" in query
@@ -0,0 +1,97 @@
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from afdd.db import PGCOPY_HEADER, PGCOPY_TRAILER, decode_bucket_copy, decode_timeseries_copy, pivot_timeseries, pivot_timeseries_columns
+from afdd.models import TimeseriesColumns
+
+
+@pytest.fixture
+def graph():
+    return pd.DataFrame({
+        "class": ["CO2_Sensor", "PM10_Level_Sensor", "CO2_Sensor", "CO2_Sensor"],
+        "timeseriesid": ["co2-1", "pm10-1 ", "co2-2", "co2-2"],
+        "componentURI": ["component1", "component1", "component2", "component3"],
+    })
+
+
+def readings():
+    ts = pd.to_datetime([
+        "2024-10-24T12:00:00", "2024-10-24T12:00:00", "2024-10-24T12:00:00", "2024-10-24T12:05:00",
+        "2024-10-24T12:05:00", "2024-10-24T12:10:00", "2024-10-24T12:10:00", "2024-10-24T12:00:00",
+    ], utc=True)
+    value = [400.0, 20.0, 410.0, np.nan, 21.0, 405.0, 405.0, 420.0]
+    timeseriesid = ["co2-1", "pm10-1", "co2-2", "co2-1", "pm10-1", "co2-1", "co2-1", "co2-2"]
+    return ts, value, timeseriesid
+
+
+def test_pivot_timeseries_columns_matches_pivot_timeseries(graph):
+    ts, value, timeseriesid = readings()
+    timeseries_ids = np.array(["co2-1", "pm10-1", "co2-2"], dtype=object)
+    columns = TimeseriesColumns(
+        ts=ts.asi8,
+        value=np.array(value),
+        point=pd.Index(timeseries_ids).get_indexer(timeseriesid).astype(np.int32),
+        timeseries_ids=timeseries_ids,
+    )
+
+    expected = pivot_timeseries(list(zip(ts, value, timeseriesid)), graph.copy())
+    result = pivot_timeseries_columns(columns, graph)
+
+    pd.testing.assert_frame_equal(result, expected)
+    # co2-2 belongs to two components and fills both, the first reading of a cell wins
+    assert result.loc[("component3", ts[0]), "CO2_Sensor"] == 410.0
+    assert graph["timeseriesid"].tolist()[1] == "pm10-1 "
+
+
+def test_pivot_timeseries_columns_without_readings(graph):
+    columns = TimeseriesColumns(
+        ts=np.array([], dtype=np.int64),
+        value=np.array([]),
+        point=np.array([], dtype=np.int32),
+        timeseries_ids=np.array(["co2-1"], dtype=object),
+    )
+
+    result = pivot_timeseries_columns(columns, graph)
+
+    assert result.empty
+    assert result.index.names == ["componentURI", "ts"]
+
+
+def test_decode_timeseries_copy_rejects_other_layouts():
+    with pytest.raises(ValueError):
+        decode_timeseries_copy(PGCOPY_HEADER + b"\x00\x02" + PGCOPY_TRAILER, np.array([], dtype=object))
+    with pytest.raises(ValueError):
+        decode_timeseries_copy(b"not a copy stream", np.array([], dtype=object))
+
+
+def postgres_us(ts):
+    return int((ts - datetime(2000, 1, 1, tzinfo=timezone.utc)).total_seconds() * 1_000_000)
+
+
+def test_decode_bucket_copy_combines_timeseries_of_the_same_cell():
+    graph = pd.DataFrame({
+        "class": ["CO2_Sensor", "CO2_Sensor", "PM10_Level_Sensor"],
+        "timeseriesid": ["co2-1", "co2-2", "pm10-1"],
+        "componentURI": ["component1", "component1", "component1"],
+    })
+    bucket = datetime(2024, 10, 24, 12, 0, tzinfo=timezone.utc)
+    last = datetime(2024, 10, 24, 12, 2, 10, tzinfo=timezone.utc)
+    rows = [(0, 2000.0, 2, 900.0, 1100.0), (1, 1200.0, 1, 1200.0, 1200.0), (2, 40.0, 2, 15.0, 25.0)]
+    payload = PGCOPY_HEADER + b"".join(
+        struct.pack("!hiqiiidiqididiq", 7, 8, postgres_us(bucket), 4, point, 8, total, 8, count, 8, low, 8, high, 8, postgres_us(last))
+        for point, total, count, low, high in rows
+    ) + PGCOPY_TRAILER
+
+    aggregates = decode_bucket_copy(payload, np.array(["co2-1", "co2-2", "pm10-1"], dtype=object), graph)
+
+    key = ("component1", pd.Timestamp(bucket))
+    assert aggregates.partials["sum"].loc[key].to_dict() == {"CO2_Sensor": 3200.0, "PM10_Level_Sensor": 40.0}
+    assert aggregates.partials["count"].loc[key].to_dict() == {"CO2_Sensor": 3, "PM10_Level_Sensor": 2}
+    assert aggregates.partials["min"].loc[key, "CO2_Sensor"] == 900.0
+    assert aggregates.partials["max"].loc[key, "CO2_Sensor"] == 1200.0
+    assert aggregates.watermark == pd.Timestamp(last)
+    assert len(aggregates) == 3
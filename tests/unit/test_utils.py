@@ -1,8 +1,66 @@
-from datetime import datetime, timezone
+import json
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta, timezone
 
-from afdd.utils import round_time
+from afdd.models import Anomaly, AnomalyBatch, Metadata
+from afdd.utils import component_metadata, merge_intervals, round_time
 
 def test_round_time():
     time = "2024-10-24T12:34:56"
     rounded = round_time(time, 300)
-    assert rounded == datetime(2024, 10, 24, 12, 35, tzinfo=timezone.utc)
\ No newline at end of file
+    assert rounded == datetime(2024, 10, 24, 12, 35, tzinfo=timezone.utc)
+
+def test_merge_intervals_merges_each_component_separately():
+    components = pd.Index(["c1", "c1", "c1", "c2", "c2"])
+    end_time = pd.DatetimeIndex(
+        ["2024-10-24 12:10", "2024-10-24 12:15", "2024-10-24 13:00", "2024-10-24 12:15", "2024-10-24 12:20"], tz="UTC"
+    )
+
+    intervals = merge_intervals(components=components, start_time=end_time - timedelta(minutes=10), end_time=end_time)
+
+    assert intervals["componentURI"].tolist() == ["c1", "c1", "c2"]
+    assert intervals["start_time"].tolist() == [pd.Timestamp(t, tz="UTC") for t in ["2024-10-24 12:00", "2024-10-24 12:50", "2024-10-24 12:05"]]
+    assert intervals["end_time"].tolist() == [pd.Timestamp(t, tz="UTC") for t in ["2024-10-24 12:15", "2024-10-24 13:00", "2024-10-24 12:20"]]
+
+
+def test_merge_intervals_merges_past_an_interval_inside_an_earlier_one():
+    components = pd.Index(["c1", "c1", "c1"])
+    start_time = pd.DatetimeIndex(["2024-10-24 12:00", "2024-10-24 12:10", "2024-10-24 12:50"], tz="UTC")
+    end_time = pd.DatetimeIndex(["2024-10-24 13:00", "2024-10-24 12:20", "2024-10-24 13:30"], tz="UTC")
+
+    intervals = merge_intervals(components=components, start_time=start_time, end_time=end_time)
+
+    assert intervals.values.tolist() == [["c1", pd.Timestamp("2024-10-24 12:00", tz="UTC"), pd.Timestamp("2024-10-24 13:30", tz="UTC")]]
+
+
+def test_component_metadata_matches_anomaly_format():
+    graph = pd.DataFrame(
+        {
+            "point": ["p1", "p2", "p3"],
+            "class": ["CO2_Sensor", "Temperature_Sensor", "CO2_Sensor"],
+            "timeseriesid": ["ts1", "ts2", "ts3"],
+            "deviceURI": ["d1", "d1", "d2"],
+            "componentURI": ["c1", "c1", "c2"],
+        }
+    )
+
+    metadata = component_metadata(graph=graph, components=np.array(["c1", "c2"]), sensor_types=["CO2_Sensor"])
+
+    expected = Anomaly(start_time="", end_time="", rule_id=1, points=np.array(["p1"]), metadata=Metadata(device="d1", component="c1")).to_tuple()
+    assert metadata.loc["c1", "points"] == expected[3]
+    assert metadata.loc["c1", "metadata"] == expected[4]
+    assert json.loads(metadata.loc["c2", "points"]) == ["p3"]
+
+
+def test_anomaly_batch_to_tuples():
+    batch = AnomalyBatch(
+        start_time=np.array(["start"], dtype=object),
+        end_time=np.array(["end"], dtype=object),
+        rule_id=3,
+        points=np.array(['["p1"]'], dtype=object),
+        metadata=np.array(['{"device": "d1", "component": "c1"}'], dtype=object),
+    )
+
+    assert batch.to_tuples() == [("start", "end", 3, '["p1"]', '{"device": "d1", "component": "c1"}')]
+    assert len(AnomalyBatch.empty(rule_id=3)) == 0
@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from afdd.db import PGCOPY_HEADER, PGCOPY_TRAILER, decode_bucket_copy
+from afdd.models import BucketAggregates, Rule, Condition, Metric, Severity
+from afdd.windows import IncrementalWindow, batch_window, bucket_partials, database_partials, resamples_in_database
+
+
+def make_rule(duration=600, metric=Metric.AVERAGE):
+    return Rule(
+        rule_id=1,
+        name="CO2 High",
+        component_type="IAQ_Sensor_Equipment",
+        sensor_types=["CO2_Sensor"],
+        description="",
+        condition=Condition(
+            equation="CO2_Sensor > 1000",
+            metric=metric,
+            duration=duration,
+            sleep_time=1800,
+            severity=Severity.HIGH,
+        ),
+    )
+
+
+def make_timeseries(start, periods, freq="10s", components=("component1", "component2"), seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for component in components:
+        ts = pd.date_range(start, periods=periods, freq=freq)
+        values = rng.integers(800, 1300, size=periods).astype(float)
+        # leave a gap without readings so that empty buckets are covered too
+        values[periods // 3 : periods // 3 + 40] = np.nan
+        frames.append(pd.DataFrame({"componentURI": component, "ts": ts, "CO2_Sensor": values}))
+    df = pd.concat(frames).dropna()
+    return df.set_index(["componentURI", "ts"]).sort_index()
+
+
+@pytest.mark.parametrize("metric", [Metric.AVERAGE, Metric.MAX, Metric.MIN, Metric.P95])
+def test_incremental_window_matches_batch_over_whole_history(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 7, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000)
+    batch = batch_window(data, rule, start)
+
+    window = IncrementalWindow(rule=rule)
+    ts = data.index.get_level_values("ts")
+    cycle_ends = [start + timedelta(seconds=s) for s in (1800, 1833, 4000, 6000, 10001)]
+    results = []
+    for cycle_end in cycle_ends:
+        fetch_start = window.fetch_start(start)
+        cycle = data.loc[(ts >= fetch_start) & (ts <= cycle_end)]
+        results.append(window.update(cycle, start))
+    incremental = pd.concat(results)
+
+    # the bucket that is still filling up is re-emitted on the next cycle, the last emission is the final value
+    incremental = incremental[~incremental.index.duplicated(keep="last")].sort_index()
+    pd.testing.assert_frame_equal(incremental, batch.sort_index())
+
+
+def test_incremental_window_emits_windows_over_a_gap_that_spans_cycles():
+    rule = make_rule()
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000)
+    ts = data.index.get_level_values("ts")
+    # component1 stops reporting for an hour, the cycle in between only has readings of component2
+    gap = (data.index.get_level_values(0) == "component1") & (ts >= start + timedelta(seconds=3000)) & (ts < start + timedelta(seconds=6600))
+    data = data.loc[~gap]
+    ts = data.index.get_level_values("ts")
+    batch = batch_window(data, rule, start)
+
+    window = IncrementalWindow(rule=rule)
+    results = []
+    for cycle_end in (start + timedelta(seconds=s) for s in (3600, 5400, 10001)):
+        cycle = data.loc[(ts >= window.fetch_start(start)) & (ts <= cycle_end)]
+        results.append(window.update(cycle, start))
+    incremental = pd.concat(results)
+
+    incremental = incremental[~incremental.index.duplicated(keep="last")].sort_index()
+    pd.testing.assert_frame_equal(incremental, batch.sort_index())
+
+
+@pytest.mark.parametrize("metric", [Metric.AVERAGE, Metric.MAX, Metric.P95])
+def test_gap_rows_match_batch_over_the_gap(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000)
+    ts = data.index.get_level_values("ts")
+    gap = (data.index.get_level_values(0) == "component1") & (ts >= start + timedelta(seconds=3000)) & (ts < start + timedelta(seconds=6600))
+    data = data.loc[~gap]
+    ts = data.index.get_level_values("ts")
+    batch = batch_window(data, rule, start)
+
+    # the window only saw the readings before the gap, component1's readings resume in the data it didn't see
+    window = IncrementalWindow(rule=rule)
+    window.update(data.loc[ts < start + timedelta(seconds=4500)], start)
+    resume = data.loc[ts >= start + timedelta(seconds=4500)].reset_index().groupby("componentURI")["ts"].min()
+    gap_rows = window.gap_rows(resume)
+
+    assert set(gap_rows.index.get_level_values(0)) == {"component1"}
+    assert gap_rows.index.get_level_values("ts").min() == start + timedelta(seconds=3000)
+    assert gap_rows.index.get_level_values("ts").max() == start + timedelta(seconds=6450)
+    pd.testing.assert_frame_equal(gap_rows, batch.loc[gap_rows.index])
+
+
+def test_incremental_window_only_keeps_last_buckets():
+    rule = make_rule()
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000, components=("component1",))
+
+    window = IncrementalWindow(rule=rule)
+    window.update(data, start)
+
+    assert len(window.partials["sum"]) == 5
+    assert window.watermark == data.index.get_level_values("ts").max()
+    assert window.fetch_start(start) == window.watermark.to_pydatetime()
+
+
+def test_incremental_window_without_new_data_returns_nothing():
+    rule = make_rule()
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=200)
+
+    window = IncrementalWindow(rule=rule)
+    window.update(data, start)
+
+    assert window.update(data, start).empty
+
+
+def test_incremental_window_forgets_removed_components():
+    rule = make_rule()
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=200)
+
+    window = IncrementalWindow(rule=rule)
+    window.update(data, start)
+    window.forget(["component2"])
+
+    assert set(window.partials["sum"].index.get_level_values(0)) == {"component1"}
+    assert set(window.partials["count"].index.get_level_values(0)) == {"component1"}
+
+
+@pytest.mark.parametrize("metric", [Metric.MAX, Metric.MIN])
+def test_batch_window_extremes_match_raw_readings(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000, components=("component1",))
+
+    result = batch_window(data, rule, start)
+
+    # every window covers the 5 buckets of 150 seconds ending with the bucket at ts
+    raw = data.droplevel(0)["CO2_Sensor"]
+    for ts, value in result.droplevel(0)["CO2_Sensor"].items():
+        in_window = raw[(raw.index >= ts - timedelta(seconds=600)) & (raw.index < ts + timedelta(seconds=150))]
+        expected = in_window.max() if metric is Metric.MAX else in_window.min()
+        assert value == expected
+
+
+@pytest.mark.parametrize("metric", [Metric.MEDIAN, Metric.P95])
+def test_batch_window_percentiles_are_within_relative_accuracy_of_raw_readings(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 0, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000, components=("component1",))
+
+    result = batch_window(data, rule, start)
+
+    raw = data.droplevel(0)["CO2_Sensor"]
+    for ts, value in result.droplevel(0)["CO2_Sensor"].items():
+        in_window = raw[(raw.index >= ts - timedelta(seconds=600)) & (raw.index < ts + timedelta(seconds=150))]
+        expected = np.quantile(in_window, metric.quantile, method="lower")
+        assert abs(value - expected) <= 0.01 * expected
+
+
+def aggregate_like_postgres(data, resample_size):
+    """What fetch_bucket_aggregates returns for the readings in data"""
+    if data.empty:
+        return BucketAggregates(partials={name: data for name in ("sum", "count", "min", "max")}, watermark=None, rows=0)
+    partials = {}
+    for metric in (Metric.AVERAGE, Metric.MAX, Metric.MIN):
+        partials.update(bucket_partials(data, resample_size, metric))
+    return BucketAggregates(partials=partials, watermark=data.index.get_level_values("ts").max(), rows=len(partials["sum"]))
+
+
+@pytest.mark.parametrize("metric", [Metric.AVERAGE, Metric.MAX, Metric.MIN])
+def test_window_from_database_buckets_matches_raw_readings(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 7, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=1000)
+
+    raw = IncrementalWindow(rule=rule)
+    database = IncrementalWindow(rule=rule)
+    ts = data.index.get_level_values("ts")
+    for cycle_end in [start + timedelta(seconds=s) for s in (1800, 1833, 1834, 4000, 10001)]:
+        expected = raw.update(data.loc[(ts >= raw.fetch_start(start)) & (ts <= cycle_end)], start)
+        aggregates = aggregate_like_postgres(data.loc[(ts >= database.database_fetch_start(start)) & (ts <= cycle_end)], 150)
+        result = database.update_partials(database_partials(aggregates, metric), aggregates.watermark, start)
+
+        pd.testing.assert_frame_equal(result, expected)
+        assert database.watermark == raw.watermark
+
+
+@pytest.mark.parametrize("metric", [Metric.AVERAGE, Metric.MAX, Metric.MIN])
+def test_empty_first_cycle_from_database_buckets_starts_no_state(metric):
+    rule = make_rule(metric=metric)
+    start = datetime(2024, 10, 24, 12, 0, 7, tzinfo=timezone.utc)
+    data = make_timeseries(start, periods=500)
+    graph = pd.DataFrame({"class": ["CO2_Sensor"], "timeseriesid": ["ts1"], "componentURI": ["component1"]})
+    # what the bucket aggregate query returns for a quiet sensor
+    empty = decode_bucket_copy(PGCOPY_HEADER + PGCOPY_TRAILER, np.array(["ts1"], dtype=object), graph)
+
+    raw = IncrementalWindow(rule=rule)
+    database = IncrementalWindow(rule=rule)
+    assert raw.update(data.iloc[:0], start).empty
+    assert database.update_partials(database_partials(empty, metric), empty.watermark, start).empty
+    assert database.watermark is None and database.partials is None
+
+    expected = raw.update(data, start)
+    aggregates = aggregate_like_postgres(data, 150)
+    result = database.update_partials(database_partials(aggregates, metric), aggregates.watermark, start)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_percentile_metrics_are_not_resampled_in_database():
+    assert resamples_in_database(Metric.AVERAGE)
+    assert not resamples_in_database(Metric.P95)